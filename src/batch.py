@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Index a batch of jobs described by a json manifest:
+
+{
+ "es_hosts": ["172.20.22.104:9200"],
+ "parallelism": 4,
+ "parse_workers": 8,
+ "layout": "rolling",
+ "mysql": {"server": "172.20.38.50", "database": "sandbox"},
+ "jobs": [
+  {"type": "jenkins", "module": "fc6000ts", "config": "256_Generic",
+   "builds": [1203, 1204], "log_type": "ckcm"},
+  {"type": "tarball", "path": "/data/ckcm-fc6000ts.tgz", "module": "fc6000ts",
+   "config": "256_Generic", "build": 1180},
+  {"type": "mysql", "table": "t_statistic", "key": "id"}
+ ]
+}
+
+Command line options override the manifest settings.
+"""
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import sys
+import json
+import time
+from collections import namedtuple
+
+# Module imports
+import src.index as index
+from src.com import logger
+from src.com import init_logging
+from src.com import LOG_FILE
+from src.com import ManifestException
+from src.bulk import thread_indexed
+from src.metrics import METRICS
+
+# Job types of a manifest
+JOB_TYPES = ('jenkins', 'tarball', 'mysql')
+
+# Default number of jobs run at once
+DEFAULT_PARALLELISM = 2
+
+# One job of a manifest: type, display name, manifest entry
+Job = namedtuple('Job', ['job_type', 'name', 'spec'])
+
+# Outcome of a job
+JobReport = namedtuple('JobReport', ['name', 'success', 'es_index', 'documents',
+                                     'seconds', 'error'])
+
+
+def _require(spec, *keys):
+    """ check mandatory keys of a manifest entry """
+    missing = [key for key in keys if key not in spec]
+    if missing:
+        raise ManifestException('%s job: missing %s' % (spec.get('type'), ', '.join(missing)))
+
+
+def expand_jobs(entries):
+    """
+    @goal: one job per jenkins build, tarball or table of the manifest
+    @param entries: manifest "jobs" list
+    @return list of Job
+    """
+    jobs = []
+    for spec in entries:
+        job_type = spec.get('type')
+        if job_type not in JOB_TYPES:
+            raise ManifestException('unknown job type: %s' % job_type)
+        if job_type == 'jenkins':
+            _require(spec, 'module', 'config')
+            builds = spec.get('builds') or [spec.get('build', 'lastSuccessfulBuild')]
+            for build in builds:
+                job_spec = dict(spec, build=str(build))
+                jobs.append(Job(job_type, '%s/%s#%s' % (spec['module'], spec['config'], build),
+                                job_spec))
+        elif job_type == 'tarball':
+            _require(spec, 'path', 'module', 'config')
+            build = spec.get('build', 'local')
+            jobs.append(Job(job_type, '%s (%s/%s#%s)' % (spec['path'], spec['module'],
+                                                         spec['config'], build),
+                            dict(spec, build=build)))
+        else:
+            _require(spec, 'table')
+            jobs.append(Job(job_type, 'mysql:%s' % spec['table'], spec))
+    return jobs
+
+
+def load_job_manifest(manifest_file):
+    """
+    @goal: read a batch manifest
+    @param manifest_file: json manifest path
+    @return (settings dictionary, list of Job)
+    """
+    with open(manifest_file) as manifest_c:
+        try:
+            manifest = json.load(manifest_c)
+        except ValueError as exc:
+            raise ManifestException('%s: %s' % (manifest_file, exc))
+    settings = dict((key, value) for key, value in manifest.items() if key != 'jobs')
+    return settings, expand_jobs(manifest.get('jobs', []))
+
+
+def job_work_directory(job, work_directory):
+    """
+    @goal: work directory of a job, temporary if no work directory is set
+    @return (directory, temporary)
+    """
+    import tempfile
+
+    if work_directory is None:
+        return tempfile.mkdtemp(prefix='parselog-'), True
+    name = '%s-%s-%s' % (job.spec['module'], job.spec['config'], job.spec['build'])
+    directory = os.path.join(work_directory, name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory, False
+
+
+def rollup_file(settings, es_index):
+    """
+    @return rollup json file of a build, None if no rollup directory is set
+    """
+    directory = settings.get('rollup_directory')
+    if directory is None:
+        return None
+    return os.path.join(directory, '%s.rollup.json' % es_index)
+
+
+def index_traces_job(job, settings, pool):
+    """
+    @goal: download (jenkins) or untar (tarball) then index one build
+    @return (success, es_index)
+    """
+    spec = job.spec
+    log_type = spec.get('log_type', 'ckcm')
+    directory, temporary = job_work_directory(job, settings.get('work_directory'))
+    traces = None
+    try:
+        if job.job_type == 'jenkins':
+            traces = index.prepare_module(spec['module'], spec['config'],
+                                          job_number=spec['build'], log_type=log_type,
+                                          url=spec.get('url'), work_directory=directory)
+        else:
+            traces = index.prepare_tgz(spec['path'], spec['module'], spec['config'],
+                                       spec['build'], log_type=log_type,
+                                       work_directory=directory)
+        if traces is None:
+            return False, None
+        results = index.index_directory(traces.directory_c, traces.es_index, log_type,
+                                        traces.package_version, spec['module'].lower(),
+                                        traces.pytestemb_version,
+                                        incremental=settings.get('incremental', False),
+                                        pool=pool, hosts=settings.get('es_hosts'),
+                                        layout=settings.get('layout'), fields=traces.fields,
+                                        rollup_file=rollup_file(settings, traces.es_index),
+                                        templates=settings.get('templates'))
+        return all(error_code for _, error_code in results), traces.es_index
+    finally:
+        index.clean_work_directory(directory, traces, temporary)
+
+
+def index_table_job(job, settings):
+    """
+    @goal: index one MySQL table
+    @return (success, es_index)
+    """
+    mysql = settings.get('mysql', {})
+    success = index.index_table(job.spec['table'],
+                                settings.get('es_hosts') or index.ES_HOSTS,
+                                key=job.spec.get('key'),
+                                state_file=mysql.get('state_file', index.MYSQL_STATE_FILE),
+                                server=mysql.get('server', index.MYSQL_HOST),
+                                user=mysql.get('user', index.MYSQL_USER),
+                                password=mysql.get('password', index.MYSQL_PASSWORD),
+                                database=mysql.get('database', index.MYSQL_DATABASE))
+    return success, job.spec['table']
+
+
+def run_job(job, settings, pool=None):
+    """
+    @goal: run one job, failures are reported, not raised
+    @param job: Job
+    @param settings: manifest settings
+    @param pool: multiprocessing pool shared by the jobs parsing files
+    @return JobReport
+    """
+    start = time.time()
+    es_index = None
+    error = None
+    success = False
+    # documents indexed by a job: indexed by its thread (rolling layout
+    # indices are shared by the jobs)
+    indexed_before = thread_indexed()
+    try:
+        if job.job_type == 'mysql':
+            success, es_index = index_table_job(job, settings)
+        else:
+            success, es_index = index_traces_job(job, settings, pool)
+    except Exception as exc:
+        error = '%s: %s' % (type(exc).__name__, exc)
+        logger.error("%s failed: %s", job.name, error)
+    documents = thread_indexed() - indexed_before
+    return JobReport(job.name, bool(success), es_index, documents,
+                     time.time() - start, error)
+
+
+def run_jobs(jobs, settings, parallelism=DEFAULT_PARALLELISM, parse_workers=None):
+    """
+    @goal: run jobs, parallelism at once, files parsed in one shared pool
+    @param jobs: list of Job
+    @param settings: manifest settings (es_hosts, work_directory, mysql...)
+    @param parallelism: number of jobs run at once
+    @param parse_workers: number of parsing processes (cpu count if None,
+                          files parsed in the job threads if 0)
+    @return list of JobReport, in jobs order
+    Metrics are reset first: they cover this batch, jobs running at once
+    share them (documents and duration of each job are in its JobReport)
+    """
+    import multiprocessing
+    import threading
+    import Queue
+
+    jobs_queue = Queue.Queue()
+    for position, job in enumerate(jobs):
+        jobs_queue.put((position, job))
+    reports = [None] * len(jobs)
+    METRICS.reset()
+    pool = multiprocessing.Pool(parse_workers) if parse_workers != 0 else None
+
+    def worker():
+        """ run jobs until none is left """
+        while True:
+            try:
+                position, job = jobs_queue.get_nowait()
+            except Queue.Empty:
+                return
+            logger.info("Job %d/%d: %s", position + 1, len(jobs), job.name)
+            reports[position] = run_job(job, settings, pool)
+            report = reports[position]
+            logger.info("Job %s: %s, %d documents in %.1f s", job.name,
+                        'done' if report.success else 'FAILED', report.documents,
+                        report.seconds)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, parallelism))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return reports
+
+
+def format_reports(reports, seconds):
+    """
+    @goal: throughput table, one line per job and a total
+    @return list of strings
+    """
+    lines = ['%-60s %-6s %10s %8s %10s' % ('job', 'status', 'documents', 'seconds', 'docs/s')]
+    for report in reports:
+        lines.append('%-60s %-6s %10d %8.1f %10.0f' % (
+            report.name[:60], 'ok' if report.success else 'FAILED', report.documents,
+            report.seconds, report.documents / report.seconds if report.seconds else 0))
+    documents = sum(report.documents for report in reports)
+    lines.append('%-60s %-6s %10d %8.1f %10.0f' % (
+        'total', '%d/%d' % (sum(report.success for report in reports), len(reports)),
+        documents, seconds, documents / seconds if seconds else 0))
+    return lines
+
+
+def main(argv=None):
+    """
+    Command line: python -m src.batch manifest.json [options]
+    """
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('manifest', help='json job manifest')
+    arg_parser.add_argument('--es-host', action='append', dest='es_hosts',
+                            help='elasticsearch host (repeat for several nodes)')
+    arg_parser.add_argument('--parallelism', type=int, help='jobs run at once')
+    arg_parser.add_argument('--parse-workers', type=int,
+                            help='parsing processes (cpu count by default, 0: none)')
+    arg_parser.add_argument('--work-directory', help='downloads kept between runs')
+    arg_parser.add_argument('--incremental', action='store_true', default=None,
+                            help='only index new or grown files')
+    arg_parser.add_argument('--layout', choices=index.INDEX_LAYOUTS,
+                            help='one index per build or rolling indices')
+    arg_parser.add_argument('--metrics-file', help='.prom or json metrics file')
+    arg_parser.add_argument('--rollup-directory', help='rollup statistics json files')
+    arg_parser.add_argument('--templates', action='store_true', default=None,
+                            help='mine message templates, collapse repeated lines')
+    arg_parser.add_argument('--report', help='json report of the jobs')
+    arg_parser.add_argument('--profile', help='profiles output directory')
+    arg_parser.add_argument('--profile-mode', default='cprofile', choices=('cprofile', 'sample'))
+    arg_parser.add_argument('--log-file', default=LOG_FILE)
+    arg_parser.add_argument('--no-color', dest='color', action='store_false', default=None)
+    args = arg_parser.parse_args(argv)
+    init_logging(args.log_file, color=args.color)
+
+    settings, jobs = load_job_manifest(args.manifest)
+    for key in ('es_hosts', 'parallelism', 'parse_workers', 'work_directory',
+                'incremental', 'layout', 'metrics_file', 'rollup_directory', 'templates'):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    if settings.get('rollup_directory') and not os.path.isdir(settings['rollup_directory']):
+        os.makedirs(settings['rollup_directory'])
+    if args.profile:
+        from src.profiling import enable_profiling
+        enable_profiling(args.profile, args.profile_mode)
+
+    start = time.time()
+    reports = run_jobs(jobs, settings, settings.get('parallelism', DEFAULT_PARALLELISM),
+                       settings.get('parse_workers'))
+    seconds = time.time() - start
+
+    for line in format_reports(reports, seconds):
+        print line
+    index.report_metrics(settings.get('metrics_file'))
+    if args.profile:
+        from src.profiling import dump_profiles
+        dump_profiles()
+    if args.report:
+        with open(args.report, 'w') as report_c:
+            json.dump([report._asdict() for report in reports], report_c, indent=1)
+
+    return 0 if all(report.success for report in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
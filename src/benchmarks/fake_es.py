@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Local stand-in for an Elasticsearch node, bulk endpoint first """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import json
+import time
+import socket
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+class FakeElasticsearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer the requests sent by the indexing code: info, count, index
+    creation/deletion/settings and bulk (documents accepted, or rejected
+    with 429 as configured on the server)
+    """
+    protocol_version = 'HTTP/1.1'
+    # Buffered replies: headers and body in one segment (no delayed ack)
+    wbufsize = -1
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _reply(self, status, payload=None):
+        body = json.dumps(payload if payload is not None else {})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _bulk(self, body):
+        """
+        @goal: acknowledge the actions of a bulk body
+        @return (status, response)
+        """
+        server = self.server
+        lines = [line for line in body.split('\n') if line.strip()]
+        if server.draw(server.reject_request_ratio):
+            server.record(self.command, self.path, 0, len(body), rejected=len(lines) // 2)
+            return 429, {'error': {'type': 'es_rejected_execution_exception'}, 'status': 429}
+        items = []
+        ids = []
+        accepted = 0
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            op_type = action.keys()[0]
+            position += 1 if op_type == 'delete' else 2
+            if server.draw(server.reject_ratio):
+                items.append({op_type: {'status': 429, '_id': action[op_type].get('_id'),
+                                        'error': {'type': 'es_rejected_execution_exception'}}})
+            else:
+                accepted += 1
+                ids.append(action[op_type].get('_id'))
+                items.append({op_type: {'status': 201, '_id': action[op_type].get('_id')}})
+        time.sleep(server.latency + server.document_latency * len(items))
+        server.record(self.command, self.path, accepted, len(body),
+                      rejected=len(items) - accepted, ids=ids)
+        return 200, {'took': 1, 'errors': accepted < len(items), 'items': items}
+
+    def do_GET(self):
+        body = self._body()
+        if self.path.split('?')[0].endswith('_count'):
+            self._reply(200, {'count': self.server.documents})
+        elif self.path.split('?')[0] in ('', '/'):
+            self._reply(200, {'name': 'fake', 'version': {'number': '5.5.3'},
+                              'tagline': 'You Know, for Search'})
+        else:
+            self.server.record(self.command, self.path, 0, len(body))
+            self._reply(200, {})
+
+    def do_POST(self):
+        body = self._body()
+        if self.path.split('?')[0].endswith('_bulk'):
+            self._reply(*self._bulk(body))
+        else:
+            self.server.record(self.command, self.path, 0, len(body))
+            self._reply(200, {'acknowledged': True})
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_DELETE(self):
+        self.server.record(self.command, self.path, 0, len(self._body()))
+        self._reply(200, {'acknowledged': True})
+
+    def do_HEAD(self):
+        self._reply(200)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeElasticsearch(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded fake node, served from a background thread
+        with FakeElasticsearch() as fake_es:
+            Elasticsearch(hosts=fake_es.host)
+    Backpressure is simulated by rejecting (429) a ratio of the bulk
+    documents or of whole bulk requests, and by a latency per request and
+    per document
+    """
+    daemon_threads = True
+
+    def __init__(self, handler=FakeElasticsearchHandler, reject_ratio=0.0,
+                 reject_request_ratio=0.0, latency=0.0, document_latency=0.0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.reject_ratio = reject_ratio
+        self.reject_request_ratio = reject_request_ratio
+        self.latency = latency
+        self.document_latency = document_latency
+        self.documents = 0
+        self.rejected = 0
+        # ids of accepted documents (None: generated by elasticsearch)
+        self.ids = []
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        # Kept-alive client connections, closed on stop
+        self._connections = set()
+
+    def draw(self, ratio):
+        """ True with probability ratio """
+        if not ratio:
+            return False
+        with self._lock:
+            return self._random.random() < ratio
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_port
+
+    def record(self, method, path, documents, size, rejected=0, ids=()):
+        """
+        @goal: keep track of a request (method, path, documents, body bytes),
+               documents: documents accepted
+        """
+        with self._lock:
+            self.documents += documents
+            self.rejected += rejected
+            self.ids.extend(ids)
+            self.requests.append((method, path, documents, size))
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._lock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
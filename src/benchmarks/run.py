@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Parse / index pipeline benchmarks, results written as json """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import resource
+import tempfile
+import multiprocessing
+
+# Module imports
+from src.benchmarks import tracegen
+
+# Default workload
+DEFAULT_FILES = 4
+DEFAULT_LINES = 50000
+
+# Relative slow down reported as a regression by --compare
+DEFAULT_THRESHOLD = 0.2
+
+
+def bench_ckcm_log(workload):
+    """ CkcmLog classification of in-memory frames """
+    import src.log as log
+    rand = random.Random(0)
+    lines = [tracegen.ckcm_line(rand, index).decode('utf8')
+             for index in xrange(workload['lines'])]
+    record = log.CkcmLog()
+    start = time.time()
+    for line in lines:
+        record.data = line
+    return len(lines), 'lines', time.time() - start
+
+
+def bench_ckcm_log_long(workload):
+    """ CkcmLog classification of long frames (~470 characters, dumps) """
+    import src.log as log
+    rand = random.Random(0)
+    lines = [(tracegen.ckcm_line(rand, index) + ' ' +
+              ' '.join('%08x' % rand.getrandbits(32) for _ in xrange(45))).decode('utf8')
+             for index in xrange(workload['lines'])]
+    record = log.CkcmLog()
+    start = time.time()
+    for line in lines:
+        record.data = line
+    return len(lines), 'lines', time.time() - start
+
+
+def bench_octopylog_log(workload):
+    """ OctopylogLog field extraction of in-memory frames """
+    import src.log as log
+    rand = random.Random(0)
+    lines = [tracegen.octopylog_line(rand, index).decode('utf8')
+             for index in xrange(workload['lines'])]
+    record = log.OctopylogLog(tracegen.PYTESTEMB_VERSION)
+    start = time.time()
+    for line in lines:
+        record.data = line
+    return len(lines), 'lines', time.time() - start
+
+
+def bench_octopylog_lines(workload):
+    """ split_octopylog_lines of in-memory frames, by parser batches """
+    import src.log as log
+    import src.parser as parser
+    rand = random.Random(0)
+    lines = [tracegen.octopylog_line(rand, index).decode('utf8')
+             for index in xrange(workload['lines'])]
+    first_field_position = log.get_octopylog_format(tracegen.PYTESTEMB_VERSION)[2]
+    start = time.time()
+    for batch_start in xrange(0, len(lines), parser.OCTOPYLOG_BATCH_SIZE):
+        log.split_octopylog_lines(lines[batch_start:batch_start + parser.OCTOPYLOG_BATCH_SIZE],
+                                  first_field_position)
+    return len(lines), 'lines', time.time() - start
+
+
+def _bench_parser(workload, log_type, serialize):
+    """ parse every file of the workload directory """
+    import src.parser as parser
+    parser_c = parser.get_parser(log_type, tracegen.PYTESTEMB_VERSION, serialize=serialize)
+    count = 0
+    start = time.time()
+    for path in workload[log_type]:
+        for _ in parser_c.parse(path, version='v1.0.0', module='fc6000'):
+            count += 1
+    return count, 'lines', time.time() - start
+
+
+def bench_ckcm_parser(workload):
+    """ CkcmParser, document dictionaries """
+    return _bench_parser(workload, 'ckcm', False)
+
+
+def bench_ckcm_parser_json(workload):
+    """ CkcmParser, pre-serialized json documents """
+    return _bench_parser(workload, 'ckcm', True)
+
+
+def bench_octopylog_parser(workload):
+    """ OctopylogParser, document dictionaries """
+    return _bench_parser(workload, 'octopylog', False)
+
+
+def bench_tar_extract(workload):
+    """ untar to disk (decompressed_tgz) """
+    from src.com import decompressed_tgz
+    output = tempfile.mkdtemp(prefix='parselog-bench-')
+    try:
+        start = time.time()
+        decompressed_tgz(workload['tgz'], output)
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+    return workload['tgz_bytes'], 'bytes', seconds
+
+
+def bench_tar_stream(workload):
+    """ read members from the tar.gz stream (iter_tgz_members) """
+    from src.com import iter_tgz_members
+    start = time.time()
+    for member in iter_tgz_members(workload['tgz']):
+        for _ in iter(lambda: member.read(1024 * 1024), ''):
+            pass
+    return workload['tgz_bytes'], 'bytes', time.time() - start
+
+
+def _bench_bulk_body(workload, serialize):
+    """ bulk request bodies as built by the elasticsearch helpers """
+    from elasticsearch.helpers import expand_action
+    from elasticsearch.serializer import JSONSerializer
+    import src.parser as parser
+    serializer = JSONSerializer()
+    parser_c = parser.get_parser('ckcm', serialize=serialize)
+    count = 0
+    start = time.time()
+    for path in workload['ckcm']:
+        for data in parser_c.parse(path, version='v1.0.0', module='fc6000'):
+            action, source = expand_action(data)
+            serializer.dumps(action)
+            serializer.dumps(source)
+            count += 1
+    return count, 'lines', time.time() - start
+
+
+def bench_bulk_body(workload):
+    """ parse + bulk body of document dictionaries """
+    return _bench_bulk_body(workload, False)
+
+
+def bench_bulk_body_json(workload):
+    """ parse + bulk body of pre-serialized documents """
+    return _bench_bulk_body(workload, True)
+
+
+def bench_bulk_index(workload):
+    """ index_file against a local fake bulk endpoint """
+    from elasticsearch import Elasticsearch
+    from src.benchmarks.fake_es import FakeElasticsearch
+    import src.index as index
+    with FakeElasticsearch() as fake_es:
+        es_c = Elasticsearch(hosts=fake_es.host)
+        start = time.time()
+        for path in workload['ckcm']:
+            index.index_file(es_c, path, 'bench', 'ckcm', version='v1.0.0', module='fc6000')
+        seconds = time.time() - start
+        count = fake_es.documents
+    return count, 'lines', seconds
+
+
+BENCHMARKS = (('ckcm_log', bench_ckcm_log),
+              ('ckcm_log_long', bench_ckcm_log_long),
+              ('octopylog_log', bench_octopylog_log),
+              ('octopylog_lines', bench_octopylog_lines),
+              ('ckcm_parser', bench_ckcm_parser),
+              ('ckcm_parser_json', bench_ckcm_parser_json),
+              ('octopylog_parser', bench_octopylog_parser),
+              ('tar_extract', bench_tar_extract),
+              ('tar_stream', bench_tar_stream),
+              ('bulk_body', bench_bulk_body),
+              ('bulk_body_json', bench_bulk_body_json),
+              ('bulk_index', bench_bulk_index))
+
+
+def make_workload(directory, files=DEFAULT_FILES, lines=DEFAULT_LINES):
+    """
+    @goal: generate the synthetic traces used by every benchmark
+    @return workload dictionary
+    """
+    ckcm_dir = os.path.join(directory, 'ckcm')
+    octopylog_dir = os.path.join(directory, 'octopylog')
+    workload = {'files': files, 'lines': lines}
+    workload['ckcm'] = tracegen.write_trace_directory(ckcm_dir, 'ckcm', files, lines)[:-1]
+    workload['octopylog'] = tracegen.write_trace_directory(octopylog_dir, 'octopylog',
+                                                           files, lines)[:-1]
+    workload['tgz'] = tracegen.write_tgz(ckcm_dir, os.path.join(directory, 'ckcm.tgz'))
+    workload['tgz_bytes'] = sum(os.path.getsize(path) for path in workload['ckcm'])
+    return workload
+
+
+def _child(queue, func, workload):
+    """
+    @goal: run a benchmark in its own process, so that peak memory is its own
+    """
+    import logging
+    logging.getLogger('index').setLevel(logging.WARNING)
+    try:
+        count, unit, seconds = func(workload)
+        queue.put({'count': count, 'unit': unit, 'seconds': seconds,
+                   'rate': count / seconds if seconds else None,
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    except Exception as exc:
+        queue.put({'error': '%s: %s' % (type(exc).__name__, exc)})
+
+
+def run_benchmark(name, func, workload):
+    """
+    @goal: run one benchmark in a child process
+    @return result dictionary
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child, args=(queue, func, workload))
+    process.start()
+    result = queue.get()
+    process.join()
+    result['name'] = name
+    return result
+
+
+def git_revision():
+    """
+    @goal: current commit, to tell results apart
+    """
+    import subprocess
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(files=DEFAULT_FILES, lines=DEFAULT_LINES, selected=None):
+    """
+    @goal: run the benchmark suite
+    @param files: number of trace files per log type
+    @param lines: number of lines per trace file
+    @param selected: benchmark names (all if None)
+    @return results dictionary
+    """
+    directory = tempfile.mkdtemp(prefix='parselog-bench-')
+    try:
+        workload = make_workload(directory, files, lines)
+        results = [run_benchmark(name, func, workload) for name, func in BENCHMARKS
+                   if not selected or name in selected]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'files': files,
+            'lines': lines,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': results}
+
+
+def compare(previous, current, threshold=DEFAULT_THRESHOLD):
+    """
+    @goal: benchmarks whose rate dropped by more than threshold
+    @return list of (name, previous rate, current rate)
+    """
+    previous_rates = dict((result['name'], result.get('rate'))
+                          for result in previous['benchmarks'])
+    regressions = []
+    for result in current['benchmarks']:
+        before = previous_rates.get(result['name'])
+        after = result.get('rate')
+        if before and after and after < before * (1 - threshold):
+            regressions.append((result['name'], before, after))
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line: python -m src.benchmarks.run [--output results.json]
+    """
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--files', type=int, default=DEFAULT_FILES)
+    arg_parser.add_argument('--lines', type=int, default=DEFAULT_LINES)
+    arg_parser.add_argument('--only', action='append', help='benchmark name')
+    arg_parser.add_argument('--output', help='json results file')
+    arg_parser.add_argument('--compare', help='previous json results file')
+    arg_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = arg_parser.parse_args(argv)
+
+    results = run(args.files, args.lines, args.only)
+    for result in results['benchmarks']:
+        if 'error' in result:
+            print '%-18s ERROR %s' % (result['name'], result['error'])
+        else:
+            print '%-18s %12.0f %s/s %10d KB peak' % (result['name'], result['rate'] or 0,
+                                                     result['unit'], result['peak_rss_kb'])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(json.load(previous), results, args.threshold)
+        for name, before, after in regressions:
+            print 'REGRESSION %s: %.0f -> %.0f /s' % (name, before, after)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Synthetic wxCKCM / octopylog trace generator """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import random
+import tarfile
+
+# ckcm frame: [timestamp][pid][tid][S]<tag> <message>
+# the library tag follows the severity bracket, e.g. '[I]RAP'
+CKCM_LIBRARY_MIX = (('RAP', 20), ('TALA', 10), ('TANGO', 10), ('SOP', 5),
+                    ('CCTOS', 5), ('DISCO', 5), ('SOUL', 5), ('BT', 15),
+                    ('HSTI', 15), ('wxCKCM', 10))
+
+SEVERITY_MIX = (('I', 50), ('D', 20), ('V', 10), ('W', 10), ('E', 8), ('C', 2))
+
+OCTOPYLOG_TYPE_MIX = (('INFO', 60), ('DEBUG', 20), ('WARNING', 10), ('ERROR', 8),
+                      ('TRACE', 2))
+
+PYTESTEMB_VERSION = '2.2.0'
+
+_MESSAGES = ('connection handle=0x%04x state %d',
+             'buffer %d bytes at 0x%08x',
+             'timer %d expired after %d ms',
+             'profile %d event %d received',
+             'request %d queued (%d pending)')
+
+_AT_COMMANDS = ('+CGMR', '+CGMREX', '*PSSTKI', '+CLCC', '*PBSYNC')
+
+
+def _weighted(rand, mix):
+    """
+    @goal: pick a value from ((value, weight), ...)
+    """
+    total = sum(weight for _, weight in mix)
+    point = rand.uniform(0, total)
+    for value, weight in mix:
+        point -= weight
+        if point <= 0:
+            return value
+    return mix[-1][0]
+
+
+def _message(rand):
+    """
+    @goal: message with varying numbers, handles and addresses
+    """
+    return rand.choice(_MESSAGES) % (rand.randint(0, 0xffff), rand.randint(0, 0xffffff))
+
+
+def ckcm_line(rand, index, library_mix=CKCM_LIBRARY_MIX, severity_mix=SEVERITY_MIX,
+              hsti_ratio=0.5):
+    """
+    @goal: one synthetic wxCKCM frame
+    @param hsti_ratio: part of HSTI frames which are AT command/event frames
+    """
+    library = _weighted(rand, library_mix)
+    severity = _weighted(rand, severity_mix)
+    timestamp = '%02d:%02d:%02d.%03d' % (index // 3600000 % 24, index // 60000 % 60,
+                                         index // 1000 % 60, index % 1000)
+    prefix = '[%s][%d][%d][%s]' % (timestamp, 1000 + index % 7, 2000 + index % 13, severity)
+    if library == 'HSTI' and rand.random() < hsti_ratio:
+        if rand.random() < 0.5:
+            return '%sHSTI WaitCmdAT%s<LF>' % (prefix, rand.choice(_AT_COMMANDS))
+        return "%sHSTI WaitCmd: %s: '%d'<LF>" % (prefix, rand.choice(_AT_COMMANDS),
+                                                 rand.randint(0, 99))
+    if library == 'wxCKCM':
+        return '%s wxCKCM %s' % (prefix, _message(rand))
+    return '%s%s %s' % (prefix, library, _message(rand))
+
+
+def octopylog_line(rand, index, type_mix=OCTOPYLOG_TYPE_MIX):
+    """
+    @goal: one synthetic octopylog frame (pytestemb >= 2.2 layout)
+    """
+    return '2015-06-%02d %d %02d:%02d:%02d.%03d %s %s' % (
+        1 + index // 86400000 % 28, index, index // 3600000 % 24, index // 60000 % 60,
+        index // 1000 % 60, index % 1000, _weighted(rand, type_mix), _message(rand))
+
+
+def write_ckcm_trace(path, lines, seed=0, **mix):
+    """
+    @goal: write a synthetic wxCKCM trace file
+    @param path: output file, named like jenkins traces '<test>_<x>_<y>.log'
+    @param lines: number of frames
+    @param mix: library_mix, severity_mix, hsti_ratio (see ckcm_line)
+    @return number of bytes written
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as trace:
+        for index in xrange(lines):
+            trace.write(ckcm_line(rand, index, **mix) + '\n')
+    return os.path.getsize(path)
+
+
+def write_octopylog_trace(path, lines, seed=0, pytestemb_version=PYTESTEMB_VERSION,
+                          **mix):
+    """
+    @goal: write a synthetic octopylog trace file, with its pytestemb header
+    @return number of bytes written
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as trace:
+        trace.write('2015-06-01 0 00:00:00.000 INFO Library version : pytestemb %s\n'
+                    % pytestemb_version)
+        for index in xrange(1, lines):
+            trace.write(octopylog_line(rand, index, **mix) + '\n')
+    return os.path.getsize(path)
+
+
+def write_trace_directory(directory, log_type='ckcm', files=4, lines=10000, seed=0,
+                          version='v1.0.0', **mix):
+    """
+    @goal: write a synthetic build traces directory, with a version file
+    @return list of trace files
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for number in range(files):
+        if log_type == 'ckcm':
+            path = os.path.join(directory, 'test_%03d_ckcm_%d.log' % (number, seed))
+            write_ckcm_trace(path, lines, seed + number, **mix)
+        else:
+            path = os.path.join(directory, 'test_%03d_%d.log' % (number, seed))
+            write_octopylog_trace(path, lines, seed + number, **mix)
+        paths.append(path)
+    setenv = os.path.join(directory, 'setenv_module_ckcm_0.log')
+    with open(setenv, 'wb') as trace:
+        trace.write("[00:00:00.000][1][1][I]HSTI +CGMREX: '%s FC60x0'<LF>\n" % version)
+    paths.append(setenv)
+    return paths
+
+
+def write_tgz(directory, tgz_file):
+    """
+    @goal: archive a traces directory like jenkins artifacts (one top directory)
+    """
+    with tarfile.open(tgz_file, 'w:gz') as tgz_c:
+        tgz_c.add(directory, os.path.basename(directory.rstrip('/')))
+    return tgz_file
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Adaptive Elasticsearch bulk writer: chunk sizing, 429 retries, hosts """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import time
+import random
+import threading
+
+# Module imports
+from src.com import logger
+from src.metrics import METRICS
+from src.metrics import SIZE_BUCKETS
+
+# Chunk size bounds (documents), first chunk size
+BULK_MIN_CHUNK_SIZE = 50
+BULK_MAX_CHUNK_SIZE = 5000
+BULK_START_CHUNK_SIZE = 500
+
+# Bulk request latency aimed at (seconds)
+BULK_TARGET_SECONDS = 1.0
+
+# Max size of a bulk request (bytes)
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+# Timeout of a bulk request (seconds)
+BULK_REQUEST_TIMEOUT = 120
+
+# Retries of rejected (429) documents, backoff bounds (seconds)
+BULK_MAX_RETRIES = 8
+BULK_INITIAL_BACKOFF = 0.5
+BULK_MAX_BACKOFF = 60
+
+# Bulk requests sent at once to a node
+BULK_MAX_IN_FLIGHT = 2
+
+# Time a node is skipped after a connection failure (seconds)
+DEAD_HOST_SECONDS = 30
+
+_HOST_POOLS = {}
+_HOST_POOLS_LOCK = threading.Lock()
+
+# Documents indexed by the current thread (per job counts of the batch)
+_THREAD_TALLY = threading.local()
+
+
+class ChunkSizer(object):
+    """
+    Documents per bulk request: additive increase while requests are faster
+    than the target latency, halved when slow or rejected, bounded so that
+    a request stays under max_bytes (average document size observed)
+    """
+    def __init__(self, size=BULK_START_CHUNK_SIZE, min_size=BULK_MIN_CHUNK_SIZE,
+                 max_size=BULK_MAX_CHUNK_SIZE, target_seconds=BULK_TARGET_SECONDS,
+                 max_bytes=BULK_MAX_CHUNK_BYTES):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.document_bytes = None
+        self._lock = threading.Lock()
+
+    def observe(self, documents, size_bytes, seconds, rejected=False):
+        """
+        @goal: adapt the chunk size to a bulk response
+        @param documents: documents of the request
+        @param size_bytes: request body size
+        @param seconds: request latency
+        @param rejected: some documents were rejected (429)
+        """
+        if not documents:
+            return
+        with self._lock:
+            document_bytes = float(size_bytes) / documents
+            if self.document_bytes is None:
+                self.document_bytes = document_bytes
+            else:
+                self.document_bytes = 0.8 * self.document_bytes + 0.2 * document_bytes
+            if rejected or seconds > 2 * self.target_seconds:
+                size = self.size // 2
+            elif seconds < self.target_seconds and documents >= self.size:
+                size = self.size + max(self.min_size, self.size // 4)
+            else:
+                size = self.size
+            size = min(size, int(self.max_bytes / self.document_bytes))
+            self.size = max(self.min_size, min(self.max_size, size))
+        METRICS.histogram('bulk_chunk_size', SIZE_BUCKETS).observe(self.size)
+
+
+class HostPool(object):
+    """
+    One client per elasticsearch node, nodes used in turn, at most
+    max_in_flight requests per node, nodes failing to connect are skipped
+    for a while
+    """
+    def __init__(self, hosts, max_in_flight=BULK_MAX_IN_FLIGHT, sizer=None):
+        from elasticsearch import Elasticsearch
+
+        self.hosts = list(hosts)
+        self.clients = [Elasticsearch(hosts=[host]) for host in self.hosts]
+        self.slots = [threading.Semaphore(max_in_flight) for _ in self.hosts]
+        self.dead_until = [0] * len(self.hosts)
+        self.sizer = sizer or ChunkSizer()
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _order(self):
+        """ hosts in round-robin order, live ones first """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.hosts)
+        order = [(start + shift) % len(self.hosts) for shift in range(len(self.hosts))]
+        now = time.time()
+        return ([position for position in order if self.dead_until[position] <= now] +
+                [position for position in order if self.dead_until[position] > now])
+
+    def acquire(self):
+        """
+        @goal: next host with a free slot, waits for a slot if all are busy
+        @return host position
+        """
+        order = self._order()
+        for position in order:
+            if self.slots[position].acquire(False):
+                return position
+        self.slots[order[0]].acquire()
+        return order[0]
+
+    def release(self, position, failed=False):
+        if failed:
+            self.dead_until[position] = time.time() + DEAD_HOST_SECONDS
+        self.slots[position].release()
+
+
+def _host_key(host):
+    """ hashable form of an elasticsearch host (string or dictionary) """
+    if isinstance(host, dict):
+        return tuple(sorted(host.items()))
+    return host
+
+
+def get_host_pool(hosts):
+    """
+    @goal: host pool shared by the writers of a process, so in-flight
+           requests are capped per node across threads
+    @param hosts: elasticsearch hosts (strings or dictionaries)
+    @return HostPool
+    """
+    key = tuple(_host_key(host) for host in hosts)
+    with _HOST_POOLS_LOCK:
+        if key not in _HOST_POOLS:
+            _HOST_POOLS[key] = HostPool(hosts)
+        return _HOST_POOLS[key]
+
+
+def client_hosts(es_instance):
+    """
+    @return hosts of an elasticsearch client
+    """
+    return es_instance.transport.hosts
+
+
+def thread_indexed():
+    """
+    @return number of documents indexed by the current thread so far
+    """
+    return getattr(_THREAD_TALLY, 'indexed', 0)
+
+
+def backoff_delay(attempt, initial=BULK_INITIAL_BACKOFF, maximum=BULK_MAX_BACKOFF):
+    """
+    @goal: exponential backoff with full jitter
+    @param attempt: retry number, from 0
+    """
+    return random.uniform(0, min(maximum, initial * 2 ** attempt))
+
+
+class BulkWriter(object):
+    """
+    Write documents into an index by bulk requests sized by the host pool
+    sizer, rejected (429) documents and failed requests are retried
+    """
+    def __init__(self, host_pool, es_index, doc_type, max_retries=BULK_MAX_RETRIES,
+                 initial_backoff=BULK_INITIAL_BACKOFF, max_backoff=BULK_MAX_BACKOFF,
+                 request_timeout=BULK_REQUEST_TIMEOUT):
+        from elasticsearch.helpers import expand_action
+        from elasticsearch.serializer import JSONSerializer
+
+        self.host_pool = host_pool
+        self.es_index = es_index
+        self.doc_type = doc_type
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self._expand_action = expand_action
+        self._dumps = JSONSerializer().dumps
+        self.indexed = 0
+        self.not_indexed = []
+
+    def _lines(self, data):
+        """ action and source lines of a document """
+        action, source = self._expand_action(data)
+        return '%s\n%s\n' % (self._dumps(action), self._dumps(source))
+
+    def _chunks(self, documents):
+        """ (documents, lines) chunks, sized when each chunk starts """
+        sizer = self.host_pool.sizer
+        chunk, lines, size_bytes = [], [], 0
+        for data in documents:
+            line = self._lines(data)
+            if chunk and (len(chunk) >= sizer.size or
+                          size_bytes + len(line) > sizer.max_bytes):
+                yield chunk, lines
+                chunk, lines, size_bytes = [], [], 0
+            chunk.append(data)
+            lines.append(line)
+            size_bytes += len(line)
+        if chunk:
+            yield chunk, lines
+
+    def _send(self, body):
+        """
+        @goal: one bulk request on the next host with a free slot
+        @return response items
+        """
+        from elasticsearch.exceptions import ConnectionError
+
+        position = self.host_pool.acquire()
+        failed = False
+        try:
+            return self.host_pool.clients[position].bulk(body, index=self.es_index,
+                                                         doc_type=self.doc_type,
+                                                         request_timeout=self.request_timeout)['items']
+        except ConnectionError:
+            failed = True
+            raise
+        finally:
+            self.host_pool.release(position, failed)
+
+    def _reject(self, chunk, status, reason):
+        self.not_indexed.extend(chunk)
+        METRICS.counter('bulk_rejected_total', status=status).inc(len(chunk))
+        logger.debug('%d documents rejected (%s): %s', len(chunk), status, reason)
+
+    def write_chunk(self, chunk, lines):
+        """
+        @goal: index one chunk, rejected documents (429) and chunks of
+               failed requests (429, connection, timeout) are retried
+        """
+        from elasticsearch.exceptions import ConnectionError
+        from elasticsearch.exceptions import TransportError
+
+        sizer = self.host_pool.sizer
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(backoff_delay(attempt - 1, self.initial_backoff, self.max_backoff))
+                METRICS.counter('bulk_retried_total').inc(len(chunk))
+            body = ''.join(lines)
+            start = time.time()
+            try:
+                items = self._send(body)
+            except ConnectionError as exc:
+                error = ('connection', exc)
+                sizer.observe(len(chunk), len(body), time.time() - start, rejected=True)
+                continue
+            except TransportError as exc:
+                if exc.status_code != 429:
+                    self._reject(chunk, exc.status_code, exc)
+                    raise
+                error = (429, exc)
+                sizer.observe(len(chunk), len(body), time.time() - start, rejected=True)
+                continue
+            finally:
+                METRICS.histogram('bulk_documents', SIZE_BUCKETS).observe(len(chunk))
+                METRICS.histogram('bulk_seconds').observe(time.time() - start)
+
+            retry_chunk, retry_lines = [], []
+            indexed = self.indexed
+            for data, line, item in zip(chunk, lines, items):
+                status = item.values()[0].get('status', 500)
+                if 200 <= status < 300:
+                    self.indexed += 1
+                elif status == 429:
+                    retry_chunk.append(data)
+                    retry_lines.append(line)
+                else:
+                    self._reject([data], status, item)
+            _THREAD_TALLY.indexed = thread_indexed() + self.indexed - indexed
+            sizer.observe(len(chunk), len(body), time.time() - start,
+                          rejected=bool(retry_chunk))
+            if not retry_chunk:
+                return
+            chunk, lines = retry_chunk, retry_lines
+            error = (429, 'es_rejected_execution')
+        self._reject(chunk, error[0], error[1])
+
+    def write(self, documents):
+        """
+        @goal: index documents
+        @param documents: documents iterable (parser generator)
+        @return (error_code, not_indexed_data): error code False if one
+                document is not indexed
+        """
+        for chunk, lines in self._chunks(documents):
+            self.write_chunk(chunk, lines)
+        return not self.not_indexed, self.not_indexed
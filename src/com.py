@@ -5,18 +5,16 @@
 __copyright__ = "Copyright 2015, Parrot"
 
 # Generic imports
+import os
 import sys
-import requests
-from datetime import datetime
 
 # logging imports
 import logging
-from logging.handlers import RotatingFileHandler
 
-# fabric imports
-from fabric.colors import yellow
-from fabric.colors import blue
-from fabric.colors import white
+# Module imports
+from src.metrics import METRICS
+from src.metrics import stage
+from src.metrics import timed
 
 # Globals
 JENKINS_SERVER = 'https://komodo.parrot.biz:8080/'
@@ -36,30 +34,69 @@ FC60x0_CONFIGS = (('fc6000p', '256L_Generic_I2C'),
                   ('fc6050w',  'Demo'))
 
 
-# logger object creation
+# Log file, rotated when it reaches LOG_FILE_SIZE
+LOG_FILE = 'index.log'
+LOG_FILE_SIZE = 1000000
+
+# logger object creation, handlers are set by init_logging
 logger = logging.getLogger('index')
 logger.setLevel(logging.DEBUG)
-# Build formatter for each handler
-formatter_file = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s')
-formatter_console = logging.Formatter(yellow('[%(asctime)s]') + \
-                                      blue('[%(levelname)s]') + \
-                                      white(' %(message)s'))
+logger.addHandler(logging.NullHandler())
+_LOGGING_INITIALIZED = False
+
+
+def init_logging(log_file=LOG_FILE, color=None, console_level=logging.INFO):
+    """
+    @goal: set the logger handlers, called once by entry points (imports
+           have no side effect, parse workers do not open the log file)
+    @param log_file: rotating debug log file (no file if None)
+    @param color: colored console output (fabric), if stdout is a tty if None
+    @param console_level: console log level
+    """
+    from logging.handlers import RotatingFileHandler
+    global _LOGGING_INITIALIZED
 
-# Set handlers filesize is < 1Mo
-file_handler = RotatingFileHandler('index.log', 'a', 1000000, 1)
-stream_handler = logging.StreamHandler(stream=sys.stdout)
+    if _LOGGING_INITIALIZED:
+        return
+    _LOGGING_INITIALIZED = True
 
-# Set formatters
-file_handler.setFormatter(formatter_file)
-stream_handler.setFormatter(formatter_console)
+    if color is None:
+        color = sys.stdout.isatty()
+    formatter_console = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s')
+    if color:
+        try:
+            from fabric.colors import yellow
+            from fabric.colors import blue
+            from fabric.colors import white
+            formatter_console = logging.Formatter(yellow('[%(asctime)s]') + \
+                                                  blue('[%(levelname)s]') + \
+                                                  white(' %(message)s'))
+        except ImportError:
+            pass
 
-# Set level
-file_handler.setLevel(logging.DEBUG)
-stream_handler.setLevel(logging.INFO)
+    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    stream_handler.setFormatter(formatter_console)
+    stream_handler.setLevel(console_level)
+    logger.addHandler(stream_handler)
 
-# Add handlers to logger
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+    if log_file:
+        # Set handlers filesize is < 1Mo
+        file_handler = RotatingFileHandler(log_file, 'a', LOG_FILE_SIZE, 1)
+        file_handler.setFormatter(logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s'))
+        file_handler.setLevel(logging.DEBUG)
+        logger.addHandler(file_handler)
+
+# Size of the blocks read from trace files
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Downloads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+HTTP_POOL_SIZE = 10
+_SESSION = None
+
+# Max size of a tar member kept in memory when spooled
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
 
 #Exceptions
 
@@ -67,22 +104,20 @@ class UntarException(Exception):
     """Untar failed Exception"""
 
 
+class ExportException(Exception):
+    """Columnar export failed Exception"""
+
+
+class ManifestException(Exception):
+    """Invalid job manifest Exception"""
+
+
 #Decorators
 def timing(func):
     '''
-    timing decorator
+    timing decorator: call durations go to the function_seconds histogram
     '''
-    def wrapper(*args, **kwargs):
-        '''
-        func wrapper
-        '''
-        start = datetime.now()
-        func(*args, **kwargs)
-        stop = datetime.now()
-        logger.debug('Time execution %s, %s : %s sec',
-                     func.__name__, args, (stop - start).total_seconds())
-
-    return wrapper
+    return timed()(func)
 
 
 def decompressed_tgz(tgz_file, output_directory):
@@ -94,7 +129,7 @@ def decompressed_tgz(tgz_file, output_directory):
     """
     import tarfile
     untar_directory = None
-    with tarfile.open(tgz_file) as tgz_file:
+    with stage('untar_seconds'), tarfile.open(tgz_file) as tgz_file:
         tgz_info = tgz_file.getnames()
 
         if tgz_info:
@@ -108,14 +143,275 @@ def decompressed_tgz(tgz_file, output_directory):
     return untar_directory
 
 
-def download_tgz_file(url_tgz_traces, output_file_name):
+class TarMember(object):
+    """
+    Named file object read from a tar.gz stream
+    """
+    def __init__(self, name, file_c, size=None):
+        self.name = name
+        self.size = size
+        self._file = file_c
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def close(self):
+        return self._file.close()
+
+
+def iter_tgz_members(tgz_file):
+    """
+    @goal: stream regular files of a tar.gz file, decompressed once and
+           without writing on disk
+    @param tgz_file: tar.gz file
+    @return TarMember generator, each member is only readable until the
+            next one is requested
+    """
+    import tarfile
+    with tarfile.open(tgz_file, 'r|gz') as tgz_c:
+        for member in tgz_c:
+            if member.isfile():
+                yield TarMember(os.path.basename(member.name),
+                                tgz_c.extractfile(member))
+
+
+def spool_member(member, chunk_size=READ_CHUNK_SIZE):
+    """
+    @goal: keep a tar member readable after the stream moved on, in memory
+           up to SPOOL_MAX_SIZE then in a temporary file
+    @param member: TarMember
+    @return spooled TarMember, rewound, size set
+    """
+    import tempfile
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    for chunk in iter(lambda: member.read(chunk_size), ''):
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return TarMember(member.name, spool, size)
+
+
+def get_session():
+    """
+    @goal: shared http session, connections are kept alive and reused
+           between jenkins requests
+    @return session: requests.Session
+    """
+    import requests
+    global _SESSION
+
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        _SESSION.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                pool_maxsize=HTTP_POOL_SIZE)
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+def _load_download_meta(meta_file_name):
+    """
+    @goal: load validators (url, etag, last-modified) of a downloaded file
+    """
+    import json
+    try:
+        with open(meta_file_name) as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_download_meta(meta_file_name, meta):
+    """
+    @goal: save validators (url, etag, last-modified) of a downloaded file
+    """
+    import json
+    with open(meta_file_name, 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+def download_tgz_file(url_tgz_traces, output_file_name, session=None,
+                      chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES):
     '''
-    @goal: download tgz file
+    @goal: download tgz file, streamed to disk
+           - an unchanged file (same ETag/Last-Modified) is not downloaded again
+           - an interrupted download is resumed with a Range request
+           the cache is output_file_name and its .meta file: it only works
+           if they are kept between calls (persistent work directory)
     @param url_tgz_traces: tar.gz file url
     @param output_file_name: local filename where to save file
+    @param session: requests session (shared session if None)
+    @param chunk_size: number of bytes written at once
+    @param retries: number of resumes after a connection failure
+    @return downloaded: False if local file was up to date
     '''
+    import requests
+
+    session = session or get_session()
+    meta_file_name = output_file_name + '.meta'
+    part_file_name = output_file_name + '.part'
+    meta = _load_download_meta(meta_file_name)
+    if meta.get('url') != url_tgz_traces:
+        meta = {'url': url_tgz_traces}
+        if os.path.isfile(part_file_name):
+            os.remove(part_file_name)
+
+    headers = {}
+    if meta.get('complete') and os.path.isfile(output_file_name):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    for attempt in range(retries + 1):
+        request_headers = dict(headers)
+        offset = 0
+        if not meta.get('complete') and os.path.isfile(part_file_name):
+            offset = os.path.getsize(part_file_name)
+        if offset:
+            request_headers['Range'] = 'bytes=%d-' % offset
+            validator = meta.get('etag') or meta.get('last_modified')
+            if validator:
+                request_headers['If-Range'] = validator
+
+        try:
+            response = session.get(url_tgz_traces, headers=request_headers, stream=True)
+            try:
+                if response.status_code == 304:
+                    logger.info("%s up to date", output_file_name)
+                    return False
+                if response.status_code == 416 and offset:
+                    # Nothing left after offset: part file complete (not
+                    # renamed yet) if the sizes match, otherwise start again
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    if total == str(offset):
+                        break
+                    response.close()
+                    response = session.get(url_tgz_traces, headers=headers, stream=True)
+                response.raise_for_status()
+
+                if response.status_code != 206:
+                    # Full content, start again from scratch
+                    offset = 0
+                meta.update({'etag': response.headers.get('ETag'),
+                             'last_modified': response.headers.get('Last-Modified'),
+                             'complete': False})
+                _save_download_meta(meta_file_name, meta)
+
+                downloaded = METRICS.counter('download_bytes_total')
+                with stage('download_seconds'), \
+                        open(part_file_name, 'ab' if offset else 'wb') as output_file:
+                    for chunk in response.iter_content(chunk_size):
+                        output_file.write(chunk)
+                        downloaded.inc(len(chunk))
+            finally:
+                response.close()
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as exc:
+            if attempt == retries:
+                raise
+            logger.warning("%s download interrupted (%s), resuming", url_tgz_traces, exc)
+            headers = {}
+
+    os.rename(part_file_name, output_file_name)
+    meta['complete'] = True
+    _save_download_meta(meta_file_name, meta)
+    logger.info("%s downloaded", output_file_name)
+    return True
 
-    response = requests.get(url_tgz_traces, verify=False)
-    with open(output_file_name, 'wb') as output_file:
-        output_file.write(response.content)
 
+def read_lines(file_path, chunk_size=READ_CHUNK_SIZE, offset=0):
+    """
+    @goal: stream lines of a trace file by chunks, bounded memory
+    @param file_path: trace file path, or file object (tar member, ...)
+    @param chunk_size: number of bytes read at once
+    @param offset: byte offset where to start reading, from the start of
+                   the file (file objects must support seek)
+    @return line generator, '\n' stripped
+    """
+    if hasattr(file_path, 'read'):
+        if offset:
+            if not hasattr(file_path, 'seek'):
+                raise ValueError('offset %d on a file object without seek' % offset)
+            file_path.seek(offset)
+        for line in _read_chunked_lines(file_path, chunk_size):
+            yield line
+        return
+
+    with open(file_path, 'rb') as file_c:
+        if offset:
+            file_c.seek(offset)
+        for line in _read_chunked_lines(file_c, chunk_size):
+            yield line
+
+
+def _read_chunked_lines(file_c, chunk_size):
+    """
+    @goal: split file object content into lines, chunk by chunk
+    """
+    # Pieces of the line spanning chunks, joined once complete (a long
+    # line is not copied again for each chunk)
+    pending = []
+    for chunk in iter(lambda: file_c.read(chunk_size), ''):
+        if '\n' not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split('\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = ''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            yield line
+    pending = ''.join(pending)
+    if pending:
+        yield pending
+
+
+def file_digest(file_path, length=None, chunk_size=READ_CHUNK_SIZE):
+    """
+    @goal: sha1 of a file content
+    @param file_path: file path
+    @param length: only hash the first length bytes (whole file if None)
+    @return hexadecimal digest
+    """
+    import hashlib
+
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file_c:
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = file_c.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def last_line_end(file_path, chunk_size=READ_CHUNK_SIZE):
+    """
+    @goal: offset after the last end of line of a file, read backwards:
+           a partial last line (still written) is left out
+    @param file_path: file path
+    @return byte offset, 0 if the file has no complete line
+    """
+    with open(file_path, 'rb') as file_c:
+        file_c.seek(0, os.SEEK_END)
+        end = file_c.tell()
+        while end > 0:
+            start = max(0, end - chunk_size)
+            file_c.seek(start)
+            position = file_c.read(end - start).rfind('\n')
+            if position >= 0:
+                return start + position + 1
+            end = start
+    return 0
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Export parsed traces to columnar files (Parquet, Arrow IPC) """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import itertools
+
+# Module imports
+import src.parser as parser
+from src.com import logger
+from src.com import ExportException
+
+# Exported fields, in column order
+EXPORT_COLUMNS = ('timestamp', 'severity', 'library', 'ATCommand', 'ATEvent',
+                  'test', 'module', 'version', 'text')
+
+# Low cardinality fields, dictionary encoded
+DICTIONARY_COLUMNS = ('severity', 'library', 'ATCommand', 'ATEvent',
+                      'test', 'module', 'version')
+
+# Number of rows buffered before a row group (record batch) is written
+ROW_GROUP_SIZE = 64 * 1024
+
+EXPORT_FORMATS = ('parquet', 'arrow')
+
+
+def _import_pyarrow():
+    """
+    @goal: pyarrow is only required by the columnar export
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportException("pyarrow is required for columnar export")
+    return pyarrow
+
+
+def get_ckcm_timestamp(text):
+    """
+    @goal: ckcm frames start with their timestamp: '[timestamp]...'
+    @return timestamp or None
+    """
+    if text and text.startswith('['):
+        end = text.find(']')
+        if end > 0:
+            return text[1:end]
+    return None
+
+
+def document_row(data):
+    """
+    @goal: document dictionary to a row of EXPORT_COLUMNS, 'None' strings
+           written by the parsers become nulls
+    @return row values
+    """
+    row = [data.get(column) for column in EXPORT_COLUMNS]
+    row = [None if value == u'None' else value for value in row]
+    if row[0] is None:
+        row[0] = get_ckcm_timestamp(data.get('text'))
+    return row
+
+
+class ColumnarWriter(object):
+    """
+    Write rows by row groups to a Parquet or Arrow IPC file
+    """
+    def __init__(self, output_path, file_format='parquet', row_group_size=ROW_GROUP_SIZE):
+        if file_format not in EXPORT_FORMATS:
+            raise ExportException("Unknown export format: %s" % file_format)
+        self.pyarrow = _import_pyarrow()
+        self.output_path = output_path
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._columns = [[] for _ in EXPORT_COLUMNS]
+        self._writer = None
+        self._sink = None
+
+    def write(self, row):
+        """
+        @goal: buffer one row, flush a row group when full
+        """
+        for values, value in zip(self._columns, row):
+            values.append(value)
+        if len(self._columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        @goal: write buffered rows as one row group
+        """
+        if not self._columns[0]:
+            return
+        pyarrow = self.pyarrow
+        arrays = []
+        for column, values in zip(EXPORT_COLUMNS, self._columns):
+            array = pyarrow.array(values, type=pyarrow.string())
+            if column in DICTIONARY_COLUMNS:
+                array = array.dictionary_encode()
+            arrays.append(array)
+        batch = pyarrow.RecordBatch.from_arrays(arrays, list(EXPORT_COLUMNS))
+
+        if self._writer is None:
+            if self.file_format == 'parquet':
+                self._writer = pyarrow.parquet.ParquetWriter(self.output_path, batch.schema,
+                                                             use_dictionary=True)
+            else:
+                self._sink = pyarrow.OSFile(self.output_path, 'wb')
+                self._writer = pyarrow.RecordBatchFileWriter(self._sink, batch.schema)
+
+        if self.file_format == 'parquet':
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self.rows += len(self._columns[0])
+        self._columns = [[] for _ in EXPORT_COLUMNS]
+
+    def close(self):
+        """
+        @goal: flush last row group and close file
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_documents(documents, output_path, file_format='parquet',
+                     row_group_size=ROW_GROUP_SIZE):
+    """
+    @goal: export parser documents to a columnar file, row group by row group
+    @param documents: document dictionaries (parser generator)
+    @param output_path: output file
+    @param file_format: 'parquet' or 'arrow' (Arrow IPC file)
+    @param row_group_size: number of rows per row group
+    @return rows: number of exported rows
+    """
+    with ColumnarWriter(output_path, file_format, row_group_size) as writer:
+        for data in documents:
+            writer.write(document_row(data))
+    logger.info("%d rows exported to %s", writer.rows, output_path)
+    return writer.rows
+
+
+def export_files(log_file_paths, output_path, log_type, version=None, module=None,
+                 pytestemb_version=None, file_format='parquet',
+                 row_group_size=ROW_GROUP_SIZE):
+    """
+    @goal: parse log files and export them to one columnar file
+    @param log_file_paths: log files paths
+    @param output_path: output file
+    @param log_type: ckcm or octopylog
+    @param version: package version
+    @param module: fc60x0 module
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @return rows: number of exported rows
+    """
+    parser_c = parser.get_parser(log_type, pytestemb_version)
+    documents = itertools.chain.from_iterable(
+        parser_c.parse(log_file_path, version=version, module=module)
+        for log_file_path in log_file_paths)
+    return export_documents(documents, output_path, file_format, row_group_size)
+
+
+def export_directory(directory, output_path, log_type, version=None, module=None,
+                     pytestemb_version=None, file_format='parquet',
+                     row_group_size=ROW_GROUP_SIZE):
+    """
+    @goal: parse every log file of an untarred directory into one columnar file
+    @return rows: number of exported rows
+    """
+    log_file_paths = [os.path.join(directory, file_c)
+                      for file_c in sorted(os.listdir(directory))]
+    return export_files(log_file_paths, output_path, log_type, version=version,
+                        module=module, pytestemb_version=pytestemb_version,
+                        file_format=file_format, row_group_size=row_group_size)
@@ -4,20 +4,155 @@
 # Generic imports
 import os
 import re
+import time
+from functools import partial
+from collections import namedtuple
+from threading import Lock
 from contextlib import contextmanager
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
-from elasticsearch.exceptions import RequestError
-from elasticsearch.helpers import bulk
 
 # Module imports
 import src.jenkins as jenkins
 import src.parser as parser
+from src.bulk import BulkWriter
+from src.bulk import client_hosts
+from src.bulk import get_host_pool
 from src.com import timing
 from src.com import decompressed_tgz as decompressed_tgz
 from src.com import logger
 from src.com import UntarException
 from src.com import FC60x0_CONFIGS
+from src.com import file_digest
+from src.com import last_line_end
+from src.com import iter_tgz_members
+from src.com import read_lines
+from src.com import spool_member
+from src.com import init_logging
+from src.metrics import METRICS
+from src.metrics import count_parsed
+from src.metrics import record_parsed
+from src.profiling import dump_profiles
+from src.profiling import profile_iter
+from src.profiling import profile_label
+from src.profiling import profile_stage
+from src.rollup import Rollup
+from src.rollup import save_rollup
+from src.templates import get_template_miner
+from src.templates import save_template_miner
+
+# Elasticsearch host
+ES_HOST = "172.20.22.104"
+
+# Elasticsearch nodes, used in turn (comma separated in PARSELOG_ES_HOSTS)
+ES_HOSTS = os.environ.get('PARSELOG_ES_HOSTS', ES_HOST).split(',')
+
+# Parsers yield json serialized documents to the bulk helpers
+SERIALIZE_DOCUMENTS = True
+
+# MySQL tables high-water marks (incremental sync)
+MYSQL_STATE_FILE = 'mysql_sync.json'
+_SYNC_STATE_LOCK = Lock()
+
+# MySQL statistics database
+MYSQL_HOST = "172.20.38.50"
+MYSQL_USER = "parrotsa"
+MYSQL_PASSWORD = "parrotsa"
+MYSQL_DATABASE = "sandbox"
+
+# Mappings of trace documents: exact values are keywords, only the
+# trace text is analyzed
+INDEX_MAPPINGS = {
+    'dynamic_templates': [{'strings': {'match_mapping_type': 'string',
+                                       'mapping': {'type': 'keyword'}}}],
+    'properties': {
+        'text': {'type': 'text'},
+        'severity': {'type': 'keyword'},
+        'library': {'type': 'keyword'},
+        'module': {'type': 'keyword'},
+        'version': {'type': 'keyword'},
+        'test': {'type': 'keyword'},
+        'author': {'type': 'keyword'},
+        'ATCommand': {'type': 'keyword'},
+        'ATEvent': {'type': 'keyword'},
+        'build': {'type': 'keyword'},
+        'config': {'type': 'keyword'},
+        'template_id': {'type': 'keyword'},
+        'params': {'type': 'keyword'},
+        'repeat': {'type': 'integer'},
+        'index_time': {'type': 'date'},
+        # octopylog time of day, kept as sent if not a date
+        'timestamp': {'type': 'date', 'ignore_malformed': True,
+                      'format': 'HH:mm:ss.SSS||HH:mm:ss,SSS||HH:mm:ss||strict_date_optional_time'},
+    }
+}
+
+# Index settings during a bulk load: no refresh, no replica, translog
+# fsynced in the background
+BULK_LOAD_SETTINGS = {'index': {'refresh_interval': '-1',
+                                'number_of_replicas': 0,
+                                'translog.durability': 'async'}}
+
+# Index settings restored once loaded
+PRODUCTION_SETTINGS = {'index': {'refresh_interval': '1s',
+                                 'number_of_replicas': 1,
+                                 'translog.durability': 'request'}}
+
+# Segments per shard after the load, force-merge timeout (seconds)
+FORCE_MERGE_SEGMENTS = 1
+FORCE_MERGE_TIMEOUT = 3600
+
+# Index layout: one index per build ('build') or time/size rolled indices
+# behind aliases ('rolling')
+INDEX_LAYOUTS = ('build', 'rolling')
+INDEX_LAYOUT = os.environ.get('PARSELOG_INDEX_LAYOUT', 'build')
+
+# Rolling layout names: <log_type>-traces read alias (all indices),
+# <log_type>-traces-write write alias (current index), <log_type>-traces-000001...
+ROLLING_ALIAS = '{0}-traces'
+ROLLING_SHARDS = 2
+
+# Current index rolled over once one condition is met
+ROLLOVER_CONDITIONS = {'max_age': '7d', 'max_docs': 50000000}
+
+# Rolled indices dropped when older than RETENTION_DAYS, or beyond the
+# RETENTION_INDICES newest ones (no limit if None)
+RETENTION_DAYS = 90
+RETENTION_INDICES = None
+
+# Message templates mined while indexing (template_id, params fields,
+# consecutive repeats collapsed), see src/templates.py
+TEMPLATE_MINING = os.environ.get('PARSELOG_TEMPLATES', '0') == '1'
+
+# Rollup documents (counts per test, severity, library...) of every build,
+# one index per log type
+ROLLUP_INDEX = '{0}-rollups'
+ROLLUP_DOC_TYPE = 'rollup'
+ROLLUP_MAPPINGS = {
+    'dynamic_templates': INDEX_MAPPINGS['dynamic_templates'],
+    'properties': {
+        'count': {'type': 'long'},
+        'lines': {'type': 'long'},
+        'errors': {'type': 'long'},
+        'index_time': {'type': 'date'},
+    }
+}
+
+# Documents sent at once by a parsing process, batches waiting to be
+# indexed per call (memory bound of parallel parsing)
+PARSE_BATCH_SIZE = 2000
+PARSE_QUEUE_SIZE = 8
+
+# Read size when checking a cached version line
+VERSION_LINE_SIZE = 4096
+
+# Stream mode: tar.gz bytes spooled at most while looking for versions,
+# the archive is untarred instead beyond it
+STREAM_SCAN_MAX_SIZE = 256 * 1024 * 1024
+
+# Per index manifests of indexed files (incremental indexing)
+MANIFEST_DIRECTORY = 'manifests'
+
+# Per build versions caches, kept between runs (untarred builds are not)
+VERSION_CACHE_DIRECTORY = 'versions'
 
 
 @timing
@@ -26,6 +161,9 @@ def delete_data(index_del):
     @goal: delete index from into elasticsearch database
     @return delete_error_code: error code deletion
     """
+    from elasticsearch import Elasticsearch
+    from elasticsearch.exceptions import NotFoundError
+
     delete_error_code = None
     es_c = Elasticsearch()
 
@@ -38,246 +176,1401 @@ def delete_data(index_del):
     return delete_error_code
 
 
-@timing
-def index_file(es_instance, log_file_path, es_index, log_type, version=None, module=None,
+def get_log_parser(log_type, pytestemb_version=None, serialize=SERIALIZE_DOCUMENTS):
+    """
+    @goal: build the parser matching a log type
+    @param log_type: ckcm or octopylog
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @param serialize: parser yields json documents, ready for bulk requests
+    @return parser_c: parser instance
+    """
+    return parser.get_parser(log_type, pytestemb_version, serialize=serialize)
+
+
+def parse_file(task):
+    """
+    @goal: parse one log file, run in a worker process, documents are sent
+           by batches of PARSE_BATCH_SIZE to the queue (waits while the
+           indexing process is late)
+    @param task: (log_file_path, log_type, version, module, pytestemb_version, offset,
+                  fields, serialize, id_prefix, build_index, queue), build_index
+                  labels the profile of the file
+    Queue items: (log_file_path, documents, None), then for the last batch
+    (log_file_path, documents, (error, count, seconds, serialize_seconds, rollup)):
+    error is None on success, seconds spent parsing and serializing documents
+    (metrics of worker processes are not shared), Rollup of the file
+    """
+    (log_file_path, log_type, version, module, pytestemb_version, offset, fields,
+     serialize, id_prefix, build_index, queue) = task
+    start = time.time()
+    waiting = 0.0
+    count = 0
+    error = None
+    rollup = Rollup()
+    documents = []
+    parser_c = None
+    try:
+        parser_c = get_log_parser(log_type, pytestemb_version, serialize=serialize)
+        with profile_stage('parse', profile_label(build_index, log_file_path)):
+            for data in parser_c.parse(log_file_path, version=version, module=module,
+                                       offset=offset, rollup=rollup, id_prefix=id_prefix,
+                                       **fields):
+                documents.append(data)
+                if len(documents) >= PARSE_BATCH_SIZE:
+                    count += len(documents)
+                    put_start = time.time()
+                    queue.put((log_file_path, documents, None))
+                    waiting += time.time() - put_start
+                    documents = []
+    except Exception as exc:
+        error = '%s: %s' % (type(exc).__name__, exc)
+    count += len(documents)
+    serialize_seconds = parser_c.serialize_seconds if parser_c is not None else 0.0
+    queue.put((log_file_path, documents,
+               (error, count, time.time() - start - waiting - serialize_seconds,
+                serialize_seconds, rollup)))
+
+
+def bulk_index(es_instance, documents, es_index, log_type, log_file_path=None,
                pytestemb_version=None):
     """
-    @goal: index log file into elastic search database
+    @goal: stream documents into elastic search database by adaptive chunks,
+           spread over the client nodes (see src/bulk.py)
     @param es_instance: ElasticSearch instance
-    @param log_file_path: path to file traces directory
+    @param documents: documents iterable (parser generator)
     @param es_index: ElasticSearch index
-    @param version: field version in elastic search  (optional)
+    @param log_type: document type
     @return error_code: boolean, False if one line is not indexed
     @not_indexed_data: list of all data not indexed
     """
-    error_code = True
-    not_indexed_data = []
-
-    if log_type == 'ckcm':
-        parser_c = parser.CkcmParser()
-    elif log_type == 'octopylog':
-        parser_c = parser.OctopylogParser(pytestemb_version)
-
-    # Parse log file and format data to export
-    parsed_trace = parser_c.parse(log_file_path, version=version, module=module)
+    from elasticsearch.exceptions import RequestError
 
+    writer = BulkWriter(get_host_pool(client_hosts(es_instance)), es_index, log_type)
     try:
-        bulk_data = [data for data in parsed_trace]
-        #TODO probleme d'update
-        bulk(es_instance, actions=bulk_data, index=es_index, doc_type=log_type, request_timeout=30)
+        with profile_stage('bulk'):
+            writer.write(documents)
     except IndexError:
         logger.error("%s\npytestemb version:%s\nindex:%s",
                      log_file_path, pytestemb_version, es_index)
     except RequestError as exc:
-        error_code = False
-        not_indexed_data.append(data)
         logger.error('%s bad index format', es_index)
         logger.error(exc)
 
-    return error_code, not_indexed_data
+    # Labelled by document type: index names (one per build) are unbounded
+    METRICS.counter('indexed_documents_total', log_type=log_type).inc(writer.indexed)
+    if writer.not_indexed:
+        logger.error('%s: %d documents not indexed in %s',
+                     log_file_path, len(writer.not_indexed), es_index)
 
+    return not writer.not_indexed, writer.not_indexed
 
-def index_module(module_type, config, job_number='lastSuccessfulBuild',
-                 log_type='ckcm', url=None):
+
+@timing
+def index_file(es_instance, log_file_path, es_index, log_type, version=None, module=None,
+               pytestemb_version=None, offset=None, fields=None, rollup=None,
+               mine_templates=None, id_prefix=None):
     """
-    @goal: index module ckcm traces
+    @goal: index log file into elastic search database
+    @param es_instance: ElasticSearch instance
+    @param log_file_path: path to file traces directory
+    @param es_index: ElasticSearch index
+    @param version: field version in elastic search  (optional)
+    @param offset: byte offset where to start, deterministic ids if set (optional)
+    @param fields: other fields of every document, build and config (optional)
+    @param rollup: Rollup counting the parsed lines (optional)
+    @param mine_templates: function setting the template fields of the
+                           parsed documents, see template_mining (optional)
+    @param id_prefix: prefix of deterministic ids (build in a shared index)
+    @return error_code: boolean, False if one line is not indexed
+    @not_indexed_data: list of all data not indexed
+    """
+    # Templates are mined from document dictionaries
+    parser_c = get_log_parser(log_type, pytestemb_version,
+                              serialize=SERIALIZE_DOCUMENTS and mine_templates is None)
+
+    # Parse log file and format data to export
+    parsed_trace = parser_c.parse(log_file_path, version=version, module=module,
+                                  offset=offset, rollup=rollup, id_prefix=id_prefix,
+                                  **(fields or {}))
+    # Parsing is profiled apart from the bulk requests consuming it, json
+    # serialization included (DocumentBuilder.build in the profile, timed
+    # apart in the metrics)
+    parsed_trace = profile_iter(parsed_trace, 'parse',
+                                profile_label(id_prefix or es_index, log_file_path))
+    parsed_trace = count_parsed(parsed_trace, parser_c.type, parser_c)
+    if mine_templates is not None:
+        parsed_trace = profile_iter(mine_templates(parsed_trace), 'templates')
+
+    return bulk_index(es_instance, parsed_trace, es_index, log_type,
+                      log_file_path=log_file_path, pytestemb_version=pytestemb_version)
+
+
+# Traces of a jenkins job, ready to be indexed, fields: build and config
+# fields of its documents
+ModuleTraces = namedtuple('ModuleTraces', ['es_index', 'directory_c', 'members',
+                                           'package_version', 'pytestemb_version',
+                                           'fields'])
+
+
+def prepare_module(module_type, config, job_number='lastSuccessfulBuild',
+                   log_type='ckcm', url=None, work_directory='/tmp', stream=False):
+    """
+    @goal: download module traces, untar them and detect versions
     @param module_type : fc60x0 module
     @param config: fc60x0 config
     @param job_number: jenkins job number
     @param log_type: ckcm or octopylog
+    @param work_directory: directory for tar.gz file and untarred traces
+    @param stream: do not untar, members are read from the tar.gz stream
+    @return traces: ModuleTraces, None if untar failed
     """
-    import glob
-
-    err_list = []
-    print module_type
     # Create jenkins job object
-    jenkins_job = jenkins.JenkinsJob(config_hw=module_type,
-                                     config_sw=config,
-                                     job_number=job_number,
-                                     log_type=log_type,
-                                     url_results=url)
+    with profile_stage('download'):
+        jenkins_job = jenkins.JenkinsJob(config_hw=module_type,
+                                         config_sw=config,
+                                         job_number=job_number,
+                                         log_type=log_type,
+                                         url_results=url,
+                                         work_directory=work_directory)
 
     logger.info("Jenkins job: %s", jenkins_job.get_url())
 
-    # Decompressed ckcm.tgz into /tmp/
+    # Decompressed ckcm.tgz into work directory
     if log_type == 'ckcm':
         tgz_file = jenkins_job.ckcm_tgz_file_name
     elif log_type == 'octopylog':
         tgz_file = jenkins_job.octopylog_tgz_file_name
 
-    try:
-        directory_c = decompressed_tgz(tgz_file, '/tmp')
-        logger.info("current_directory: %s", directory_c)
-    except UntarException as msg:
-        logger.error(msg)
-        return
+    return prepare_tgz(tgz_file, module_type, config, jenkins_job.build_number,
+                       log_type=log_type, work_directory=work_directory, stream=stream)
 
-    # Get pytestemb version
-    pytestemb_version = None
-    if log_type == 'octopylog':
-        pytestemb_version = get_pytestemb_version(directory_c)
 
-    package_version = get_package_version(directory_c)
+def prepare_tgz(tgz_file, module_type, config, build_number, log_type='ckcm',
+                work_directory='/tmp', stream=False):
+    """
+    @goal: untar module traces and detect versions
+    @param tgz_file: local tar.gz file of traces
+    @param module_type : fc60x0 module
+    @param config: fc60x0 config
+    @param build_number: jenkins build number (part of the index name)
+    @param log_type: ckcm or octopylog
+    @param work_directory: directory for untarred traces
+    @param stream: do not untar, members are read from the tar.gz stream
+    @return traces: ModuleTraces, None if untar failed
+    """
+    directory_c = None
+    members = None
+    if stream:
+        members = iter_tgz_members(tgz_file)
+        with profile_stage('versions'):
+            spooled, package_version, pytestemb_version = scan_stream_versions(members,
+                                                                               log_type)
+        if package_version is None:
+            # Versions not found early in the stream: untar and search the files
+            for member in spooled:
+                member.close()
+            members.close()
+            members = None
+            stream = False
+            logger.warning("streaming: no version in the first %d bytes of %s, untarring",
+                           STREAM_SCAN_MAX_SIZE, tgz_file)
+        else:
+            members = stream_members(spooled, members)
+            logger.info("streaming: %s", tgz_file)
+    if not stream:
+        try:
+            with profile_stage('untar'):
+                directory_c = decompressed_tgz(tgz_file, work_directory)
+            logger.info("current_directory: %s", directory_c)
+        except UntarException as msg:
+            logger.error(msg)
+            return None
+
+        with profile_stage('versions'):
+            # Cached per build: the directory is a new temporary one each run
+            cache_key = '{0}_{1}_{2}_{3}'.format(log_type, module_type, config,
+                                                 build_number).lower()
+            # Get pytestemb version
+            pytestemb_version = None
+            if log_type == 'octopylog':
+                pytestemb_version = get_pytestemb_version(directory_c, cache_key)
+
+            package_version = get_package_version(directory_c, cache_key)
 
     # Build elastic search index
     es_index_current = "{0}_{1}_{2}_{3}_{4}".format(log_type, package_version.lower(),
-                                                    module_type.lower(), config.lower(), jenkins_job.build_number)
+                                                    module_type.lower(), config.lower(), build_number)
 
-    # Index each line from log file traces
     logger.info("Version : %s, Package: %s, Config: %s",
                 package_version, module_type, config)
 
+    return ModuleTraces(es_index_current, directory_c, members,
+                        package_version, pytestemb_version,
+                        {'build': str(build_number), 'config': config})
 
-    with elastic_search(hosts="172.20.22.104") as es_c:
-        # Create elastic search instance
-        try:
-            es_c.indices.delete(es_index_current)
-        except NotFoundError:
-            logger.info("Current index: {0}".format(es_index_current))
-        es_c.indices.create(es_index_current)
-        for file_c in os.listdir(directory_c):
-            logger.info("    Parsing... %s", file_c)
-            logger.info("Current index: {0}".format(es_index_current))
+
+def clean_work_directory(work_directory, traces, temporary):
+    """
+    @goal: remove job files, other jobs files are left untouched
+    @param work_directory: job work directory
+    @param traces: ModuleTraces of the job (or None)
+    @param temporary: True if work directory was created for the job,
+                      otherwise downloaded tar.gz are kept as cache
+    """
+    import shutil
+
+    if temporary:
+        logger.info("Cleaning: delete directory {0}".format(work_directory))
+        shutil.rmtree(work_directory, ignore_errors=True)
+    elif traces and traces.directory_c:
+        logger.info("Cleaning: delete directory {0}".format(traces.directory_c))
+        shutil.rmtree(traces.directory_c, ignore_errors=True)
+
+
+def index_module(module_type, config, job_number='lastSuccessfulBuild',
+                 log_type='ckcm', url=None, workers=1, incremental=False,
+                 stream=False, work_directory=None, metrics_file=None, layout=None,
+                 rollup_file=None, templates=None):
+    """
+    @goal: index module ckcm traces
+    @param module_type : fc60x0 module
+    @param config: fc60x0 config
+    @param job_number: jenkins job number
+    @param log_type: ckcm or octopylog
+    @param workers: number of parsing processes, files parsed in parallel if > 1
+    @param incremental: keep the index and only index new or grown files,
+                        according to the index manifest
+    @param stream: parse tar.gz members while decompressing, nothing is
+                   extracted (files parsed in process, no manifest)
+    @param work_directory: directory kept between runs for downloads (cache),
+                           a temporary directory removed at the end if None:
+                           the tar.gz is then downloaded on every run
+    @param metrics_file: pipeline metrics written at the end, prometheus
+                         text if it ends with .prom, json otherwise
+    @param layout: 'build' (one index per build) or 'rolling' (rolled
+                   indices behind aliases), INDEX_LAYOUT if None
+    @param rollup_file: rollup statistics of the build also written to this
+                        json file (see src/rollup.py)
+    @param templates: mine message templates (see src/templates.py),
+                      TEMPLATE_MINING if None
+    Stages are profiled when PARSELOG_PROFILE is set (see src/profiling.py)
+    """
+    import tempfile
+
+    logger.debug("index_module: %s %s", module_type, config)
+    # Metrics of this run only (same process, former runs)
+    METRICS.reset()
+    temporary = work_directory is None
+    if temporary:
+        work_directory = tempfile.mkdtemp(prefix='parselog-')
+    if stream and (workers > 1 or incremental):
+        logger.warning("Stream mode: workers and incremental options ignored")
+
+    traces = None
+    try:
+        traces = prepare_module(module_type, config, job_number=job_number,
+                                log_type=log_type, url=url,
+                                work_directory=work_directory, stream=stream)
+        if traces is None:
+            return
+
+        # Index each line from log file traces
+        if stream:
+            layout = layout or INDEX_LAYOUT
+            with elastic_search(hosts=ES_HOSTS) as es_c:
+                target = prepare_target_index(es_c, traces.es_index, log_type, layout,
+                                              fields=dict(traces.fields,
+                                                          module=module_type.lower()))
+                rollup = Rollup()
+                mine_templates = template_mining(log_type, traces.es_index, templates)
+                with bulk_load(es_c, target, layout == 'build'):
+                    results = index_members(es_c, traces.members, target, log_type,
+                                            traces.package_version, module_type.lower(),
+                                            traces.pytestemb_version, traces.fields, rollup,
+                                            mine_templates)
+                if mine_templates is not None:
+                    save_templates(log_type, traces.es_index)
+                index_rollup(es_c, rollup, traces.es_index, log_type,
+                             dict(traces.fields, module=module_type.lower(),
+                                  version=traces.package_version))
+                finish_target_index(es_c, log_type, layout)
+            if rollup_file:
+                save_rollup(rollup, rollup_file)
+        else:
+            results = index_directory(traces.directory_c, traces.es_index, log_type,
+                                      traces.package_version, module_type.lower(),
+                                      traces.pytestemb_version, workers, incremental,
+                                      layout=layout, fields=traces.fields,
+                                      rollup_file=rollup_file, templates=templates)
+    finally:
+        clean_work_directory(work_directory, traces, temporary)
+        report_metrics(metrics_file)
+        dump_profiles()
+
+    err_list = [error_code for _, error_code in results]
+    return all(err_list)
+
+
+def index_configs(configs=FC60x0_CONFIGS, job_number='lastSuccessfulBuild',
+                  log_type='ckcm', download_workers=4, parse_workers=None,
+                  index_workers=2, work_directory=None, metrics_file=None, layout=None,
+                  templates=None):
+    """
+    @goal: index several configs as a pipeline
+           - download, untar and version detection in download_workers threads
+           - parsing in one shared pool of parse_workers processes
+           - bulk indexing in index_workers threads
+           at most index_workers jobs wait between download and indexing
+    @param configs: (module_type, config) pairs
+    @param job_number: jenkins job number
+    @param log_type: ckcm or octopylog
+    @param download_workers: number of concurrent downloads
+    @param parse_workers: number of parsing processes (cpu count if None)
+    @param index_workers: number of jobs indexed at once
+    @param work_directory: parent of per job work directories (tempdir if None),
+                           job directories are removed at the end: no
+                           download cache
+    @param metrics_file: pipeline metrics file, see index_module
+    @param layout: index layout, see index_module
+    @param templates: mine message templates, see index_module
+    @return results: {(module_type, config): True if job fully indexed}
+    """
+    import multiprocessing
+    import tempfile
+    import threading
+    import Queue
+
+    configs_queue = Queue.Queue()
+    for config_fc in configs:
+        configs_queue.put(config_fc)
+    # Bounded: downloads wait when indexing is late (backpressure)
+    traces_queue = Queue.Queue(maxsize=index_workers)
+    results = {}
+    # Metrics of this run only (same process, former runs)
+    METRICS.reset()
+    pool = multiprocessing.Pool(parse_workers)
+
+    def download_stage():
+        """ prepare jobs until no config is left """
+        while True:
             try:
-                index_file(es_c, os.path.join(directory_c, file_c),
-                           es_index_current,
-                           log_type, version=package_version, module=module_type.lower(),
-                           pytestemb_version=pytestemb_version)
+                module_type, config = configs_queue.get_nowait()
+            except Queue.Empty:
+                return
+            job_directory = tempfile.mkdtemp(prefix='parselog-%s-%s-' % (module_type, config),
+                                             dir=work_directory)
+            traces = None
+            try:
+                traces = prepare_module(module_type, config, job_number=job_number,
+                                        log_type=log_type, work_directory=job_directory)
             except Exception as exc:
-                raise exc
+                logger.error("%s %s: download failed: %s", module_type, config, exc)
+            if traces is None:
+                results[(module_type, config)] = False
+                clean_work_directory(job_directory, traces, True)
+            else:
+                traces_queue.put((module_type, config, job_directory, traces))
+
+    def index_stage():
+        """ index prepared jobs until a stop marker is received """
+        while True:
+            job = traces_queue.get()
+            if job is None:
+                return
+            module_type, config, job_directory, traces = job
+            try:
+                job_results = index_directory(traces.directory_c, traces.es_index, log_type,
+                                              traces.package_version, module_type.lower(),
+                                              traces.pytestemb_version, pool=pool,
+                                              layout=layout, fields=traces.fields,
+                                              templates=templates)
+                results[(module_type, config)] = all(error_code for _, error_code in job_results)
+            except Exception as exc:
+                logger.error("%s %s: indexing failed: %s", module_type, config, exc)
+                results[(module_type, config)] = False
             finally:
-                #err_list.append(err)
-                logger.info("Removing {0}".format(os.path.join(directory_c, file_c)))
+                clean_work_directory(job_directory, traces, True)
+
+    downloaders = [threading.Thread(target=download_stage) for _ in range(download_workers)]
+    indexers = [threading.Thread(target=index_stage) for _ in range(index_workers)]
+    try:
+        for thread in downloaders + indexers:
+            thread.start()
+        for thread in downloaders:
+            thread.join()
+        for _ in indexers:
+            traces_queue.put(None)
+        for thread in indexers:
+            thread.join()
+    finally:
+        pool.close()
+        pool.join()
+        report_metrics(metrics_file)
+        dump_profiles()
+
+    return results
+
+
+def report_metrics(metrics_file=None):
+    """
+    @goal: log the pipeline metrics summary, export them to a file
+    @param metrics_file: .prom (prometheus text) or json file, optional
+    """
+    from src.metrics import export
+
+    for line in export(metrics_file):
+        logger.info("Metrics: %s", line)
+
+
+def create_index(es_c, es_index, log_type=None):
+    """
+    @goal: create an index ready for a bulk load
+    @param es_c: ElasticSearch instance
+    @param es_index: ElasticSearch index
+    @param log_type: document type, explicit trace mappings if set
+                     (dynamic mappings otherwise, MySQL tables)
+    """
+    body = {'settings': BULK_LOAD_SETTINGS}
+    if log_type:
+        body['mappings'] = {log_type: INDEX_MAPPINGS}
+    es_c.indices.create(es_index, body=body)
+
+
+def recreate_index(es_c, es_index, log_type=None):
+    """
+    @goal: delete index if it exists, then create it empty
+    @param es_c: ElasticSearch instance
+    @param es_index: ElasticSearch index
+    @param log_type: document type, see create_index
+    """
+    from elasticsearch.exceptions import NotFoundError
+
+    try:
+        es_c.indices.delete(es_index)
+    except NotFoundError:
+        logger.info("Current index: {0}".format(es_index))
+    create_index(es_c, es_index, log_type)
+
+
+@contextmanager
+def bulk_load(es_c, es_index, enabled=True):
+    """
+    @goal: bulk load settings while indexing, then production settings
+           restored, index refreshed and force-merged
+    @param es_c: ElasticSearch instance
+    @param es_index: ElasticSearch index
+    @param enabled: settings left untouched if False (rolling write index
+                    shared by concurrent jobs, merged once rolled over)
+    """
+    if not enabled:
+        yield
+        return
+    es_c.indices.put_settings(BULK_LOAD_SETTINGS, index=es_index)
+    try:
+        yield
+    finally:
+        es_c.indices.put_settings(PRODUCTION_SETTINGS, index=es_index)
+        es_c.indices.refresh(index=es_index)
+        es_c.indices.forcemerge(index=es_index, max_num_segments=FORCE_MERGE_SEGMENTS,
+                                request_timeout=FORCE_MERGE_TIMEOUT)
+        logger.info("%s: production settings restored, force-merged", es_index)
+
+
+def rolling_names(log_type):
+    """
+    @goal: names of the rolling layout of a log type
+    @return (read alias, write alias, first index)
+    """
+    read_alias = ROLLING_ALIAS.format(log_type)
+    return read_alias, read_alias + '-write', read_alias + '-000001'
+
+
+def ensure_rolling_index(es_c, log_type):
+    """
+    @goal: put the index template of the rolled indices (mappings, read
+           alias), create the first index if there is no write alias yet
+    @param es_c: ElasticSearch instance
+    @param log_type: document type
+    @return write alias
+    """
+    from elasticsearch.exceptions import RequestError
+
+    read_alias, write_alias, first_index = rolling_names(log_type)
+    settings = {'index': dict(PRODUCTION_SETTINGS['index'], number_of_shards=ROLLING_SHARDS)}
+    es_c.indices.put_template(read_alias, body={'template': read_alias + '-*',
+                                                'settings': settings,
+                                                'mappings': {log_type: INDEX_MAPPINGS},
+                                                'aliases': {read_alias: {}}})
+    if not es_c.indices.exists_alias(name=write_alias):
+        try:
+            es_c.indices.create(first_index, body={'aliases': {write_alias: {}}})
+            logger.info("Rolling index created: %s", first_index)
+        except RequestError:
+            # created meanwhile by another job
+            logger.info("Rolling index exists: %s", first_index)
+    return write_alias
+
+
+def rollover_index(es_c, log_type, conditions=ROLLOVER_CONDITIONS):
+    """
+    @goal: roll the write alias over to a new index if the current one is
+           old or big enough, the former index is force-merged (read only)
+    @param es_c: ElasticSearch instance
+    @param log_type: document type
+    @param conditions: rollover conditions (max_age, max_docs)
+    @return new index name if rolled over, None otherwise
+    """
+    write_alias = rolling_names(log_type)[1]
+    response = es_c.indices.rollover(write_alias, body={'conditions': conditions})
+    if not response.get('rolled_over'):
+        return None
+    logger.info("Rolled over %s: %s -> %s", write_alias, response['old_index'],
+                response['new_index'])
+    es_c.indices.forcemerge(index=response['old_index'], max_num_segments=FORCE_MERGE_SEGMENTS,
+                            request_timeout=FORCE_MERGE_TIMEOUT)
+    return response['new_index']
+
+
+def delete_build_documents(es_c, log_type, fields):
+    """
+    @goal: delete documents of a build from the rolled indices (build
+           indexed again)
+    @param es_c: ElasticSearch instance
+    @param log_type: document type
+    @param fields: build, config, module of the documents to delete
+    """
+    read_alias = rolling_names(log_type)[0]
+    query = {'query': {'bool': {'filter': [{'term': {key: value}}
+                                           for key, value in sorted(fields.items())]}}}
+    response = es_c.delete_by_query(index=read_alias, body=query)
+    if response.get('deleted'):
+        logger.info("%s: %d documents of %s deleted", read_alias, response['deleted'],
+                    ', '.join('%s %s' % item for item in sorted(fields.items())))
+
+
+def apply_retention(es_c, log_type, days=RETENTION_DAYS, max_indices=RETENTION_INDICES):
+    """
+    @goal: drop whole rolled indices: rolled over more than days ago, or
+           beyond the max_indices newest ones, never the write index
+    @param es_c: ElasticSearch instance
+    @param log_type: document type
+    @param days: retention period, no age limit if None
+    @param max_indices: number of indices kept, no limit if None
+    @return dropped index names
+    """
+    read_alias, write_alias, _ = rolling_names(log_type)
+    settings = es_c.indices.get_settings(index=read_alias, name='index.creation_date')
+    write_indices = set(es_c.indices.get_alias(name=write_alias))
+    created = sorted((int(index_settings['settings']['index']['creation_date']), es_index)
+                     for es_index, index_settings in settings.items())
+
+    dropped = set()
+    if days is not None:
+        # documents of an index are older than the creation of the next one
+        cutoff = (time.time() - days * 86400) * 1000
+        dropped.update(es_index for (_, es_index), (rolled, _) in zip(created, created[1:])
+                       if rolled < cutoff)
+    if max_indices is not None:
+        dropped.update(es_index for _, es_index in created[:max(0, len(created) - max_indices)])
+    dropped = sorted(dropped - write_indices)
+    for es_index in dropped:
+        es_c.indices.delete(es_index)
+        logger.info("Retention: %s dropped", es_index)
+    return dropped
+
+
+def prepare_target_index(es_c, es_index, log_type, layout, incremental=False, fields=None):
+    """
+    @goal: index documents are written to
+           - build layout: es_index, recreated (kept if incremental)
+           - rolling layout: write alias, rolled over if needed, former
+             documents of the build deleted (kept if incremental)
+    @param es_c: ElasticSearch instance
+    @param es_index: ElasticSearch index of the build
+    @param log_type: document type
+    @param layout: 'build' or 'rolling'
+    @param incremental: keep documents already indexed
+    @param fields: build, config and module of the documents (rolling layout)
+    @return index or alias name
+    """
+    if layout not in INDEX_LAYOUTS:
+        raise ValueError('index layout must be one of %s' % ', '.join(INDEX_LAYOUTS))
+    if layout == 'rolling':
+        write_alias = ensure_rolling_index(es_c, log_type)
+        rollover_index(es_c, log_type)
+        if not incremental:
+            if fields and 'build' in fields:
+                delete_build_documents(es_c, log_type, fields)
+            else:
+                logger.warning("%s: no build field, former documents kept", es_index)
+        return write_alias
+    if not incremental:
+        recreate_index(es_c, es_index, log_type)
+    elif not es_c.indices.exists(es_index):
+        create_index(es_c, es_index, log_type)
+    return es_index
+
+
+def finish_target_index(es_c, log_type, layout):
+    """
+    @goal: retention of the rolled indices once a build is indexed
+    """
+    if layout == 'rolling':
+        apply_retention(es_c, log_type)
+
+
+def index_directory(directory_c, es_index, log_type, version, module, pytestemb_version,
+                    workers=1, incremental=False, pool=None, hosts=None, layout=None,
+                    fields=None, rollup_file=None, templates=None):
+    """
+    @goal: index then remove log files of an untarred directory
+    @param directory_c: directory of log files
+    @param es_index: ElasticSearch index
+    @param log_type: ckcm or octopylog
+    @param version: package version
+    @param module: fc60x0 module
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @param workers: number of parsing processes, files parsed in parallel if > 1
+    @param incremental: only index new or grown files, see index_module
+    @param pool: multiprocessing pool parsing files (overrides workers)
+    @param hosts: elasticsearch hosts (ES_HOSTS if None)
+    @param layout: 'build': es_index is (re)created, 'rolling': documents
+                   written to the rolling write alias, es_index only names
+                   the incremental manifest (INDEX_LAYOUT if None)
+    @param fields: build and config fields of every document (optional)
+    @param rollup_file: rollup statistics also written to this json file
+    @param templates: mine message templates (TEMPLATE_MINING if None)
+    @return results: (file name, error code) per parsed file
+    """
+    layout = layout or INDEX_LAYOUT
+    fields = fields or {}
+    file_list = sorted(os.listdir(directory_c))
+    # None offset: whole file, elastic search ids
+    offsets = dict.fromkeys(file_list)
+    signatures = {}
+    manifest = {}
+    partial_rollups = {}
+    # Rollup of each parsed file
+    rollups = {}
+    mine_templates = template_mining(log_type, es_index, templates)
+    # Incremental ids (file name, offset) of builds sharing rolled indices
+    id_prefix = es_index if layout == 'rolling' else None
+
+    with elastic_search(hosts=hosts or ES_HOSTS) as es_c:
+        # Create elastic search instance
+        if incremental:
+            manifest = load_manifest(es_index)
+            offsets, signatures = get_incremental_offsets(directory_c, file_list, manifest)
+            partial_rollups = partial_line_rollups(directory_c, offsets, manifest, log_type,
+                                                   pytestemb_version)
+        target = prepare_target_index(es_c, es_index, log_type, layout, incremental,
+                                      dict(fields, module=module))
+
+        for file_c in file_list:
+            if file_c not in offsets:
+                logger.info("    Unchanged... %s", file_c)
                 os.remove(os.path.join(directory_c, file_c))
 
-    # clean tmp directory
+        # Nothing new (incremental): index settings left untouched
+        with bulk_load(es_c, target, layout == 'build' and bool(offsets)):
+            if workers > 1 or pool is not None:
+                results = index_files_parallel(es_c, directory_c, target, log_type,
+                                               version, module, pytestemb_version, workers,
+                                               offsets, pool=pool, fields=fields,
+                                               rollups=rollups, mine_templates=mine_templates,
+                                               id_prefix=id_prefix)
+            else:
+                results = []
+                for file_c in sorted(offsets):
+                    logger.info("    Parsing... %s", file_c)
+                    logger.info("Current index: {0}".format(target))
+                    rollups[file_c] = Rollup()
+                    try:
+                        error_code, _ = index_file(es_c, os.path.join(directory_c, file_c),
+                                                   target,
+                                                   log_type, version=version,
+                                                   module=module,
+                                                   pytestemb_version=pytestemb_version,
+                                                   offset=offsets[file_c], fields=fields,
+                                                   rollup=rollups[file_c],
+                                                   mine_templates=mine_templates,
+                                                   id_prefix=id_prefix)
+                        results.append((file_c, error_code))
+                    except Exception as exc:
+                        raise exc
+                    finally:
+                        logger.info("Removing {0}".format(os.path.join(directory_c, file_c)))
+                        os.remove(os.path.join(directory_c, file_c))
 
-    deprecated_files = [os.path.join("/tmp", f) for f in os.listdir("/tmp") if re.search(r'(pytestemb|ckcm|octopylog).*', f)
-                        if os.path.isfile(os.path.join("/tmp", f))]
-    deprecated_dirs = [os.path.join("/tmp", f) for f in os.listdir("/tmp") if re.search(r'(pytestemb|ckcm|octopylog).*', f)
-                        if os.path.isdir(os.path.join("/tmp", f))]
+        # Rollup of the build, files indexed by former runs included if
+        # incremental (rollup of each file kept in the manifest)
+        file_rollups = rollups
+        if incremental:
+            file_rollups = update_file_rollups(manifest, results, offsets, rollups,
+                                               partial_rollups)
+        rollup = Rollup()
+        for file_rollup in file_rollups.values():
+            rollup.merge(file_rollup)
+        index_rollup(es_c, rollup, es_index, log_type,
+                     dict(fields, module=module, version=version), replace=not incremental)
 
-    for d_file in deprecated_files:
-        logger.info("Cleaning: delete file {0}".format(d_file))
-        os.remove(d_file)
+        finish_target_index(es_c, log_type, layout)
 
-    #for d_file in deprecated_dirs:
-    #    logger.info("Cleaning: delete file {0}".format(d_file))
-    #    os.rmdir(d_file)
+    if incremental:
+        for file_c, error_code in results:
+            if error_code:
+                manifest[file_c] = dict(signatures[file_c],
+                                        rollup=file_rollups[file_c].to_json())
+        save_manifest(es_index, manifest)
+    if rollup_file:
+        save_rollup(rollup, rollup_file)
+    if mine_templates is not None:
+        save_templates(log_type, es_index)
 
+    return results
 
 
-    return all(err_list)
+def index_members(es_c, members, es_index, log_type, version, module, pytestemb_version,
+                  fields=None, rollup=None, mine_templates=None):
+    """
+    @goal: index tar.gz members as they are decompressed
+    @param es_c: ElasticSearch instance
+    @param members: TarMember iterator
+    @param es_index: ElasticSearch index
+    @param log_type: ckcm or octopylog
+    @param version: package version
+    @param module: fc60x0 module
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @param fields: build and config fields of every document (optional)
+    @param rollup: Rollup counting the lines of every member (optional)
+    @param mine_templates: template mining function (optional)
+    @return results: (file name, error code) per member
+    """
+    results = []
+    for member in members:
+        logger.info("    Parsing... %s", member.name)
+        try:
+            error_code, _ = index_file(es_c, member, es_index, log_type, version=version,
+                                       module=module, pytestemb_version=pytestemb_version,
+                                       fields=fields, rollup=rollup,
+                                       mine_templates=mine_templates)
+        finally:
+            member.close()
+        results.append((member.name, error_code))
+    return results
+
+
+def index_files_parallel(es_c, directory_c, es_index, log_type, version, module,
+                         pytestemb_version, workers, offsets=None, pool=None, fields=None,
+                         rollups=None, mine_templates=None, id_prefix=None):
+    """
+    @goal: parse directory files in a process pool, index them as they come
+    @param es_c: ElasticSearch instance
+    @param directory_c: directory of log files
+    @param es_index: ElasticSearch index
+    @param log_type: ckcm or octopylog
+    @param version: package version
+    @param module: fc60x0 module
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @param workers: number of parsing processes
+    @param offsets: {file name: start offset} of files to parse (all if None)
+    @param pool: multiprocessing pool to use, a pool of workers processes
+                 is created for the call if None
+    @param fields: build and config fields of every document (optional)
+    @param rollups: dictionary filled with the Rollup of each file (optional)
+    @param mine_templates: template mining function, run in this process so
+                           that templates ids are shared (optional)
+    @param id_prefix: prefix of deterministic ids, see index_file (optional)
+    @return results: (file name, error code) per file, error code False
+                     if file not (fully) indexed
+    """
+    import multiprocessing
+    import Queue
+
+    results = []
+    if offsets is None:
+        offsets = dict.fromkeys(os.listdir(directory_c))
+    # Bounded: parsing processes wait when indexing is late (backpressure)
+    manager = multiprocessing.Manager()
+    queue = manager.Queue(PARSE_QUEUE_SIZE)
+    tasks = [(os.path.join(directory_c, file_c), log_type, version, module, pytestemb_version,
+              offset, fields or {}, SERIALIZE_DOCUMENTS and mine_templates is None, id_prefix,
+              id_prefix or es_index, queue)
+             for file_c, offset in sorted(offsets.items())]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers)
+    # error code of files being indexed
+    error_codes = {}
+    completed = False
+    try:
+        parsing = pool.map_async(parse_file, tasks)
+        while len(results) < len(tasks):
+            try:
+                file_path, documents, outcome = queue.get(timeout=1)
+            except Queue.Empty:
+                if parsing.ready():
+                    # raises the error of a parsing process, if any
+                    parsing.get()
+                continue
+            file_c = os.path.basename(file_path)
+            error_code = error_codes.get(file_c, True)
+            if documents:
+                if mine_templates is not None:
+                    documents = mine_templates(documents)
+                indexed, _ = bulk_index(es_c, documents, es_index, log_type,
+                                        log_file_path=file_path,
+                                        pytestemb_version=pytestemb_version)
+                error_code = error_code and indexed
+            if outcome is None:
+                error_codes[file_c] = error_code
+                continue
+
+            error, count, seconds, serialize_seconds, rollup = outcome
+            logger.info("    Parsed... %s", file_c)
+            if rollups is not None:
+                rollups[file_c] = rollup
+            record_parsed(log_type, count, seconds, serialize_seconds)
+            if error:
+                logger.error("%s parsing failed: %s", file_path, error)
+                error_code = False
+            results.append((file_c, error_code))
+            logger.info("Removing {0}".format(file_path))
+            os.remove(file_path)
+        completed = True
+    finally:
+        # On error, parsing processes may wait on the full queue: stopped
+        # (own pool) or their put fails once the manager is shut down
+        if own_pool:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+        manager.shutdown()
+        if own_pool:
+            pool.join()
+
+    return results
+
+
+def manifest_path(es_index):
+    """
+    @goal: path of the manifest of an index
+    @param es_index: ElasticSearch index
+    @return manifest file path
+    """
+    return os.path.join(MANIFEST_DIRECTORY, '{0}.json'.format(es_index))
+
+
+def template_mining(log_type, es_index, templates=None):
+    """
+    @goal: template mining function of a build (TemplateMiner.mine of the
+           log type miner, new templates labelled with the build index)
+    @param templates: mine templates, TEMPLATE_MINING if None
+    @return function of parsed documents, None if mining is disabled
+    """
+    if templates is None:
+        templates = TEMPLATE_MINING
+    if not templates:
+        return None
+    return partial(get_template_miner(log_type).mine, log_type=log_type, source=es_index)
+
+
+def save_templates(log_type, es_index):
+    """
+    @goal: log the templates first seen in a build, save the template table
+    """
+    new_templates = get_template_miner(log_type).first_seen(es_index)
+    logger.info("%s: %d new message templates %s", es_index, len(new_templates),
+                sorted(new_templates)[:20])
+    save_template_miner(log_type)
+
+
+def update_file_rollups(manifest, results, offsets, rollups, partial_rollups=None):
+    """
+    @goal: rollup of each file of an incremental build: a file parsed from
+           its start replaces the rollup of its manifest entry, the rollup
+           of a tail is added to it, files not indexed keep their entry
+    @param manifest: files indexed by former runs, with their rollup
+    @param results: (file name, error code) of the files parsed
+    @param offsets: {file name: start offset} of the files parsed
+    @param rollups: {file name: Rollup} of the files parsed
+    @param partial_rollups: {file name: Rollup} of the partial last lines
+                            parsed again, see partial_line_rollups
+    @return {file name: Rollup}
+    """
+    file_rollups = dict((file_c, Rollup.from_json(entry.get('rollup', {})))
+                        for file_c, entry in manifest.items())
+    for file_c, error_code in results:
+        if not error_code:
+            continue
+        if offsets.get(file_c):
+            file_rollup = file_rollups.setdefault(file_c, Rollup())
+            if partial_rollups and file_c in partial_rollups:
+                file_rollup.subtract(partial_rollups[file_c])
+            file_rollup.merge(rollups[file_c])
+        else:
+            file_rollups[file_c] = rollups[file_c]
+    return file_rollups
+
+
+def load_manifest(es_index):
+    """
+    @goal: load files already indexed into an index
+    @param es_index: ElasticSearch index
+    @return manifest: {file name: {size, mtime, hash, offset, rollup}}
+    """
+    import json
+
+    if not os.path.isfile(manifest_path(es_index)):
+        return {}
+    with open(manifest_path(es_index)) as manifest_c:
+        return json.load(manifest_c)
+
+
+def save_manifest(es_index, manifest):
+    """
+    @goal: save files indexed into an index
+    @param es_index: ElasticSearch index
+    @param manifest: {file name: {size, mtime, hash, offset, rollup}}
+    """
+    import json
+
+    if not os.path.isdir(MANIFEST_DIRECTORY):
+        os.makedirs(MANIFEST_DIRECTORY)
+    with open(manifest_path(es_index), 'w') as manifest_c:
+        json.dump(manifest, manifest_c, indent=1, sort_keys=True)
+
+
+def index_rollup(es_c, rollup, es_index, log_type, fields=None, replace=True):
+    """
+    @goal: write the rollup documents of a build into the rollup index of
+           its log type (dashboards count lines there, not in raw documents)
+    @param es_c: ElasticSearch instance
+    @param rollup: Rollup of the build
+    @param es_index: ElasticSearch index of the build (rollup key)
+    @param log_type: ckcm or octopylog
+    @param fields: module, version, build, config of the build
+    @param replace: delete the former rollup documents of the build first
+    @return error_code: boolean, False if one document is not indexed
+    """
+    from elasticsearch.exceptions import RequestError
+
+    rollup_index = ROLLUP_INDEX.format(log_type)
+    if not es_c.indices.exists(rollup_index):
+        try:
+            es_c.indices.create(rollup_index,
+                                body={'mappings': {ROLLUP_DOC_TYPE: ROLLUP_MAPPINGS}})
+        except RequestError:
+            # created meanwhile by another job
+            pass
+    elif replace:
+        es_c.delete_by_query(index=rollup_index,
+                             body={'query': {'term': {'rollup_key': es_index}}})
+    documents = rollup.documents(es_index, dict(fields or {}, log_type=log_type,
+                                                index_time=time.strftime('%Y-%m-%dT%H:%M:%S')))
+    error_code, _ = bulk_index(es_c, documents, rollup_index, ROLLUP_DOC_TYPE)
+    logger.info("%s: %d rollup documents of %s", rollup_index, len(documents), es_index)
+    return error_code
+
+
+def get_incremental_offsets(directory, file_list, manifest):
+    """
+    @goal: find files to (re)index and where to start parsing them
+    @param directory: directory of log files
+    @param file_list: file names
+    @param manifest: files already indexed
+    @return offsets: {file name: start offset}, unchanged files are left out
+    @return signatures: {file name: manifest entry once indexed}, offset
+                        after the last complete line: a partial last line
+                        is parsed again once grown (same document id)
+    """
+    offsets = {}
+    signatures = {}
+    for file_c in file_list:
+        file_path = os.path.join(directory, file_c)
+        stat = os.stat(file_path)
+        entry = manifest.get(file_c)
+        if entry and entry['size'] == stat.st_size \
+        and entry['mtime'] == int(stat.st_mtime):
+            continue
+        offset = 0
+        if entry and stat.st_size >= entry['size'] \
+        and file_digest(file_path, entry['size']) == entry['hash']:
+            if stat.st_size == entry['size']:
+                # Touched only
+                continue
+            # Same beginning: only index the tail
+            offset = entry['offset']
+        offsets[file_c] = offset
+        signatures[file_c] = {'size': stat.st_size,
+                              'mtime': int(stat.st_mtime),
+                              'hash': file_digest(file_path),
+                              'offset': last_line_end(file_path)}
+    return offsets, signatures
+
+
+def partial_line_rollups(directory, offsets, manifest, log_type, pytestemb_version=None):
+    """
+    @goal: rollup of the partial last line of the files whose tail is
+           parsed from it: counted by the former run, counted again now
+    @param directory: directory of log files
+    @param offsets: {file name: start offset}, see get_incremental_offsets
+    @param manifest: files already indexed
+    @return {file name: Rollup}
+    """
+    import StringIO
+
+    partial_rollups = {}
+    for file_c, offset in offsets.items():
+        entry = manifest.get(file_c)
+        if not offset or entry['offset'] >= entry['size']:
+            continue
+        with open(os.path.join(directory, file_c), 'rb') as file_d:
+            file_d.seek(offset)
+            line = StringIO.StringIO(file_d.read(entry['size'] - offset))
+        line.name = file_c
+        partial_rollups[file_c] = Rollup()
+        parser_c = parser.get_parser(log_type, pytestemb_version)
+        for _ in parser_c.parse(line, rollup=partial_rollups[file_c]):
+            pass
+    return partial_rollups
+
+
+def match_pytestemb_version(line):
+    """
+    @goal: get pytestemb version from an octopylog line
+    @return pytestemb version or None
+    """
+    if 'Library version : pytestemb' in line:
+        return line.split()[-1]
+    return None
+
+
+def match_cgmrex(line):
+    """
+    @goal: get FC60x0 version from a CGMREX answer line
+    @return version or None
+    """
+    if '+CGMREX:' in line:
+        version = line.split("'")[1].lower()
+        return version.split()[0]  # Ensure no space in version
+    return None
+
+
+def match_cgmr(line):
+    """
+    @goal: get FC60x0 version from a CGMR answer line
+    @return version or None
+    """
+    if '+CGMR:HW' in line:
+        # Get version from line
+        parsed_line = re.match("(.*)-SW(.*)<0x0D><0x0A>(.*)", line)
+        if parsed_line:
+            return parsed_line.group(2)
+    return None
+
+
+def is_cgmrex_file(file_name):
+    """
+    @goal: True if test file may hold a CGMREX answer
+    """
+    return file_name.startswith('cmd_CGMREX') \
+        or file_name.startswith('check_module_') \
+        or file_name.startswith('setenv_')
+
+
+def is_cgmr_file(file_name):
+    """
+    @goal: True if test file may hold a CGMR answer
+    """
+    return file_name.startswith('cmd_CGMR')
+
+
+def scan_member(member, match):
+    """
+    @goal: find first matching line of a spooled tar member, then rewind it
+    @param member: spooled TarMember
+    @param match: line matcher, returns a value or None
+    @return matched value or None
+    """
+    value = None
+    for line in read_lines(member):
+        value = match(line)
+        if value:
+            break
+    member.seek(0)
+    return value
 
 
-def get_pytestemb_version(directory):
+def scan_stream_versions(members, log_type, max_size=None):
+    """
+    @goal: get package and pytestemb versions from a tar.gz stream, members
+           are read until versions are found and spooled to be parsed later
+    @param members: TarMember iterator, left on the first member not read
+    @param log_type: ckcm or octopylog
+    @param max_size: bytes spooled at most, STREAM_SCAN_MAX_SIZE if None
+    @return spooled: members already read, rewound
+    @return package_version: package version, None if versions are not
+                             found within max_size bytes
+    @return pytestemb_version: pytestemb version (octopylog only)
+    """
+    if max_size is None:
+        max_size = STREAM_SCAN_MAX_SIZE
+    spooled = []
+    spooled_size = 0
+    package_version = None
+    pytestemb_version = None
+    cgmrex_found = False
+    need_pytestemb = log_type == 'octopylog'
+
+    try:
+        for member in members:
+            member = spool_member(member)
+            spooled.append(member)
+            spooled_size += member.size
+            if need_pytestemb and pytestemb_version is None:
+                pytestemb_version = scan_member(member, match_pytestemb_version)
+            if package_version is None and is_cgmrex_file(member.name):
+                cgmrex_found = True
+                package_version = scan_member(member, match_cgmrex)
+            if package_version is not None \
+            and (pytestemb_version is not None or not need_pytestemb):
+                break
+            if spooled_size >= max_size:
+                return spooled, None, pytestemb_version
+    except Exception:
+        for member in spooled:
+            member.close()
+        raise
+
+    if package_version is None:
+        # Same rule as get_package_version: CGMR only without CGMREX files
+        package_version = 'unknown'
+        if not cgmrex_found:
+            for member in spooled:
+                if is_cgmr_file(member.name):
+                    version = scan_member(member, match_cgmr)
+                    if version:
+                        package_version = version
+                        break
+
+    return spooled, package_version, pytestemb_version
+
+
+def stream_members(spooled, members):
+    """
+    @goal: spooled members then the rest of the stream, spools closed and
+           stream stopped when the iteration is dropped
+    @param spooled: members read by scan_stream_versions
+    @param members: TarMember iterator of the tar.gz stream
+    @return TarMember generator
+    """
+    try:
+        for member in spooled:
+            yield member
+        for member in members:
+            yield member
+    finally:
+        for member in spooled:
+            member.close()
+        members.close()
+
+
+def find_first_match(file_paths, match):
+    """
+    @goal: stream files line by line until a line matches
+    @param file_paths: files to scan, in scan order
+    @param match: line matcher, returns a value or None
+    @return (value, file path, line byte offset), (None, None, None) if not found
+    """
+    for file_path in file_paths:
+        offset = 0
+        for line in read_lines(file_path):
+            value = match(line)
+            if value:
+                return value, file_path, offset
+            offset += len(line) + 1
+    return None, None, None
+
+
+def match_at(file_path, offset, match):
+    """
+    @goal: check a single line of a file, at a known byte offset
+    @return matched value or None
+    """
+    if not os.path.isfile(file_path):
+        return None
+    for line in read_lines(file_path, chunk_size=VERSION_LINE_SIZE, offset=offset):
+        return match(line)
+    return None
+
+
+def likely_version_files(directory, file_names):
+    """
+    @goal: order candidate files, dedicated version tests first, then
+           smallest files first
+    @param directory: directory of file_names
+    @param file_names: candidate file names
+    @return file paths
+    """
+    def rank(file_name):
+        """ scan order """
+        return (not file_name.startswith('cmd_CGMR'),
+                not file_name.startswith('check_module_'),
+                os.path.getsize(os.path.join(directory, file_name)))
+
+    return [os.path.join(directory, file_name) for file_name in sorted(file_names, key=rank)]
+
+
+def version_cache_path(directory, cache_key=None):
+    """
+    @goal: versions cache of a build: file of the build key in
+           VERSION_CACHE_DIRECTORY, so that builds untarred in a new
+           temporary directory each run (index_module, index_configs)
+           reuse it, next to the build directory if there is no key
+    @param directory: build directory
+    @param cache_key: build key (log type, module, config, build number)
+    """
+    if cache_key:
+        return os.path.join(VERSION_CACHE_DIRECTORY, '{0}.json'.format(cache_key))
+    directory = directory.rstrip('/')
+    return '{0}.versions.json'.format(directory)
+
+
+def cached_version(directory, key, match, cache_key=None):
+    """
+    @goal: get a version from the cache, checked against the cached line
+           (file name and offset, in directory)
+    @param directory: build directory
+    @param key: 'package' or 'pytestemb'
+    @param match: line matcher of the version
+    @param cache_key: build key, see version_cache_path
+    @return version or None
+    """
+    import json
+
+    try:
+        with open(version_cache_path(directory, cache_key)) as cache_c:
+            entry = json.load(cache_c).get(key)
+    except (IOError, ValueError):
+        return None
+    if not entry:
+        return None
+    file_path = os.path.join(directory, entry['file'])
+    if match_at(file_path, entry['offset'], match) != entry['version']:
+        return None
+    return entry['version']
+
+
+def cache_version(directory, key, version, file_path, offset, cache_key=None):
+    """
+    @goal: store a found version with the file and offset of its line
+    """
+    import json
+
+    cache_file = version_cache_path(directory, cache_key)
+    if cache_key and not os.path.isdir(VERSION_CACHE_DIRECTORY):
+        os.makedirs(VERSION_CACHE_DIRECTORY)
+    try:
+        with open(cache_file) as cache_c:
+            cache = json.load(cache_c)
+    except (IOError, ValueError):
+        cache = {}
+    cache[key] = {'version': version,
+                  'file': os.path.basename(file_path),
+                  'offset': offset}
+    with open(cache_file, 'w') as cache_c:
+        json.dump(cache, cache_c)
+
+
+def get_pytestemb_version(directory, cache_key=None):
     """
     @goal: get pytestemb version used for test
     @param directory: directory to parse
+    @param cache_key: build key of the versions cache (optional)
     @return pytestemb_version: pytestemb version
     """
-    found = False
-    pytestemb_version = None
-    for file_c_name in os.listdir(directory):
-        if found:
-            break
-        with open(os.path.join(directory, file_c_name), 'r') as file_c:
-            file_c_content = file_c.read()
+    pytestemb_version = cached_version(directory, 'pytestemb', match_pytestemb_version,
+                                       cache_key)
+    if pytestemb_version:
+        return pytestemb_version
 
-        for line_c in file_c_content.split('\n'):
-            if found:
-                break
-            if 'Library version : pytestemb' in line_c:
-                pytestemb_version = line_c.split()[-1]
-                found = True
+    file_paths = likely_version_files(directory, os.listdir(directory))
+    pytestemb_version, file_path, offset = find_first_match(file_paths,
+                                                            match_pytestemb_version)
+    if pytestemb_version:
+        cache_version(directory, 'pytestemb', pytestemb_version, file_path, offset, cache_key)
 
     return pytestemb_version
 
 
-def get_package_version(directory):
+def get_package_version(directory, cache_key=None):
     """
     @goal: get version from traces directory
     @param directory: directory to parse
+    @param cache_key: build key of the versions cache (optional)
     @return version: package version
     """
+    cached = cached_version(directory, 'package_cgmrex', match_cgmrex, cache_key) \
+        or cached_version(directory, 'package_cgmr', match_cgmr, cache_key)
+    if cached:
+        return cached
+
     # Find cmd_CGMREX test file and parse CGMREX command
     check_module_files = [file_c for file_c in os.listdir(directory)
-                          if file_c.startswith('cmd_CGMREX')
-                          or file_c.startswith('check_module_')
-                          or file_c.startswith('setenv_')]
+                          if is_cgmrex_file(file_c)]
 
     if not check_module_files:
         # Find cmd_CGMR test file and parse CGMR command
         check_module_files = [file_c for file_c in os.listdir(directory)
-                              if file_c.startswith('cmd_CGMR')]
-        [version, _] = get_cgmr([os.path.join(directory, file_path)
-                                         for file_path in check_module_files])
+                              if is_cgmr_file(file_c)]
+        [version, _] = get_cgmr(likely_version_files(directory, check_module_files),
+                                cache_key)
     else:
-        [version, _] = get_cgmrex([os.path.join(directory, file_path)
-                                           for file_path in check_module_files])
+        [version, _] = get_cgmrex(likely_version_files(directory, check_module_files),
+                                  cache_key)
     return version
 
 
-def get_cgmrex(log_file_path_list):
+def get_cgmrex(log_file_path_list, cache_key=None):
     """
     @goal: Parse CGMREX command
     @param ckcm_file_path_list: ckcm files paths list
+    @param cache_key: build key of the versions cache (optional)
     @return version: FC60x0 version
     @return package: FC60x0 config
     @return ckcm_file_path: ckcm file in which CGMREX has been encountered first
     """
-    version = 'unknown'
-    log_file_path = None
-    found = False
-
-    # Loop an all ckcm files
-    for log_file_path in log_file_path_list:
-        if found:
-            break
-        with open(log_file_path) as log_file:
-            file_content = log_file.read()
-        for line in file_content.split('\n'):
-            # Found '+CGMREX in file'
-            if '+CGMREX:' in line:
-                version = line.split("'")[1].lower()
-                version = version.split()[0]  # Ensure no space in version
-                logger.debug("CGMREX in %s\n%s", log_file_path, line)
-                found = True
-                break
+    version, log_file_path, offset = find_first_match(log_file_path_list, match_cgmrex)
+    if version:
+        logger.debug("CGMREX in %s at %d", log_file_path, offset)
+        cache_version(os.path.dirname(log_file_path), 'package_cgmrex',
+                      version, log_file_path, offset, cache_key)
+    else:
+        version = 'unknown'
 
     return [version, log_file_path]
 
 
-def get_cgmr(log_file_path_list):
+def get_cgmr(log_file_path_list, cache_key=None):
     """
     @goal: Parse CGMR command
     @param ckcm_file_path_list: ckcm files paths list
+    @param cache_key: build key of the versions cache (optional)
     @return version: FC60x0 version
     @return package: FC60x0 config
     @return ckcm_file_path: ckcm file in which CGMR has been encountered first
     """
-    version = 'unknown'
-    log_file_path = None
-    found = False
-
-    # Loop an all ckcm files
-    for log_file_path in log_file_path_list:
-        if found:
-            break
-        with open(log_file_path) as ckcm_file:
-            file_content = ckcm_file.read()
-        for line in file_content.split('\n'):
-            # Found '+CGMR in file'
-            if '+CGMR:HW' in line:
-                # Get version from line
-                parsed_line = re.match("(.*)-SW(.*)<0x0D><0x0A>(.*)", line)
-                if parsed_line:
-                    version = parsed_line.group(2)
-                    logger.debug("CGMR in %s", log_file_path)
-                    logger.debug("Version found >>> %s", line)
-                    logger.debug("Version : %s", version)
-                    found = True
-                    break
+    version, log_file_path, offset = find_first_match(log_file_path_list, match_cgmr)
+    if version:
+        logger.debug("CGMR in %s at %d", log_file_path, offset)
+        logger.debug("Version : %s", version)
+        cache_version(os.path.dirname(log_file_path), 'package_cgmr',
+                      version, log_file_path, offset, cache_key)
+    else:
+        version = 'unknown'
 
     return [version, log_file_path]
 
@@ -287,6 +1580,8 @@ def elastic_search(hosts=None):
     """
     Create a context manager when calling elasticsearch
     """
+    from elasticsearch import Elasticsearch
+
     try:
         es_c = Elasticsearch(hosts=hosts)
         logger.debug("Instanciate ElasticSearch\n%s", es_c.info())
@@ -297,36 +1592,92 @@ def elastic_search(hosts=None):
         logger.info('%d successfully indexed data', count_lines)
 
 
-def index_table(table, ip_address):
+def load_sync_state(state_file):
+    """
+    @goal: load MySQL tables high-water marks
+    @param state_file: json state file
+    @return state: {table: high-water mark}
+    """
+    import json
+
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as state_c:
+        return json.load(state_c)
+
+
+def save_sync_state(state_file, state):
+    """
+    @goal: save MySQL tables high-water marks
+    @param state_file: json state file
+    @param state: {table: high-water mark}
+    """
+    import json
+
+    with open(state_file, 'w') as state_c:
+        json.dump(state, state_c, default=str)
+
+
+def index_table(table, ip_address, key=None, state_file=MYSQL_STATE_FILE,
+                server=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD,
+                database=MYSQL_DATABASE):
     """
     Index MySQL table into elasticsearch instance
+    @param table: MySQL table
+    @param ip_address: elasticsearch host (or hosts list)
+    @param key: high-water mark column, if set only rows added since the
+                last run are indexed and the index is kept
+    @param state_file: json file storing the high-water mark per table
+    @param server, user, password, database: MySQL connection
+    @return error_code: False if rows were not indexed
     """
+    from elasticsearch.exceptions import NotFoundError
+    from elasticsearch.exceptions import RequestError
+
+    since = None
+    if key:
+        since = load_sync_state(state_file).get(table)
 
-    parser_c = parser.MySQLParser(server="172.20.38.50", user="parrotsa", password="parrotsa",
-                                  database="sandbox", table=table)
-    table_parsed = parser_c.parse()
+    error_code = False
+    parser_c = parser.MySQLParser(server=server, user=user, password=password,
+                                  database=database, table=table)
+    table_parsed = profile_iter(parser_c.parse(key=key, since=since), 'parse', table)
 
     with elastic_search(hosts=ip_address) as es_c:
         try:
             index_es = table
-            bulk_data = [data for data in table_parsed]
-            try:
-                es_c.indices.delete(index_es)
-            except NotFoundError:
-                logger.warning("Deleting index: {0} not found".format(index_es))
-            es_c.indices.create(index_es)
-            bulk(es_c, bulk_data, index=index_es, doc_type=table)
+            if since is None:
+                try:
+                    es_c.indices.delete(index_es)
+                except NotFoundError:
+                    logger.warning("Deleting index: {0} not found".format(index_es))
+                create_index(es_c, index_es)
+            else:
+                logger.info("%s: incremental sync from %s > %s", table, key, since)
+            # Incremental syncs are small: settings and segments left as is
+            with bulk_load(es_c, index_es, since is None):
+                error_code, _ = bulk_index(es_c, table_parsed, index_es, table)
+            if key and error_code and parser_c.high_water_mark is not None:
+                # Tables may be synced concurrently, reload the other marks
+                with _SYNC_STATE_LOCK:
+                    state = load_sync_state(state_file)
+                    state[table] = parser_c.high_water_mark
+                    save_sync_state(state_file, state)
         except IndexError:
             raise IndexError
         except RequestError as exc:
             print exc
             logger.error('%s bad index format', table)
+        finally:
+            dump_profiles()
+
+    return error_code
 
 
 if __name__ == "__main__":
+    init_logging()
     #print FC60x0_CONFIGS
-    #for config_fc in FC60x0_CONFIGS:
-    #    index_module(config_fc[0], config_fc[1], log_type='octopylog')
+    #index_configs(FC60x0_CONFIGS, log_type='octopylog')
 
     index_table("t_statistic", "172.20.22.104")
     index_table("t_performance", "172.20.22.104")
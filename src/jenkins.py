@@ -8,7 +8,7 @@ __copyright__ = "Copyright 2015, Parrot"
 # Module imports
 from src.com import JENKINS_SERVER
 from src.com import download_tgz_file
-import requests
+from src.com import get_session
 
 class JenkinsJob(object):
     """
@@ -17,15 +17,17 @@ class JenkinsJob(object):
     def __init__(self, config_hw=None, config_sw=None,
                  job_number='lastSuccessfulBuild',
                  log_type='ckcm',
-                 url_results=None):
+                 url_results=None,
+                 work_directory='/tmp'):
         """
         Instantiate a JenkinsJob object
-        Download tgz trace file
+        Download tgz trace file into work_directory
         Patch to avoid jenkins connection error (SSLv3 forced)
         """
-        
-        self._ckcm_tgz_file_name = '/tmp/ckcm-%s-%s.tgz' % (config_hw, config_sw)
-        self._octopylog_tgz_file_name = '/tmp/octopylog-%s-%s.tgz' % (config_hw, config_sw)
+
+        self._ckcm_tgz_file_name = '%s/ckcm-%s-%s.tgz' % (work_directory, config_hw, config_sw)
+        self._octopylog_tgz_file_name = '%s/octopylog-%s-%s.tgz' % (work_directory, config_hw,
+                                                                    config_sw)
         self.server = JENKINS_SERVER
         base_url = self.server + 'job/nb_' + config_hw.upper() + \
                            '/CONFIG_HW=' + config_hw.upper() + \
@@ -45,7 +47,7 @@ class JenkinsJob(object):
         elif log_type == 'octopylog':
             download_tgz_file(self.ctp_traces, self._octopylog_tgz_file_name)
 
-        self.build_number = int(requests.get("{0}{1}".format(base_url, '/buildNumber'), verify=False).text)
+        self.build_number = int(get_session().get("{0}{1}".format(base_url, '/buildNumber')).text)
 
     @property
     def ckcm_tgz_file_name(self):
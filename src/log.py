@@ -7,20 +7,201 @@ __copyright__ = "Copyright 2015, Parrot"
 # Generic imports
 import re
 
+# wxCKCM library tags, by decreasing precedence (first match wins).
+# ']HSTI' is also a hiphop tag, so 'hsti' is only reached if hiphop
+# tags are changed: kept to mirror the historical if/elif chain.
+CKCM_LIBRARY_TAGS = (('hiphop',    (']HSTI', 'SoftAT_', 'HIPHOP')),
+                     ('tala',      (']TALA',)),
+                     ('tango',     (']TANGO',)),
+                     ('soprano',   (']SOP',)),
+                     ('concertos', (']CCTOS',)),
+                     ('disco',     (']DISCO',)),
+                     ('soul',      (']SOUL',)),
+                     ('wxCKCM',    ('wxCKCM',)),
+                     ('rap',       (']RAP', ']SIVR')),
+                     ('blues',     (']BT', 'rt_postBlues', 'Blues')),
+                     ('hsti',      (']HSTI',)))
+
+CKCM_SEVERITIES = {'i': 'info',
+                   'e': 'error',
+                   'w': 'warning',
+                   'd': 'debug',
+                   'v': 'verbose',
+                   'c': 'critical'}
+
+# (tag, library) in precedence order
+_CKCM_TAGS = tuple((tag, library) for library, tags in CKCM_LIBRARY_TAGS for tag in tags)
+
+# Severity is the first character after the 4th '['
+_CKCM_SEVERITY_RE = re.compile(r'(?:[^[]*\[){4}([^[])')
+
+
+def get_ckcm_library(data):
+    '''
+    Get library from ckcm frame: first tag found in precedence order,
+    substring searches stay linear in the line length (overlapping tags
+    such as ']CCTOSoftAT_' included)
+    '''
+    for tag, library in _CKCM_TAGS:
+        if tag in data:
+            return library
+    return 'unknown'
+
+
+def get_ckcm_severity(data):
+    '''
+    Get severity from ckcm frame
+    '''
+    match = _CKCM_SEVERITY_RE.match(data)
+    if match:
+        return CKCM_SEVERITIES.get(match.group(1).lower())
+    return None
+
+
+def _get_hsti_field(data, marker, repeat):
+    '''
+    Get text between the last marker and the last '<LF>' of a frame,
+    'repeat' characters right after the marker are skipped
+    '''
+    end = data.rfind('<LF>')
+    start = data.rfind(marker, 0, end)
+    if end < 0 or start < 0:
+        return None
+    start += len(marker)
+    while repeat and data.startswith(repeat, start) and start < end:
+        start += 1
+    return data[start:end]
+
+
+def get_hsti_command(data):
+    '''
+    Get HSTI command from ckcm frame
+    '''
+    command = None
+    if 'WaitCmdAT' in data:
+        command = _get_hsti_field(data, 'WaitCmdAT', None)
+        if command is None:
+            print '>>> AttributeError: (HSTI Command) Bad ckcm line format:\n>>>%s' % data
+    return command
+
+
+def get_hsti_event(data):
+    '''
+    Get HSTI event from ckcm frame
+    '''
+    event = None
+    wait_cmd = data.find('WaitCmd')
+    colon = data.find(':', wait_cmd + len('WaitCmd'))
+    if wait_cmd >= 0 and colon >= 0 \
+    and data.rfind('<LF>') > colon:
+        event = _get_hsti_field(data, 'WaitCm', 'd')
+    elif 'HSTIRapEvent' in data:
+        event = _get_hsti_field(data, 'HSTIRapEven', 't')
+        if event is None:
+            print '>>> AttributeError: (HSTI Rap Event) Bad ckcm line format:\n>>>%s' % data
+    return event
+
+
+# pytestemb version -> (major, minor, first field position)
+_OCTOPYLOG_FORMATS = {}
+
+
+def get_octopylog_format(pytestemb_version):
+    '''
+    Octopylog line format of a pytestemb version, computed once per version
+    @return (major, minor, first_field_position)
+    '''
+    try:
+        return _OCTOPYLOG_FORMATS[pytestemb_version]
+    except KeyError:
+        pass
+    numbers = pytestemb_version.split('.')
+    major, minor = int(numbers[0]), int(numbers[1])
+    first_field_position = 0
+    if major >= 2 and minor >= 2:
+        first_field_position = 2
+    _OCTOPYLOG_FORMATS[pytestemb_version] = (major, minor, first_field_position)
+    return _OCTOPYLOG_FORMATS[pytestemb_version]
+
+
+def split_octopylog_line(data, first_field_position):
+    '''
+    Extract timestamp, message type and message from an octopylog frame,
+    the line is tokenized once
+    @param data: octopylog frame
+    @param first_field_position: position of the timestamp field
+    @return (timestamp, message_type, message), all None if the frame does
+            not start with a digit; IndexError if there is no timestamp
+    '''
+    if not data[0].isdigit():
+        return None, None, None
+    fields = data.split()
+    timestamp = fields[first_field_position]
+    message_type = None
+    if len(fields) > first_field_position + 1:
+        message_type = fields[first_field_position + 1]
+    message = ' '.join(fields[first_field_position + 2:])
+    return timestamp, message_type, message
+
+
+def split_octopylog_lines(lines, first_field_position):
+    '''
+    Batch version of split_octopylog_line: every line is tokenized once,
+    then each column is extracted in one pass over the tokens
+    @param lines: octopylog frames
+    @param first_field_position: position of the timestamp field
+    @return columns: {'timestamp': [...], 'message_type': [...], 'message': [...]},
+            None values for frames not starting with a digit; IndexError if
+            a frame has no timestamp
+    '''
+    tokens = [line.split() if line[:1].isdigit() else None for line in lines]
+    type_position = first_field_position + 1
+    message_position = first_field_position + 2
+    join = u' '.join
+    return {'timestamp': [fields and fields[first_field_position] for fields in tokens],
+            'message_type': [fields[type_position] if fields and len(fields) > type_position
+                             else None for fields in tokens],
+            'message': [fields and join(fields[message_position:]) for fields in tokens]}
+
+
+def classify_ckcm_line(data):
+    '''
+    Extract severity, library, HSTI command and event from a ckcm frame
+    @param data: ckcm frame
+    @return (severity, library, command, event)
+    '''
+    library = get_ckcm_library(data)
+    command = event = None
+    if library == 'hsti':
+        command = get_hsti_command(data)
+        event = get_hsti_event(data)
+    return get_ckcm_severity(data), library, command, event
+
 class GenericLog(object):
     """
     Generic Log class (parent)
+    Slot based: one record is allocated per file and fed line by line
     """
+    __slots__ = ('log_type', '_data')
+
     def __init__(self, data):
         """
         Initialize class
         """
-        self._log_type = "default"
+        self.log_type = "default"
         self._data = data
 
+    def fields(self):
+        """
+        (name, value) of every slot of the record
+        """
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                yield name, getattr(self, name, None)
+
     def __str__(self):
         s = 'Log :\n'
-        for items in self.__dict__.items():
+        for items in self.fields():
             s  += '- {0}: {1}\n'.format(*items)
         return s
 
@@ -35,6 +216,8 @@ class CkcmLog(GenericLog):
     """
     CKCM log class (specific)
     """
+    __slots__ = ('library', 'severity', 'command', 'event')
+
     def __init__(self):
         self.log_type = "ckcm"
         self._data    = None
@@ -50,71 +233,20 @@ class CkcmLog(GenericLog):
     @data.setter
     def data(self, value):
         self._data = value
-        self.severity = self.set_severity()
-        self.library = self.set_library()
-        self.event = self.set_event()
-        self.command = self.set_command()
+        (self.severity, self.library,
+         self.command, self.event) = classify_ckcm_line(value)
 
     def set_library(self):
         '''
         Get library from ckcm frame
         '''
-        library = 'unknown'
-        cmd_event = None
-
-        blues_str_list  = [']BT', 'rt_postBlues', 'Blues']
-        hiphop_str_list = [']HSTI', 'SoftAT_', 'HIPHOP']
-        rap_str_list    = [']RAP', ']SIVR']
-
-        if any(cur_str in self.data for cur_str in blues_str_list):
-            library = 'blues'
-        elif ']HSTI' in self.data:
-            library = 'hsti'
-        if any(cur_str in self.data for cur_str in rap_str_list):
-            library = 'rap'
-        if any(cur_str in self.data for cur_str in hiphop_str_list):
-            library = 'hiphop'
-        elif ']TALA' in self.data:
-            library = 'tala'
-        elif ']TANGO' in self.data:
-            library = 'tango'
-        elif ']SOP' in self.data:
-            library = 'soprano'
-        elif ']CCTOS' in self.data:
-            library = 'concertos'
-        elif ']DISCO' in self.data:
-            library = 'disco'
-        elif ']SOUL' in self.data:
-            library = 'soul'
-        elif 'wxCKCM' in self.data:
-            library = 'wxCKCM'
-
-        return library
-       
+        return get_ckcm_library(self.data)
+
     def set_severity(self):
         '''
-        Get library from ckcm frame
+        Get severity from ckcm frame
         '''
-        try:
-            severity = self.data.split("[")[4][0].lower().encode('utf8')
-        except IndexError:
-            severity = 'unknown'
-        if severity == 'i':
-            severity = 'info'
-        elif severity == 'e':
-            severity = 'error'
-        elif severity == 'w':
-            severity = 'warning'
-        elif severity == 'd':
-            severity = 'debug'
-        elif severity == 'v':
-            severity = 'verbose'
-        elif severity == 'c':
-            severity = 'critical'
-        else:
-            severity = None
-
-        return severity  
+        return get_ckcm_severity(self.data)
 
     def set_command(self):
         '''
@@ -122,11 +254,7 @@ class CkcmLog(GenericLog):
         '''
         command = None
         if self.library == 'hsti':
-            if 'WaitCmdAT' in self.data:
-                try:
-                    command = re.search('(.*)WaitCmdAT(.*)<LF>', self.data).group(2)
-                except AttributeError:
-                    print '>>> AttributeError: (HSTI Command) Bad ckcm line format:\n>>>%s' % self.data
+            command = get_hsti_command(self.data)
         return command
 
     def set_event(self):
@@ -135,22 +263,17 @@ class CkcmLog(GenericLog):
         '''
         event = None
         if self.library == 'hsti':
-            if re.search('WaitCmd(.*):(.*)<LF>', self.data):
-                try:
-                    self._event = re.search('(.*)WaitCmd*(.*)<LF>', self.data).group(2)
-                except AttributeError:
-                    print '>>> AttributeError: (HSTI Event) Bad ckcm line format:\n>>>%s' % self.data
-            elif 'HSTIRapEvent' in self.data:
-                try:
-                    self.event = re.search('(.*)HSTIRapEvent*(.*)<LF>', self.data).group(2)
-                except AttributeError:
-                    print '>>> AttributeError: (HSTI Rap Event) Bad ckcm line format:\n>>>%s' % self.data
+            event = get_hsti_event(self.data)
         return event
 
 class OctopylogLog(GenericLog):
     """
     octopylog class (specific)
     """
+    __slots__ = ('message_type', 'timestamp', 'message', 'pytestemb_version',
+                 'pytestemb_version_major', 'pytestemb_version_minor',
+                 'first_field_position')
+
     def __init__(self, pytestemb_version):
         self.log_type = "octopylog"
         self._data    = None
@@ -158,12 +281,9 @@ class OctopylogLog(GenericLog):
         self.timestamp = None
         self.message = None
         self.pytestemb_version = pytestemb_version
-        self.pytestemb_version_major = int(pytestemb_version.split('.')[0])
-        self.pytestemb_version_minor = int(pytestemb_version.split('.')[1])
-        self.first_field_position = 0
-        if self.pytestemb_version_major >= 2 \
-        and self.pytestemb_version_minor >= 2:
-            self.first_field_position = 2
+        (self.pytestemb_version_major,
+         self.pytestemb_version_minor,
+         self.first_field_position) = get_octopylog_format(pytestemb_version)
 
     @property
     def data(self):
@@ -172,48 +292,23 @@ class OctopylogLog(GenericLog):
     @data.setter
     def data(self, value):
         self._data = value
-        self.message_type = self.set_message_type()
-        self.timestamp = self.set_timestamp()
-        self.message = self.set_message()
+        (self.timestamp, self.message_type,
+         self.message) = split_octopylog_line(value, self.first_field_position)
 
     def set_message_type(self):
         '''
         Set message type field from octopylog frame
         '''
-        if self.data[0].isdigit():
-            try:
-                message_type = self.data.split()[self.first_field_position + 1]
-            except IndexError:
-                message_type = None
-        else:
-            message_type = None
-        return message_type
+        return split_octopylog_line(self.data, self.first_field_position)[1]
 
     def set_timestamp(self):
         '''
         Set timestamp field from octopylog frame
         '''
-        if self.data[0].isdigit():
-            timestamp = self.data.split()[self.first_field_position]
-        else:
-            timestamp = None
-        return timestamp
+        return split_octopylog_line(self.data, self.first_field_position)[0]
 
     def set_message(self):
         '''
         Set message field from octopylog frame
         '''
-        if self.data[0].isdigit():
-            try:
-                message = ' '.join(self.data.split()[self.first_field_position + 2:])
-            except IndexError:
-                message = None
-        else:
-            message = None
-        return message
-
-
-
-
-
-
+        return split_octopylog_line(self.data, self.first_field_position)[2]
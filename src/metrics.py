@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Pipeline instrumentation: counters and histograms per stage """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# Histogram buckets (upper bounds), seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Histogram buckets (upper bounds), documents per bulk request
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Name prefix of exported metrics
+METRICS_PREFIX = 'parselog_'
+
+
+class Counter(object):
+    """
+    Monotonic counter
+    """
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return {'value': self.value}
+
+
+class Histogram(object):
+    """
+    Observations count, sum and cumulative counts per bucket
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum', '_lock')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[position] += 1
+                    break
+
+    def sample(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': zip(self.buckets, cumulative)}
+
+
+class Registry(object):
+    """
+    Metrics by (name, labels), created on first use
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = kind(*args)
+        return metric
+
+    def describe(self, name, text):
+        """ help text of a metric (prometheus HELP line) """
+        self._help[name] = text
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def samples(self):
+        """
+        @return list of (name, labels dictionary, metric)
+        """
+        return [(name, dict(labels), metric)
+                for (name, labels), metric in sorted(self._metrics.items())]
+
+    def to_json(self):
+        """
+        @return {name: [sample, ...]}, sample holds its labels
+        """
+        data = {}
+        for name, labels, metric in self.samples():
+            sample = metric.sample()
+            sample['labels'] = labels
+            data.setdefault(name, []).append(sample)
+        return data
+
+    def to_prometheus(self):
+        """
+        @return metrics in prometheus text exposition format
+        """
+        lines = []
+        described = set()
+        for name, labels, metric in self.samples():
+            full_name = METRICS_PREFIX + name
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (full_name, self._help[name]))
+                kind = 'counter' if isinstance(metric, Counter) else 'histogram'
+                lines.append('# TYPE %s %s' % (full_name, kind))
+            if isinstance(metric, Counter):
+                lines.append('%s%s %s' % (full_name, _labels(labels), metric.value))
+                continue
+            sample = metric.sample()
+            for bound, count in sample['buckets']:
+                lines.append('%s_bucket%s %d' % (full_name, _labels(labels, le=bound), count))
+            lines.append('%s_bucket%s %d' % (full_name, _labels(labels, le='+Inf'), sample['count']))
+            lines.append('%s_sum%s %s' % (full_name, _labels(labels), sample['sum']))
+            lines.append('%s_count%s %d' % (full_name, _labels(labels), sample['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    """ prometheus label set: {a="1",b="2"} """
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+# Process wide registry
+METRICS = Registry()
+
+METRICS.describe('download_bytes_total', 'Bytes downloaded from Jenkins')
+METRICS.describe('download_seconds', 'Duration of a tar.gz download')
+METRICS.describe('untar_seconds', 'Duration of a tar.gz extraction')
+METRICS.describe('parsed_lines_total', 'Documents produced by a parser')
+METRICS.describe('parse_seconds_total', 'Time spent parsing, json serialization excluded')
+METRICS.describe('serialize_seconds_total', 'Time spent serializing documents to json')
+METRICS.describe('bulk_documents', 'Documents per bulk request')
+METRICS.describe('bulk_seconds', 'Bulk request latency')
+METRICS.describe('bulk_rejected_total', 'Documents rejected by elasticsearch')
+METRICS.describe('function_seconds', 'Duration of a timed function')
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    @goal: observe the duration of a block in a histogram
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        METRICS.histogram(name, **labels).observe(time.time() - start)
+
+
+def timed(name='function_seconds', **labels):
+    """
+    @goal: decorator, observe the duration of each call in a histogram
+           (function label set to the function name)
+    """
+    def decorator(func):
+        histogram_labels = dict(labels)
+        histogram_labels.setdefault('function', func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.histogram(name, **histogram_labels).observe(time.time() - start)
+        return wrapper
+    return decorator
+
+
+def count_parsed(documents, parser_name, parser_c=None):
+    """
+    @goal: count documents of a parser generator and the time spent in it
+           (not in the consumer), totals are recorded once exhausted
+    @param documents: parser generator
+    @param parser_name: parser label (ckcm, octopylog...)
+    @param parser_c: parser of the generator, its serialization time is
+                     recorded apart from parsing (optional)
+    """
+    clock = time.time
+    count = 0
+    elapsed = 0.0
+    iterator = iter(documents)
+    try:
+        while True:
+            start = clock()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                elapsed += clock() - start
+                return
+            elapsed += clock() - start
+            count += 1
+            yield data
+    finally:
+        serialize_seconds = parser_c.serialize_seconds if parser_c is not None else 0.0
+        record_parsed(parser_name, count, elapsed - serialize_seconds, serialize_seconds)
+
+
+def record_parsed(parser_name, count, seconds, serialize_seconds=0.0):
+    """
+    @goal: record documents parsed out of process (pool workers)
+    @param seconds: parsing time, serialization excluded
+    @param serialize_seconds: json serialization time
+    """
+    METRICS.counter('parsed_lines_total', parser=parser_name).inc(count)
+    METRICS.counter('parse_seconds_total', parser=parser_name).inc(seconds)
+    if serialize_seconds:
+        METRICS.counter('serialize_seconds_total', parser=parser_name).inc(serialize_seconds)
+
+
+def summary():
+    """
+    @goal: one line per stage, rates derived from the counters
+    @return list of strings
+    """
+    data = METRICS.to_json()
+    lines = []
+    downloaded = sum(s['value'] for s in data.get('download_bytes_total', []))
+    download_seconds = sum(s['sum'] for s in data.get('download_seconds', []))
+    if download_seconds:
+        lines.append('download: %d bytes, %.0f bytes/s' % (downloaded,
+                                                           downloaded / download_seconds))
+    for sample in data.get('untar_seconds', []):
+        lines.append('untar: %d archives, %.2f s' % (sample['count'], sample['sum']))
+    seconds = dict((s['labels']['parser'], s['value'])
+                   for s in data.get('parse_seconds_total', []))
+    for sample in data.get('parsed_lines_total', []):
+        parser_name = sample['labels']['parser']
+        rate = sample['value'] / seconds[parser_name] if seconds.get(parser_name) else 0
+        lines.append('parse %s: %d lines, %.0f lines/s' % (parser_name, sample['value'], rate))
+    for sample in data.get('serialize_seconds_total', []):
+        lines.append('serialize %s: %.2f s' % (sample['labels']['parser'], sample['value']))
+    for sample in data.get('bulk_seconds', []):
+        if sample['count']:
+            lines.append('bulk: %d requests, %.3f s mean latency'
+                         % (sample['count'], sample['sum'] / sample['count']))
+    for sample in data.get('bulk_documents', []):
+        if sample['count']:
+            lines.append('bulk: %.0f documents per request'
+                         % (float(sample['sum']) / sample['count']))
+    for sample in data.get('bulk_rejected_total', []):
+        lines.append('bulk: %d rejected (status %s)' % (sample['value'],
+                                                        sample['labels'].get('status')))
+    return lines
+
+
+def export(file_path=None):
+    """
+    @goal: write metrics to a file, prometheus text format if the file
+           name ends with .prom, json otherwise
+    @param file_path: output file (nothing written if None)
+    @return summary lines
+    """
+    import json
+
+    if file_path:
+        with open(file_path, 'w') as metrics_file:
+            if file_path.endswith('.prom'):
+                metrics_file.write(METRICS.to_prometheus())
+            else:
+                json.dump(METRICS.to_json(), metrics_file, indent=1, sort_keys=True)
+    return summary()
@@ -6,11 +6,63 @@ __copyright__ = "Copyright 2015, Parrot"
 
 #imports
 import os
+import json
+import time
 import log
-import mysql.connector as mysql
+from itertools import izip
 from datetime import datetime
 
 from src.com import logger
+from src.com import read_lines
+
+# Number of rows fetched at once from MySQL
+MYSQL_FETCH_SIZE = 1000
+
+# Number of octopylog frames split at once (log.split_octopylog_lines)
+OCTOPYLOG_BATCH_SIZE = 1000
+
+def document_id(file_name, line_offset):
+    '''
+    Deterministic document id: re-indexing a line overwrites it
+    '''
+    return u'%s:%d' % (file_name, line_offset)
+
+
+class DocumentBuilder(object):
+    '''
+    Build the documents of one file: constant fields and index time are
+    formatted once, documents are optionally serialized to json strings
+    (sent as is by the elasticsearch bulk helpers), serialize_seconds is
+    the time spent serializing them
+    '''
+    def __init__(self, serialize=False, **constants):
+        self.serialize = serialize
+        self.serialize_seconds = 0.0
+        self.constants = dict((key, u'%s' % value) for key, value in constants.items())
+        self.constants['author'] = u'jenkins'
+        self.constants['index_time'] = u'%s' % datetime.now().isoformat()
+        # '{"constant": ..., ' : closed by the variable fields
+        self._json_prefix = json.dumps(self.constants, ensure_ascii=False)[:-1] + u', '
+
+    def build(self, fields, doc_id=None):
+        '''
+        @param fields: line fields
+        @param doc_id: document id (optional)
+        @return document dictionary, or json string if serialize is set
+        '''
+        if self.serialize:
+            start = time.time()
+            source = self._json_prefix + json.dumps(fields, ensure_ascii=False)[1:]
+            self.serialize_seconds += time.time() - start
+            if doc_id is None:
+                return source
+            return {'_id': doc_id, '_source': source}
+        data = self.constants.copy()
+        data.update(fields)
+        if doc_id is not None:
+            data['_id'] = doc_id
+        return data
+
 
 class LogParser(object):
     '''
@@ -18,6 +70,7 @@ class LogParser(object):
     '''
     def __init__(self):
         self.type = 'generic'
+        self.serialize_seconds = 0.0
 
     def parse(self, data):
         raise NotImplementedError('No parse method')
@@ -26,90 +79,155 @@ class CkcmParser(LogParser):
     """
     Inherit from LogParser
     """
-    def __init__(self):
+    def __init__(self, serialize=False):
         self.type = 'ckcm'
+        self.serialize = serialize
+        # Json serialization time of the parsed files (not parsing)
+        self.serialize_seconds = 0.0
 
-    def parse(self, ckcm_file_path, version=None, module=None):
+    def parse(self, ckcm_file_path, version=None, module=None, offset=None, rollup=None,
+              id_prefix=None, **fields):
         '''
         wxCKCM parser
-        @param ckcm_file_path: wxCKCM file path
+        @param ckcm_file_path: wxCKCM file path, or named file object
+        @param offset: byte offset where to start parsing, if set documents
+                       get a deterministic '_id' (file name and line offset)
+        @param id_prefix: prefix of the '_id' (build of a shared index)
+        @param rollup: Rollup counting the parsed lines (optional)
+        @param fields: other fields of every document (build, config...)
         @return test_name: file script name
         @return parsed_trace: ckcm formatted traces
         '''
         #Read ckcm file
-        test_title = "_".join(os.path.basename(ckcm_file_path).split("_")[:-2])
+        file_name = os.path.basename(getattr(ckcm_file_path, 'name', ckcm_file_path))
+        test_title = "_".join(file_name.split("_")[:-2])
+        line_offset = offset or 0
+        id_name = file_name if id_prefix is None else u'%s:%s' % (id_prefix, file_name)
+        # One record per file, fed line by line
+        ckcm_line = log.CkcmLog()
+        builder = DocumentBuilder(self.serialize, test=test_title,
+                                  module=module, version=version, **fields)
 
         # Loop on ckcm file
-        with open(ckcm_file_path) as ckcm_file:
-            ckcm_content = ckcm_file.read()
-
-        for line in ckcm_content.split('\n'):
-            # Ensure first character is a '[' (timestamp)
-            if line.startswith("["):
-                ckcm_line = log.CkcmLog()
-                try:
-                    ckcm_line.data = line.decode('utf8')
-                    # one line log = one data dictionary 
-                    data = {
-                        'author': u'jenkins',
-                        'test': u"%s" % test_title,
-                        'severity': u"%s" % ckcm_line.severity,
-                        'text': u"%s" % ckcm_line.data,
-                        'library': u'%s' % ckcm_line.library,
-                        'ATCommand': u'%s' % ckcm_line.command, 
-                        'ATEvent': u'%s' % ckcm_line.event,
-                        'index_time': u'%s' % datetime.now().isoformat(),
-                        'module': u"%s" % module,
-                        'version': u'%s' % version
-                          }
-                    yield data
-                except UnicodeDecodeError:
-                    logger.error(UnicodeDecodeError)
+        try:
+            for line in read_lines(ckcm_file_path, offset=line_offset):
+                position = line_offset
+                line_offset += len(line) + 1
+                # Ensure first character is a '[' (timestamp)
+                if line.startswith("["):
+                    try:
+                        ckcm_line.data = line.decode('utf8')
+                        if rollup is not None:
+                            # '[HH:MM:SS.mmm]...'
+                            rollup.add(test_title, ckcm_line.severity, ckcm_line.library,
+                                       line[1:line.find(']')])
+                        # one line log = one document
+                        yield builder.build({
+                            'severity': u"%s" % ckcm_line.severity,
+                            'text': u"%s" % ckcm_line.data,
+                            'library': u'%s' % ckcm_line.library,
+                            'ATCommand': u'%s' % ckcm_line.command,
+                            'ATEvent': u'%s' % ckcm_line.event
+                            }, None if offset is None else document_id(id_name, position))
+                    except UnicodeDecodeError:
+                        logger.error(UnicodeDecodeError)
+        finally:
+            self.serialize_seconds += builder.serialize_seconds
 
 class OctopylogParser(LogParser):
     """
     Inherit from LogParser
     """
-    def __init__(self, pytestemb_version):
+    def __init__(self, pytestemb_version, serialize=False):
         self.type = 'octopylog'
         self.pytestemb_version = pytestemb_version
+        self.serialize = serialize
+        # Json serialization time of the parsed files (not parsing)
+        self.serialize_seconds = 0.0
 
-    def parse(self, ctp_file_path, version=None, module=None):
+    def parse(self, ctp_file_path, version=None, module=None, offset=None, rollup=None,
+              id_prefix=None, **fields):
         """
         CTP parser
-        @param ctp_file_path: wxCKCM file path
+        @param ctp_file_path: wxCKCM file path, or named file object
+        @param offset: byte offset where to start parsing, if set documents
+                       get a deterministic '_id' (file name and line offset)
+        @param id_prefix: prefix of the '_id' (build of a shared index)
+        @param rollup: Rollup counting the parsed lines (optional), message
+                       type as severity
+        @param fields: other fields of every document (build, config...)
         @return test_name: file script name
         @return parsed_trace: octopylog formatted traces
         """
         #Read octopylog file
-        test_title = "_".join(os.path.basename(ctp_file_path).split("_")[:-1])
-        
-        with open(ctp_file_path) as ctp_file:
-            ctp_content = ctp_file.read()
-
-        # Loop on octopylog file
-        for line in ctp_content.split('\n'):
-            # Ensure first character is a digit (timestamp)
-            if line and line[0].isdigit():
-
-                ctp_line = log.OctopylogLog(self.pytestemb_version)
-
-                try:
-                    ctp_line.data = line.decode('utf8')
-                    # one line log = one data dictionary 
-                    data = {
-                        'author': u'jenkins',
-                        'test': u"%s" % test_title,
-                        'text': u"%s" % ctp_line.message,
-                        'timestamp': u"%s" % ctp_line.timestamp,
-                        'library': u"%s" % ctp_line.message_type,
-                        'index_time': 'u%s' % datetime.now().isoformat(),
-                        'version': u'%s' % version,
-                        'module': u'%s' % module
-                          }
-                    yield data
-                except UnicodeDecodeError:
-                    logger.error(UnicodeDecodeError)
+        file_name = os.path.basename(getattr(ctp_file_path, 'name', ctp_file_path))
+        test_title = "_".join(file_name.split("_")[:-1])
+        line_offset = offset or 0
+        id_name = file_name if id_prefix is None else u'%s:%s' % (id_prefix, file_name)
+        first_field_position = log.get_octopylog_format(self.pytestemb_version)[2]
+        builder = DocumentBuilder(self.serialize, test=test_title,
+                                  module=module, version=version, **fields)
+
+        def documents(positions, lines):
+            ''' documents of a batch of frames, split at once '''
+            try:
+                columns = log.split_octopylog_lines(lines, first_field_position)
+                frames = zip(columns['timestamp'], columns['message_type'], columns['message'])
+            except IndexError:
+                # frame without timestamp: frames before it are yielded
+                # first, as when split one by one
+                frames = (log.split_octopylog_line(line, first_field_position) for line in lines)
+            for position, (timestamp, message_type, message) in izip(positions, frames):
+                if rollup is not None:
+                    rollup.add(test_title, (message_type or u'').lower(),
+                               message_type, timestamp)
+                # one line log = one document
+                yield builder.build({
+                    'text': u"%s" % message,
+                    'timestamp': u"%s" % timestamp,
+                    'library': u"%s" % message_type
+                    }, None if offset is None else document_id(id_name, position))
+
+        # Loop on octopylog file, frames split by batches
+        positions = []
+        lines = []
+        try:
+            for line in read_lines(ctp_file_path, offset=line_offset):
+                position = line_offset
+                line_offset += len(line) + 1
+                # Ensure first character is a digit (timestamp)
+                if line and line[0].isdigit():
+                    try:
+                        lines.append(line.decode('utf8'))
+                        positions.append(position)
+                    except UnicodeDecodeError:
+                        logger.error(UnicodeDecodeError)
+                    if len(lines) >= OCTOPYLOG_BATCH_SIZE:
+                        for data in documents(positions, lines):
+                            yield data
+                        positions = []
+                        lines = []
+            for data in documents(positions, lines):
+                yield data
+        finally:
+            self.serialize_seconds += builder.serialize_seconds
+
+
+def get_parser(log_type, pytestemb_version=None, serialize=False):
+    '''
+    Build the parser matching a log type
+    @param log_type: ckcm or octopylog
+    @param pytestemb_version: pytestemb version (octopylog only)
+    @param serialize: parser yields json documents
+    @return parser_c: parser instance
+    '''
+    if log_type == 'ckcm':
+        parser_c = CkcmParser(serialize=serialize)
+    elif log_type == 'octopylog':
+        parser_c = OctopylogParser(pytestemb_version, serialize=serialize)
+    else:
+        raise ValueError('log type must be one of ckcm, octopylog: %s' % log_type)
+    return parser_c
 
 
 class MySQLParser(LogParser):
@@ -117,32 +235,65 @@ class MySQLParser(LogParser):
     Inherit from LogParser
     """
     def __init__(self, server, user, password, database, table):
+        import mysql.connector as mysql
+
         self.type = 't_table'
         self.pytestemb_version = table
         self.user = user
         self.password = password
         self.server = server
         self.table = table
+        self.high_water_mark = None
         self.cur_db = mysql.connect(user=user,
                                     password=password,
                                     host=server,
                                     database=database)
 
-    def parse(self):
-        columns = """SHOW COLUMNS FROM {0}""".format(self.table)
-        cursor = self.cur_db.cursor(buffered=True)
-        cursor.execute(columns)
-        columns = cursor.fetchall()
-        columns = [column[0] for column in columns]
-        query = """SELECT * from {0}""".format(self.table)
+    def parse(self, batch_size=MYSQL_FETCH_SIZE, key=None, since=None):
+        '''
+        MySQL table parser, rows are streamed by batches (unbuffered cursor)
+        @param batch_size: number of rows fetched at once
+        @param key: high-water mark column (primary key or timestamp),
+                    rows are read in key order
+        @param since: incremental mode, only rows with key > since are read
+        @return data: one dictionary per row
+        '''
+        import mysql.connector as mysql
 
         cursor = self.cur_db.cursor(buffered=True)
-        cursor.execute(query)
-        results = cursor.fetchall()
-        print len(results)
-        for index, result in enumerate(results):
-            data = {col: res for col, res in zip(columns, result)}
-            if index % 1000 == 0:
-                print index
-                print data
-            yield data
\ No newline at end of file
+        cursor.execute("""SHOW COLUMNS FROM {0}""".format(self.table))
+        columns = [column[0] for column in cursor.fetchall()]
+        cursor.close()
+
+        query = """SELECT * FROM {0}""".format(self.table)
+        params = ()
+        if key:
+            key_position = columns.index(key)
+            if since is not None:
+                query += """ WHERE {0} > %s""".format(key)
+                params = (since,)
+            query += """ ORDER BY {0}""".format(key)
+        self.high_water_mark = since
+
+        cursor = self.cur_db.cursor(buffered=False)
+        try:
+            cursor.execute(query, params)
+            count = 0
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    if key:
+                        self.high_water_mark = row[key_position]
+                    yield dict(zip(columns, row))
+                count += len(rows)
+                logger.debug("%s: %d rows read", self.table, count)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            # Generator abandoned early (bulk error): closing the cursor with
+            # rows left unread raises "Unread result found"
+            try:
+                if self.cur_db.unread_result:
+                    self.cur_db.consume_results()
+                cursor.close()
+            except mysql.Error as exc:
+                logger.warning("%s: cursor not closed: %s", self.table, exc)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Optional profiling of the indexing stages (cProfile or sampling) """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Module imports
+from src.com import logger
+
+# Profiling output directory, profiling disabled if not set
+PROFILE_ENV = 'PARSELOG_PROFILE'
+
+# Profiling mode: cprofile (pstats files) or sample (flamegraph folded stacks)
+PROFILE_MODE_ENV = 'PARSELOG_PROFILE_MODE'
+PROFILE_MODES = ('cprofile', 'sample')
+
+# Sampling period, seconds
+SAMPLE_INTERVAL = 0.005
+
+# Folded stacks file written in sample mode (flamegraph.pl input)
+FOLDED_FILE_NAME = 'profile.folded'
+
+_PROFILER = None
+
+
+def profile_label(es_index, file_path):
+    """
+    @goal: label of a trace file profile, files of the same name from other
+           builds or configs get their own profile
+    @param es_index: build index of the file
+    @param file_path: trace file path, or named file object
+    """
+    return '%s/%s' % (es_index, os.path.basename(getattr(file_path, 'name', file_path)))
+
+
+def _label_path(label):
+    """ relative path of a label: 'build/file' labels give a directory per build """
+    parts = [part for part in str(label).split('/') if part not in ('', '.', '..')]
+    return os.path.join(*parts or ['_'])
+
+
+class StageProfiler(object):
+    """
+    cProfile per stage: stages may nest (parsing consumed by bulk requests),
+    only the innermost stage of a thread is profiled, so time is attributed
+    to one stage only
+    """
+    mode = 'cprofile'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._local = threading.local()
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name, label, profile=None):
+        import cProfile
+
+        stack = self._stack()
+        if stack:
+            stack[-1][0].disable()
+        if profile is None:
+            profile = cProfile.Profile()
+        stack.append((profile, name, label))
+        profile.enable()
+
+    def _exit(self, store=True):
+        stack = self._stack()
+        profile, name, label = stack.pop()
+        profile.disable()
+        if store:
+            self._store(profile, name, label)
+        if stack:
+            stack[-1][0].enable()
+
+    def _store(self, profile, name, label):
+        """ keep a stage profile for dump, or write it if labelled """
+        if label is None:
+            with self._lock:
+                self._profiles.setdefault(name, []).append(profile)
+        else:
+            # one file per label (trace file, table...), written right away,
+            # numbered if the label was already profiled (build run twice)
+            file_path = os.path.join(self.directory, name, _label_path(label))
+            with self._lock:
+                if not os.path.isdir(os.path.dirname(file_path)):
+                    os.makedirs(os.path.dirname(file_path))
+                number = 0
+                profile_path = file_path + '.prof'
+                while os.path.exists(profile_path):
+                    number += 1
+                    profile_path = '%s.%d.prof' % (file_path, number)
+                profile.dump_stats(profile_path)
+
+    @contextmanager
+    def stage(self, name, label=None):
+        self._enter(name, label)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def iterate(self, iterable, name, label=None):
+        """
+        profile the iterable only, not its consumer: one profile enabled
+        around each item, stored once the iterable is exhausted or closed
+        """
+        import cProfile
+
+        profile = cProfile.Profile()
+        iterator = iter(iterable)
+        try:
+            while True:
+                self._enter(name, label, profile)
+                try:
+                    data = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit(store=False)
+                yield data
+        finally:
+            self._store(profile, name, label)
+
+    def dump(self):
+        """
+        @goal: write one pstats file per stage, profiles of all threads merged
+        """
+        import pstats
+
+        with self._lock:
+            profiles, self._profiles = self._profiles, {}
+        for name, stage_profiles in profiles.items():
+            stats = pstats.Stats(stage_profiles[0])
+            for profile in stage_profiles[1:]:
+                stats.add(profile)
+            file_path = os.path.join(self.directory, name + '.prof')
+            stats.dump_stats(file_path)
+            logger.info("Profile: %s", file_path)
+
+
+class SamplingProfiler(object):
+    """
+    Sampling of the threads running a stage, stacks are written folded
+    (stage;function;function count) for flamegraph tools. Only the threads
+    of the main process are sampled: forked parsing processes (workers > 1,
+    index_configs) are not, use cprofile mode to profile them
+    """
+    mode = 'sample'
+
+    def __init__(self, directory, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.counts = {}
+        self._stages = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for thread_id, stages in self._stages.items():
+                frame = frames.get(thread_id)
+                if not stages or frame is None:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append('%s (%s:%d)' % (code.co_name,
+                                                     os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(stages + functions[::-1])
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name='profiler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    @contextmanager
+    def stage(self, name, label=None):
+        self._start()
+        thread_id = threading.current_thread().ident
+        stages = self._stages.setdefault(thread_id, [])
+        stages.append(name if label is None else '%s:%s' % (name, label))
+        try:
+            yield
+        finally:
+            stages.pop()
+
+    def iterate(self, iterable, name, label=None):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, label):
+                try:
+                    data = next(iterator)
+                except StopIteration:
+                    return
+            yield data
+
+    def dump(self):
+        """
+        @goal: write the folded stacks sampled so far
+        """
+        file_path = os.path.join(self.directory, FOLDED_FILE_NAME)
+        counts = dict(self.counts)
+        with open(file_path, 'w') as folded:
+            for key, count in sorted(counts.items()):
+                folded.write('%s %d\n' % (key, count))
+        logger.info("Profile: %s (%d samples)", file_path, sum(counts.values()))
+
+
+def enable_profiling(directory, mode='cprofile'):
+    """
+    @goal: profile the indexing stages from now on
+    @param directory: output directory of profiles
+    @param mode: cprofile or sample (main process only, see SamplingProfiler)
+    @return profiler
+    """
+    global _PROFILER
+
+    if mode not in PROFILE_MODES:
+        raise ValueError('profiling mode must be one of %s' % ', '.join(PROFILE_MODES))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if mode == 'sample':
+        _PROFILER = SamplingProfiler(directory)
+    else:
+        _PROFILER = StageProfiler(directory)
+    return _PROFILER
+
+
+def get_profiler():
+    """
+    @return profiler, None when profiling is disabled
+    """
+    if _PROFILER is None and os.environ.get(PROFILE_ENV):
+        enable_profiling(os.environ[PROFILE_ENV],
+                         os.environ.get(PROFILE_MODE_ENV, 'cprofile'))
+    return _PROFILER
+
+
+@contextmanager
+def _no_profile():
+    yield
+
+
+def profile_stage(name, label=None):
+    """
+    @goal: context manager profiling a stage (nothing if profiling disabled)
+    @param name: stage name (download, untar, versions, parse, bulk...)
+    @param label: profile this occurrence separately (trace file name...)
+    """
+    profiler = get_profiler()
+    if profiler is None:
+        return _no_profile()
+    return profiler.stage(name, label)
+
+
+def profile_iter(iterable, name, label=None):
+    """
+    @goal: profile the production of each item of an iterable (parser
+           generator), not its consumer
+    """
+    profiler = get_profiler()
+    if profiler is None:
+        return iterable
+    return profiler.iterate(iterable, name, label)
+
+
+def dump_profiles():
+    """
+    @goal: write the profiles collected so far
+    """
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.dump()
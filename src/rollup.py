@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Rollup statistics of traces, accumulated while parsing """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import json
+
+# Severities counted as errors (octopylog message types lower-cased)
+ERROR_SEVERITIES = frozenset(('error', 'critical'))
+
+# Characters of a 'HH:MM:SS.mmm' timestamp kept as time bucket: one per minute
+TIME_BUCKET_SIZE = 5
+
+
+class Rollup(object):
+    """
+    Line counts of one build (or file) per test, severity and library,
+    per time bucket and severity, first and last timestamp per test
+    """
+    def __init__(self):
+        # (test, severity, library) -> lines
+        self.counts = {}
+        # (time bucket, severity) -> lines
+        self.buckets = {}
+        # test -> [first timestamp, last timestamp]
+        self.tests = {}
+
+    def add(self, test, severity, library, timestamp=None):
+        """
+        @goal: count one line
+        @param timestamp: 'HH:MM:SS...' time of day, not bucketed if None
+        """
+        key = (test, severity, library)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if not timestamp:
+            return
+        key = (timestamp[:TIME_BUCKET_SIZE], severity)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        span = self.tests.get(test)
+        if span is None:
+            self.tests[test] = [timestamp, timestamp]
+        elif timestamp < span[0]:
+            span[0] = timestamp
+        elif timestamp > span[1]:
+            span[1] = timestamp
+
+    def merge(self, other):
+        """
+        @goal: add the counts of another rollup (other file, former run)
+        """
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        for test, (first, last) in other.tests.items():
+            span = self.tests.setdefault(test, [first, last])
+            span[0] = min(span[0], first)
+            span[1] = max(span[1], last)
+        return self
+
+    def subtract(self, other):
+        """
+        @goal: remove the counts of another rollup (line counted twice),
+               test spans are kept
+        """
+        for counts, other_counts in ((self.counts, other.counts),
+                                     (self.buckets, other.buckets)):
+            for key, count in other_counts.items():
+                count = counts.get(key, 0) - count
+                if count > 0:
+                    counts[key] = count
+                else:
+                    counts.pop(key, None)
+        return self
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def test_lines(self):
+        """
+        @return {test: (lines, errors)}
+        """
+        lines = {}
+        for (test, severity, _), count in self.counts.items():
+            total, errors = lines.get(test, (0, 0))
+            if severity in ERROR_SEVERITIES:
+                errors += count
+            lines[test] = (total + count, errors)
+        return lines
+
+    def documents(self, key, fields=None):
+        """
+        @goal: summary documents, ids derived from key so that a new run
+               of the build overwrites them
+        @param key: build key (build index name)
+        @param fields: fields of every document (module, version, build...)
+        @return documents list
+        """
+        fields = dict(fields or {}, rollup_key=key)
+        documents = []
+        for (test, severity, library), count in sorted(self.counts.items()):
+            documents.append(dict(fields, _id=u'%s:count:%s:%s:%s' % (key, test, severity, library),
+                                  kind='count', test=test, severity=severity,
+                                  library=library, count=count))
+        for (bucket, severity), count in sorted(self.buckets.items()):
+            documents.append(dict(fields, _id=u'%s:time:%s:%s' % (key, bucket, severity),
+                                  kind='time', bucket=bucket, severity=severity, count=count))
+        for test, (lines, errors) in sorted(self.test_lines().items()):
+            first, last = self.tests.get(test, (None, None))
+            documents.append(dict(fields, _id=u'%s:test:%s' % (key, test),
+                                  kind='test', test=test, lines=lines, errors=errors,
+                                  first=first, last=last))
+        return documents
+
+    def to_json(self):
+        """
+        @return json serializable dictionary (tuple keys as lists)
+        """
+        return {'counts': [list(key) + [count] for key, count in sorted(self.counts.items())],
+                'buckets': [list(key) + [count] for key, count in sorted(self.buckets.items())],
+                'tests': self.tests}
+
+    @classmethod
+    def from_json(cls, data):
+        rollup = cls()
+        rollup.counts = dict((tuple(row[:-1]), row[-1]) for row in data.get('counts', []))
+        rollup.buckets = dict((tuple(row[:-1]), row[-1]) for row in data.get('buckets', []))
+        rollup.tests = dict((test, list(span)) for test, span in data.get('tests', {}).items())
+        return rollup
+
+
+def load_rollup(file_path):
+    """
+    @goal: read a rollup saved by save_rollup
+    @return Rollup, empty if the file does not exist
+    """
+    if not os.path.isfile(file_path):
+        return Rollup()
+    with open(file_path) as rollup_file:
+        return Rollup.from_json(json.load(rollup_file))
+
+
+def save_rollup(rollup, file_path):
+    """
+    @goal: write a rollup as json
+    """
+    with open(file_path, 'w') as rollup_file:
+        json.dump(rollup.to_json(), rollup_file, indent=1, sort_keys=True)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Local index and query engine over parsed traces """
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import re
+import json
+import zlib
+import bisect
+import fnmatch
+import binascii
+import cPickle as pickle
+from array import array
+
+# Module imports
+import src.parser as parser
+from src.com import logger
+from src.com import init_logging
+
+# Fields with a bitmap index (exact value lookups)
+BITMAP_FIELDS = ('severity', 'library', 'test')
+
+# Field with an inverted index (tokens lookups)
+TEXT_FIELD = 'text'
+
+# Max number of documents of a segment (bounds memory while building)
+SEGMENT_MAX_DOCS = 1000 * 1000
+
+# Terms per block of the term file, the first term of each block is kept
+# in memory (sparse index): a lookup reads one block
+TERMS_BLOCK_SIZE = 128
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Segment files
+DOCS_FILE = 'docs.jsonl'
+OFFSETS_FILE = 'offsets.bin'
+TERMS_FILE = 'terms.txt'
+TERMS_INDEX_FILE = 'terms_index.pickle'
+POSTINGS_FILE = 'postings.bin'
+BITMAPS_FILE = 'bitmaps.pickle'
+META_FILE = 'meta.json'
+
+
+def tokenize(text):
+    """
+    @goal: lower case word tokens of a text
+    @return set of tokens
+    """
+    return set(token.lower() for token in _TOKEN_RE.findall(text or u''))
+
+
+def bitmap_from_ids(doc_ids, size):
+    """
+    @goal: bitmap (bytearray, bit i set for document i) of document ids
+    """
+    bitmap = bytearray((size + 7) // 8)
+    for doc_id in doc_ids:
+        bitmap[doc_id >> 3] |= 1 << (doc_id & 7)
+    return bitmap
+
+
+def bitmap_to_int(bitmap):
+    """
+    @goal: bitmap as an integer, to combine bitmaps with & in one operation
+    """
+    return int(binascii.hexlify(bytes(bitmap[::-1])) or '0', 16)
+
+
+# Bits set in each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (1 << bit)) for value in range(256)]
+
+
+def int_to_ids(value):
+    """
+    @goal: document ids of the bits set in an integer bitmap
+    @return sorted ids
+    """
+    doc_ids = []
+    hexa = '%x' % value
+    if len(hexa) % 2:
+        hexa = '0' + hexa
+    bitmap = bytearray(binascii.unhexlify(hexa))[::-1]
+    for position, byte in enumerate(bitmap):
+        if byte:
+            base = position << 3
+            doc_ids.extend([base + bit for bit in _BYTE_BITS[byte]])
+    return doc_ids
+
+
+class SegmentWriter(object):
+    """
+    Build one segment of a local index
+    - documents (json lines) and their offsets
+    - inverted index: sorted term file ('term position count' lines), its
+      sparse index and the posting lists of the text field
+    - zlib compressed bitmaps of BITMAP_FIELDS values
+    """
+    def __init__(self, path, name):
+        os.makedirs(path)
+        self.path = path
+        self.name = name
+        self.count = 0
+        self._docs = open(os.path.join(path, DOCS_FILE), 'wb')
+        self._offsets = array('L')
+        self._postings = {}
+        self._values = dict((field, {}) for field in BITMAP_FIELDS)
+
+    def add(self, data):
+        """
+        @goal: add a document dictionary to the segment
+        """
+        doc_id = self.count
+        self._offsets.append(self._docs.tell())
+        self._docs.write(json.dumps(data) + '\n')
+        for token in tokenize(data.get(TEXT_FIELD)):
+            self._postings.setdefault(token, array('I')).append(doc_id)
+        for field in BITMAP_FIELDS:
+            self._values[field].setdefault(data.get(field), array('I')).append(doc_id)
+        self.count += 1
+
+    def close(self):
+        """
+        @goal: write index files of the segment
+        """
+        self._docs.close()
+        with open(os.path.join(self.path, OFFSETS_FILE), 'wb') as offsets_c:
+            self._offsets.tofile(offsets_c)
+
+        terms_index = []
+        position = 0
+        with open(os.path.join(self.path, POSTINGS_FILE), 'wb') as postings_c, \
+             open(os.path.join(self.path, TERMS_FILE), 'wb') as terms_c:
+            # utf8 byte order, the order of the lookups
+            terms = sorted((token.encode('utf8'), token) for token in self._postings)
+            for number, (term, token) in enumerate(terms):
+                if number % TERMS_BLOCK_SIZE == 0:
+                    terms_index.append((term, terms_c.tell()))
+                doc_ids = self._postings[token]
+                doc_ids.tofile(postings_c)
+                terms_c.write('%s %d %d\n' % (term, position, len(doc_ids)))
+                position += len(doc_ids)
+        with open(os.path.join(self.path, TERMS_INDEX_FILE), 'wb') as terms_index_c:
+            pickle.dump(terms_index, terms_index_c, pickle.HIGHEST_PROTOCOL)
+
+        bitmaps = {}
+        for field, values in self._values.iteritems():
+            bitmaps[field] = dict((value, zlib.compress(bytes(bitmap_from_ids(doc_ids,
+                                                                             self.count))))
+                                  for value, doc_ids in values.iteritems())
+        with open(os.path.join(self.path, BITMAPS_FILE), 'wb') as bitmaps_c:
+            pickle.dump(bitmaps, bitmaps_c, pickle.HIGHEST_PROTOCOL)
+
+        with open(os.path.join(self.path, META_FILE), 'w') as meta_c:
+            json.dump({'name': self.name, 'docs': self.count}, meta_c)
+        self._postings = None
+        self._values = None
+
+
+class Segment(object):
+    """
+    Read only segment of a local index
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as meta_c:
+            meta = json.load(meta_c)
+        self.name = meta['name']
+        self.count = meta['docs']
+        self._terms_index = None
+        self._bitmaps = None
+        # (field, value) -> decompressed bitmap, reused across queries
+        self._bitmap_cache = {}
+
+    @property
+    def terms_index(self):
+        """ (first term, offset) of the term file blocks, loaded on first text query """
+        if self._terms_index is None:
+            with open(os.path.join(self.path, TERMS_INDEX_FILE), 'rb') as terms_index_c:
+                self._terms_index = pickle.load(terms_index_c)
+        return self._terms_index
+
+    def term(self, token):
+        """
+        @goal: look a token up in the term file, one block read
+        @return (posting position, count), None if no document holds it
+        """
+        term = token.encode('utf8')
+        block = bisect.bisect_right(self.terms_index, (term, float('inf'))) - 1
+        if block < 0:
+            return None
+        with open(os.path.join(self.path, TERMS_FILE), 'rb') as terms_c:
+            terms_c.seek(self.terms_index[block][1])
+            for _ in xrange(TERMS_BLOCK_SIZE):
+                line = terms_c.readline()
+                if not line:
+                    break
+                found, position, count = line.split()
+                if found == term:
+                    return int(position), int(count)
+                if found > term:
+                    break
+        return None
+
+    @property
+    def bitmaps(self):
+        """ compressed bitmaps, loaded on first field query """
+        if self._bitmaps is None:
+            with open(os.path.join(self.path, BITMAPS_FILE), 'rb') as bitmaps_c:
+                self._bitmaps = pickle.load(bitmaps_c)
+        return self._bitmaps
+
+    def postings(self, token):
+        """
+        @goal: ids of the documents holding a token
+        @return array of sorted ids
+        """
+        doc_ids = array('I')
+        term = self.term(token)
+        if term is not None:
+            position, count = term
+            with open(os.path.join(self.path, POSTINGS_FILE), 'rb') as postings_c:
+                postings_c.seek(position * doc_ids.itemsize)
+                doc_ids.fromfile(postings_c, count)
+        return doc_ids
+
+    def bitmap(self, field, value):
+        """
+        @goal: bitmap of the documents whose field equals value
+        @return bytearray, None if no document has the value
+        """
+        bitmap = self._bitmap_cache.get((field, value))
+        if bitmap is None:
+            compressed = self.bitmaps.get(field, {}).get(value)
+            if compressed is None:
+                return None
+            bitmap = self._bitmap_cache[(field, value)] = bytearray(zlib.decompress(compressed))
+        return bitmap
+
+    def documents(self, doc_ids):
+        """
+        @goal: read documents by id
+        @return document dictionary generator
+        """
+        with open(os.path.join(self.path, OFFSETS_FILE), 'rb') as offsets_c, \
+             open(os.path.join(self.path, DOCS_FILE), 'rb') as docs_c:
+            for doc_id in doc_ids:
+                offset = array('L')
+                offsets_c.seek(doc_id * offset.itemsize)
+                offset.fromfile(offsets_c, 1)
+                docs_c.seek(offset[0])
+                yield json.loads(docs_c.readline())
+
+    def search(self, text=None, **fields):
+        """
+        @goal: ids of documents holding every token of text and matching
+               every field value
+        @param text: tokens to look for in the text field
+        @param fields: {field: value} among BITMAP_FIELDS
+        @return sorted document ids
+        """
+        bitmaps = []
+        for field, value in fields.items():
+            bitmap = self.bitmap(field, value)
+            if bitmap is None:
+                return []
+            bitmaps.append(bitmap)
+
+        tokens = tokenize(text)
+        if tokens:
+            # posting lists are sorted: one token needs no intersection
+            postings = sorted((self.postings(token) for token in tokens), key=len)
+            if len(postings) == 1:
+                candidates = postings[0].tolist()
+            else:
+                candidates = set(postings[0])
+                for doc_ids in postings[1:]:
+                    candidates.intersection_update(doc_ids)
+                candidates = sorted(candidates)
+            if not bitmaps:
+                return candidates
+            mask = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                mask = bytearray(byte & other for byte, other in zip(mask, bitmap))
+            return [doc_id for doc_id in candidates if mask[doc_id >> 3] & (1 << (doc_id & 7))]
+
+        if not bitmaps:
+            return range(self.count)
+        mask = bitmap_to_int(bitmaps[0])
+        for bitmap in bitmaps[1:]:
+            mask &= bitmap_to_int(bitmap)
+        return int_to_ids(mask)
+
+
+class LocalIndex(object):
+    """
+    Local index: one directory, one sub directory per segment.
+    Segments are named after the build they come from (elastic search
+    index name) so that queries can span or select builds.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # path -> Segment: segments are never modified once written, their
+        # sparse term index and bitmaps are loaded once per LocalIndex
+        self._segments = {}
+
+    def segments(self, build='*'):
+        """
+        @goal: segments whose build name matches a glob pattern
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for segment_dir in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, segment_dir)
+            segment = self._segments.get(path)
+            if segment is None and os.path.isfile(os.path.join(path, META_FILE)):
+                segment = self._segments[path] = Segment(path)
+            if segment is not None and fnmatch.fnmatch(segment.name, build):
+                yield segment
+
+    def add_documents(self, documents, name, segment_max_docs=SEGMENT_MAX_DOCS):
+        """
+        @goal: index documents of a build, in as many segments as needed
+        @param documents: document dictionaries (parser generator)
+        @param name: build name
+        @return count: number of indexed documents
+        """
+        count = 0
+        writer = None
+        for data in documents:
+            if writer is None:
+                writer = SegmentWriter(self._new_segment_path(name), name)
+            writer.add(data)
+            count += 1
+            if writer.count >= segment_max_docs:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+        logger.info("%d documents added to local index %s (%s)", count, self.directory, name)
+        return count
+
+    def _new_segment_path(self, name):
+        """
+        @goal: unused segment directory for a build
+        """
+        number = 0
+        while os.path.exists(os.path.join(self.directory, '%s.%d' % (name, number))):
+            number += 1
+        return os.path.join(self.directory, '%s.%d' % (name, number))
+
+    def search(self, text=None, build='*', limit=100, **fields):
+        """
+        @goal: find documents across builds
+        @param text: tokens to look for in the text field (all required)
+        @param build: build name glob pattern
+        @param limit: max number of documents (None: no limit)
+        @param fields: {field: value} among BITMAP_FIELDS, e.g. severity='error'
+        @return (build name, document) generator
+        """
+        fields = dict((field, value) for field, value in fields.items() if value is not None)
+        for field in fields:
+            if field not in BITMAP_FIELDS:
+                raise ValueError("No bitmap index on field: %s" % field)
+        for segment in self.segments(build):
+            doc_ids = segment.search(text, **fields)
+            if limit is not None:
+                doc_ids = doc_ids[:limit]
+                limit -= len(doc_ids)
+            for data in segment.documents(doc_ids):
+                yield segment.name, data
+            if limit is not None and limit <= 0:
+                return
+
+
+def build_local_index(index_directory, traces_directory, name, log_type,
+                      version=None, module=None, pytestemb_version=None):
+    """
+    @goal: parse an untarred traces directory into a local index
+    @param index_directory: local index directory
+    @param traces_directory: directory of log files
+    @param name: build name (e.g. elastic search index name)
+    @return count: number of indexed documents
+    """
+    import itertools
+
+    parser_c = parser.get_parser(log_type, pytestemb_version)
+    documents = itertools.chain.from_iterable(
+        parser_c.parse(os.path.join(traces_directory, file_c), version=version, module=module)
+        for file_c in sorted(os.listdir(traces_directory)))
+    return LocalIndex(index_directory).add_documents(documents, name)
+
+
+def main(argv=None):
+    """
+    Command line: build a local index or query it
+    """
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    commands = arg_parser.add_subparsers(dest='command')
+
+    build_cmd = commands.add_parser('build', help='index a traces directory')
+    build_cmd.add_argument('index_directory')
+    build_cmd.add_argument('traces_directory')
+    build_cmd.add_argument('--name', required=True, help='build name')
+    build_cmd.add_argument('--log-type', default='ckcm', choices=('ckcm', 'octopylog'))
+    build_cmd.add_argument('--version')
+    build_cmd.add_argument('--module')
+    build_cmd.add_argument('--pytestemb-version')
+
+    query_cmd = commands.add_parser('query', help='search a local index')
+    query_cmd.add_argument('index_directory')
+    query_cmd.add_argument('--text')
+    query_cmd.add_argument('--severity')
+    query_cmd.add_argument('--library')
+    query_cmd.add_argument('--test')
+    query_cmd.add_argument('--build', default='*', help='build name glob pattern')
+    query_cmd.add_argument('--limit', type=int, default=100)
+
+    args = arg_parser.parse_args(argv)
+    init_logging()
+    if args.command == 'build':
+        build_local_index(args.index_directory, args.traces_directory, args.name,
+                          args.log_type, version=args.version, module=args.module,
+                          pytestemb_version=args.pytestemb_version)
+    else:
+        results = LocalIndex(args.index_directory).search(text=args.text, build=args.build,
+                                                          limit=args.limit,
+                                                          severity=args.severity,
+                                                          library=args.library,
+                                                          test=args.test)
+        for name, data in results:
+            print json.dumps({'build': name, 'document': data})
+
+
+if __name__ == "__main__":
+    main()
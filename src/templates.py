@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Online log template mining (Drain): messages are routed by token count and
+first tokens in a fixed depth prefix tree, then matched against the
+templates of the leaf; tokens differing from a template become parameters
+"""
+
+__copyright__ = "Copyright 2015, Parrot"
+
+# Generic imports
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+
+# Module imports
+from src.com import logger
+
+# Parameter placeholder of a template
+WILDCARD = u'<*>'
+
+# Prefix tree depth: root, token count, then DEPTH - 2 first tokens
+TEMPLATE_DEPTH = 4
+
+# Share of equal tokens for a message to match a template
+SIMILARITY_THRESHOLD = 0.5
+
+# Children of a tree node, further tokens share a wildcard child
+MAX_CHILDREN = 100
+
+# Templates kept (least recently matched ones dropped)
+MAX_TEMPLATES = 20000
+
+# Template tables, one json file per log type, kept between runs
+TEMPLATE_DIRECTORY = 'templates'
+
+# Tokens holding a digit are parameters (numbers, handles, addresses)
+_HAS_DIGIT = re.compile(r'\d')
+
+_MINERS = {}
+_MINERS_LOCK = threading.Lock()
+
+
+class Template(object):
+    """
+    One message shape: tokens (WILDCARD for parameters), matched lines
+    """
+    __slots__ = ('template_id', 'tokens', 'count', 'first_seen', 'leaf')
+
+    def __init__(self, template_id, tokens, count=0, first_seen=None):
+        self.template_id = template_id
+        self.tokens = tokens
+        self.count = count
+        self.first_seen = first_seen
+        self.leaf = None
+
+    @property
+    def text(self):
+        return u' '.join(self.tokens)
+
+
+def similarity(tokens, template_tokens):
+    """
+    @return (share of tokens equal to the template or parameters of it,
+             number of parameters): most parameters preferred on a tie
+    """
+    equal = 0
+    wildcards = 0
+    for token, template_token in zip(tokens, template_tokens):
+        if template_token == WILDCARD:
+            wildcards += 1
+        elif token == template_token:
+            equal += 1
+    return float(equal + wildcards) / len(tokens), wildcards
+
+
+class TemplateMiner(object):
+    """
+    Drain template miner, ids are never reused so that they are stable
+    across builds as long as the table is saved
+    """
+    def __init__(self, depth=TEMPLATE_DEPTH, threshold=SIMILARITY_THRESHOLD,
+                 max_children=MAX_CHILDREN, max_templates=MAX_TEMPLATES):
+        self.depth = depth
+        self.threshold = threshold
+        self.max_children = max_children
+        self.max_templates = max_templates
+        self.root = {}
+        # template id -> Template, least recently matched first
+        self.templates = OrderedDict()
+        self.next_id = 1
+        self._lock = threading.Lock()
+
+    def _leaf(self, tokens):
+        """ templates list of the tree leaf of a message """
+        node = self.root.setdefault(len(tokens), {})
+        for token in tokens[:self.depth - 2]:
+            if _HAS_DIGIT.search(token):
+                token = WILDCARD
+            if token not in node:
+                if len(node) >= self.max_children:
+                    token = WILDCARD
+                node = node.setdefault(token, {})
+            else:
+                node = node[token]
+        return node.setdefault(None, [])
+
+    def _add(self, template, leaf):
+        template.leaf = leaf
+        leaf.append(template)
+        self.templates[template.template_id] = template
+        while len(self.templates) > self.max_templates:
+            _, dropped = self.templates.popitem(last=False)
+            dropped.leaf.remove(dropped)
+
+    def match(self, message, source=None):
+        """
+        @goal: template of a message, created or generalized if needed
+        @param message: message text
+        @param source: first_seen label of a new template (build index)
+        @return (template id, parameters list)
+        """
+        tokens = message.split()
+        if not tokens:
+            return None, []
+        with self._lock:
+            leaf = self._leaf(tokens)
+            best = None
+            best_score = (self.threshold, -1)
+            for template in leaf:
+                score = similarity(tokens, template.tokens)
+                if score >= best_score:
+                    best, best_score = template, score
+            if best is None:
+                best = Template(self.next_id,
+                                [WILDCARD if _HAS_DIGIT.search(token) else token
+                                 for token in tokens], first_seen=source)
+                self.next_id += 1
+                self._add(best, leaf)
+            else:
+                best.tokens = [template_token if template_token == token else WILDCARD
+                               for token, template_token in zip(tokens, best.tokens)]
+                # most recently matched last
+                del self.templates[best.template_id]
+                self.templates[best.template_id] = best
+            best.count += 1
+            params = [token for token, template_token in zip(tokens, best.tokens)
+                      if template_token == WILDCARD]
+            return best.template_id, params
+
+    def mine(self, documents, log_type, source=None):
+        """
+        @goal: set template_id, params and repeat fields of parsed documents,
+               consecutive documents of the same message collapsed into the
+               first one (repeat: number of lines)
+        @param documents: document dictionaries of one file
+        @param log_type: ckcm (message after the '[time]' prefix) or octopylog
+        @param source: first_seen label of new templates (build index)
+        """
+        pending = None
+        pending_key = None
+        for data in documents:
+            text = data['text']
+            if log_type == 'ckcm':
+                text = text[text.find(']') + 1:]
+            template_id, params = self.match(text, source)
+            key = (template_id, params, data.get('severity'), data.get('library'))
+            if pending is not None and key == pending_key:
+                pending['repeat'] += 1
+                continue
+            if pending is not None:
+                yield pending
+            data['template_id'] = template_id
+            data['params'] = params
+            data['repeat'] = 1
+            pending, pending_key = data, key
+        if pending is not None:
+            yield pending
+
+    def first_seen(self, source):
+        """
+        @return ids of the templates first seen in source (new message shapes)
+        """
+        with self._lock:
+            return set(template.template_id for template in self.templates.values()
+                       if template.first_seen == source)
+
+    def to_json(self):
+        return {'next_id': self.next_id,
+                'templates': [{'id': template.template_id, 'template': template.text,
+                               'count': template.count, 'first_seen': template.first_seen}
+                              for template in self.templates.values()]}
+
+    @classmethod
+    def from_json(cls, data, **options):
+        miner = cls(**options)
+        for entry in data.get('templates', []):
+            tokens = entry['template'].split()
+            template = Template(entry['id'], tokens, entry.get('count', 0),
+                                entry.get('first_seen'))
+            miner._add(template, miner._leaf(tokens))
+        miner.next_id = max([data.get('next_id', 1)] +
+                            [template_id + 1 for template_id in miner.templates])
+        return miner
+
+
+def template_path(log_type):
+    """
+    @return template table file of a log type
+    """
+    return os.path.join(TEMPLATE_DIRECTORY, '{0}.json'.format(log_type))
+
+
+def get_template_miner(log_type):
+    """
+    @goal: template miner of a log type, shared by the jobs of the process,
+           loaded from its table on first use
+    """
+    with _MINERS_LOCK:
+        if log_type not in _MINERS:
+            miner = TemplateMiner()
+            if os.path.isfile(template_path(log_type)):
+                with open(template_path(log_type)) as table:
+                    miner = TemplateMiner.from_json(json.load(table))
+            _MINERS[log_type] = miner
+        return _MINERS[log_type]
+
+
+def save_template_miner(log_type):
+    """
+    @goal: write the template table of a log type
+    """
+    miner = get_template_miner(log_type)
+    if not os.path.isdir(TEMPLATE_DIRECTORY):
+        os.makedirs(TEMPLATE_DIRECTORY)
+    with miner._lock:
+        data = miner.to_json()
+    with _MINERS_LOCK:
+        with open(template_path(log_type), 'w') as table:
+            json.dump(data, table, indent=1)
+    logger.info("%s: %d templates saved", template_path(log_type), len(data['templates']))
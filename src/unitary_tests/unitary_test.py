@@ -3,12 +3,36 @@
 """ parselog unitary tests """
 
 import os
+import sys
+import json
+import random
+import pstats
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import BaseHTTPServer
+import StringIO
+from elasticsearch import Elasticsearch
 
 import com
 import jenkins
 import log
+import parser
 import index
+import batch
+import bulk
+import rollup
+import templates
+import profiling
+import export
+import search
+import src.com
+from src.metrics import Registry
+from src.benchmarks.fake_es import FakeElasticsearch
+from src.benchmarks import tracegen
 
 class TestJenkinsClass(unittest.TestCase):
 
@@ -32,7 +56,1230 @@ class TestJenkinsClass(unittest.TestCase):
         job = jenkins.JenkinsJob('fc6000ts', '256_Generic')
         self.assertNotEqual(job.decompressed_ckcm_tgz('/tmp'), None)
         print 'untar directory: %s' % job.decompressed_ckcm_tgz('/tmp')
-        
+
+
+class TestComModule(unittest.TestCase):
+
+    #test du module com
+
+    def setUp(self):
+        self.file_path = '/tmp/parselog_read_lines.log'
+        with open(self.file_path, 'w') as file_c:
+            file_c.write('[first]\n[second]\r\n\n[last]')
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def test_01_read_lines_chunks(self):
+        #Ensure lines are rebuilt whatever the chunk size
+        for chunk_size in (1, 3, 1024):
+            self.assertEqual(list(com.read_lines(self.file_path, chunk_size)),
+                             ['[first]', '[second]\r', '', '[last]'])
+
+    def test_02_read_lines_offset(self):
+        #File paths and file objects start at the same offset
+        with open(self.file_path, 'rb') as file_c:
+            self.assertEqual(list(com.read_lines(file_c, 3, offset=8)),
+                             list(com.read_lines(self.file_path, 3, offset=8)))
+        self.assertEqual(list(com.read_lines(StringIO.StringIO('[first]\n[last]'), offset=8)),
+                         ['[last]'])
+
+        class Unseekable(object):
+            def read(self, size=-1):
+                return ''
+        self.assertRaises(ValueError, list, com.read_lines(Unseekable(), offset=8))
+
+    def test_03_read_lines_long_line(self):
+        #Line spanning many chunks
+        line = 'x' * 1000000
+        lines = list(com.read_lines(StringIO.StringIO('[a]\n' + line + '\n[b]\n' + line), 1000))
+        self.assertEqual(lines, ['[a]', line, '[b]', line])
+
+class FakeArtifactHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Jenkins artifact stand-in: ETag validation and Range requests
+    """
+    content = 'x' * 1000 + 'y' * 1000
+    etag = '"artifact-1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == self.etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(self.content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(self.content))
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content) - start))
+        self.end_headers()
+        self.wfile.write(self.content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+
+    #test du telechargement des artifacts
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeArtifactHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/ckcm.tgz' % self.server.server_port
+        self.file_name = '/tmp/parselog_download.tgz'
+        FakeArtifactHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for file_name in (self.file_name, self.file_name + '.meta'):
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+
+    def test_01_download_then_cache(self):
+        self.assertTrue(com.download_tgz_file(self.url, self.file_name))
+        with open(self.file_name) as file_c:
+            self.assertEqual(file_c.read(), FakeArtifactHandler.content)
+        #Ensure unchanged artifact is not downloaded twice
+        self.assertFalse(com.download_tgz_file(self.url, self.file_name))
+
+    def test_02_download_resume(self):
+        #Simulate an interrupted download
+        com._save_download_meta(self.file_name + '.meta',
+                                {'url': self.url, 'etag': FakeArtifactHandler.etag,
+                                 'complete': False})
+        with open(self.file_name + '.part', 'w') as file_c:
+            file_c.write(FakeArtifactHandler.content[:1500])
+        self.assertTrue(com.download_tgz_file(self.url, self.file_name))
+        self.assertEqual(FakeArtifactHandler.requests[-1]['range'], 'bytes=1500-')
+        with open(self.file_name) as file_c:
+            self.assertEqual(file_c.read(), FakeArtifactHandler.content)
+
+    def test_03_download_complete_part(self):
+        #Simulate a download interrupted before the part file was renamed
+        com._save_download_meta(self.file_name + '.meta',
+                                {'url': self.url, 'etag': FakeArtifactHandler.etag,
+                                 'complete': False})
+        with open(self.file_name + '.part', 'w') as file_c:
+            file_c.write(FakeArtifactHandler.content)
+        self.assertTrue(com.download_tgz_file(self.url, self.file_name))
+        self.assertEqual(len(FakeArtifactHandler.requests), 1)
+        with open(self.file_name) as file_c:
+            self.assertEqual(file_c.read(), FakeArtifactHandler.content)
+
+    def test_04_download_oversized_part(self):
+        #Part file longer than the artifact: downloaded again
+        com._save_download_meta(self.file_name + '.meta',
+                                {'url': self.url, 'etag': FakeArtifactHandler.etag,
+                                 'complete': False})
+        with open(self.file_name + '.part', 'w') as file_c:
+            file_c.write(FakeArtifactHandler.content + 'z' * 10)
+        self.assertTrue(com.download_tgz_file(self.url, self.file_name))
+        self.assertNotIn('range', FakeArtifactHandler.requests[-1])
+        with open(self.file_name) as file_c:
+            self.assertEqual(file_c.read(), FakeArtifactHandler.content)
+
+
+class TestLogModule(unittest.TestCase):
+
+    #test du module log
+
+    def test_01_ckcm_line_classification(self):
+        ckcm_line = log.CkcmLog()
+        ckcm_line.data = u'[00:01][123][456][E][]RAP] rt_postBlues failure'
+        #Ensure rap tag has precedence over blues tag
+        self.assertEqual(ckcm_line.library, 'rap')
+        self.assertEqual(ckcm_line.severity, 'error')
+
+    def test_05_ckcm_library_overlapping_tags(self):
+        def library(data):
+            # first library of the precedence order with a tag in the line
+            for name, tags in log.CKCM_LIBRARY_TAGS:
+                if any(tag in data for tag in tags):
+                    return name
+            return 'unknown'
+        rand = random.Random(0)
+        lines = [tracegen.ckcm_line(rand, position) for position in range(2000)]
+        lines += [u'[00:01][1][2][I]]CCTOSoftAT_ start', u'[00:01][1][2][I]]SIVRAP x',
+                  u'[00:01][1][2][I]]TALA]SOUL]DISCO', u'[00:01][1][2][I]rt_postBluesHIPHOP',
+                  u'[00:01][1][2][I]]HSTIBT', u'[00:01][1][2][I]wxCKCM]RAP']
+        self.assertEqual(log.get_ckcm_library(u'[00:01][1][2][I]]CCTOSoftAT_ start'), 'hiphop')
+        self.assertEqual([log.get_ckcm_library(line) for line in lines],
+                         [library(line) for line in lines])
+
+    def test_02_ckcm_line_unknown(self):
+        ckcm_line = log.CkcmLog()
+        ckcm_line.data = u'[00:01] no tag'
+        self.assertEqual(ckcm_line.library, 'unknown')
+        self.assertEqual(ckcm_line.severity, None)
+
+    def test_03_octopylog_line_split(self):
+        ctp_line = log.OctopylogLog('2.2.0')
+        ctp_line.data = u'1 2 10:00:01 INFO  script   started'
+        self.assertEqual(ctp_line.timestamp, u'10:00:01')
+        self.assertEqual(ctp_line.message_type, u'INFO')
+        self.assertEqual(ctp_line.message, u'script started')
+
+    def test_04_octopylog_line_fields(self):
+        self.assertEqual(log.split_octopylog_line(u'10:00:01 INFO a', 0),
+                         (u'10:00:01', u'INFO', u'a'))
+        self.assertEqual(log.split_octopylog_line(u'10:00:01', 0), (u'10:00:01', None, u''))
+        self.assertEqual(log.split_octopylog_line(u'# comment', 0), (None, None, None))
+        self.assertRaises(IndexError, log.split_octopylog_line, u'1 2', 2)
+
+    def test_06_octopylog_lines_columns(self):
+        rand = random.Random(0)
+        lines = [tracegen.octopylog_line(rand, position).decode('utf8')
+                 for position in range(200)] + [u'# comment', u'', u'1 2 10:00:01']
+        columns = log.split_octopylog_lines(lines, 2)
+        self.assertEqual(zip(columns['timestamp'], columns['message_type'], columns['message']),
+                         [log.split_octopylog_line(line, 2) if line else (None, None, None)
+                          for line in lines])
+        self.assertRaises(IndexError, log.split_octopylog_lines, [u'1 2 10:00:01', u'1 2'], 2)
+
+    def test_07_octopylog_parser_batches(self):
+        directory = tempfile.mkdtemp()
+        batch_size = parser.OCTOPYLOG_BATCH_SIZE
+        try:
+            file_path = os.path.join(directory, 'test_000_0.log')
+            tracegen.write_octopylog_trace(file_path, 50)
+            with open(file_path, 'a') as trace:
+                trace.write('# end\n1 2\n')
+            with open(file_path) as trace:
+                expected = [log.split_octopylog_line(line.decode('utf8'), 2)
+                            for line in trace.read().splitlines()[:50]]
+            parser.OCTOPYLOG_BATCH_SIZE = 7
+            parsed = []
+            self.assertRaises(IndexError, lambda: parsed.extend(
+                parser.OctopylogParser(tracegen.PYTESTEMB_VERSION).parse(file_path, offset=0)))
+        finally:
+            parser.OCTOPYLOG_BATCH_SIZE = batch_size
+            shutil.rmtree(directory, ignore_errors=True)
+        # every frame before the bad one, in order
+        self.assertEqual([(data['timestamp'], data['library'], data['text']) for data in parsed],
+                         expected)
+
+class TestMetricsModule(unittest.TestCase):
+
+    #test du module metrics
+
+    def test_01_histogram_buckets(self):
+        registry = Registry()
+        histogram = registry.histogram('bulk_documents', (10, 100))
+        for value in (5, 50, 500):
+            histogram.observe(value)
+        sample = registry.to_json()['bulk_documents'][0]
+        self.assertEqual(sample['count'], 3)
+        self.assertEqual(sample['buckets'], [(10, 1), (100, 2)])
+
+    def test_02_prometheus_text(self):
+        registry = Registry()
+        registry.counter('parsed_lines_total', parser='ckcm').inc(3)
+        self.assertIn('parselog_parsed_lines_total{parser="ckcm"} 3',
+                      registry.to_prometheus())
+
+    def test_03_serialization_timed_apart(self):
+        import src.metrics as metrics
+        directory = tempfile.mkdtemp()
+        try:
+            file_paths = tracegen.write_trace_directory(directory, 'ckcm', 1, 200)
+            metrics.METRICS.reset()
+            parser_c = parser.get_parser('ckcm', serialize=True)
+            documents = metrics.count_parsed(parser_c.parse(file_paths[0]), 'ckcm', parser_c)
+            self.assertEqual(len(list(documents)), 200)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        data = metrics.METRICS.to_json()
+        metrics.METRICS.reset()
+        self.assertTrue(parser_c.serialize_seconds > 0)
+        self.assertEqual(data['serialize_seconds_total'][0]['value'], parser_c.serialize_seconds)
+        self.assertEqual(data['parsed_lines_total'][0]['value'], 200)
+
+class TestBatchModule(unittest.TestCase):
+
+    #test du module batch
+
+    def test_01_expand_builds(self):
+        jobs = batch.expand_jobs([{'type': 'jenkins', 'module': 'fc6000ts',
+                                   'config': '256_Generic', 'builds': [12, 13]},
+                                  {'type': 'mysql', 'table': 't_statistic'}])
+        self.assertEqual([job.spec.get('build') for job in jobs], ['12', '13', None])
+        self.assertEqual(jobs[2].name, 'mysql:t_statistic')
+
+    def test_02_invalid_job(self):
+        self.assertRaises(batch.ManifestException, batch.expand_jobs,
+                          [{'type': 'tarball', 'module': 'fc6000ts'}])
+
+    def test_03_metrics_of_the_batch(self):
+        from src.metrics import METRICS
+        import src.index
+        directory = tempfile.mkdtemp()
+        # batch runs src.index, not the index module of these tests
+        cache_directory = src.index.VERSION_CACHE_DIRECTORY
+        src.index.VERSION_CACHE_DIRECTORY = os.path.join(directory, 'versions')
+        try:
+            traces = os.path.join(directory, 'traces')
+            tracegen.write_trace_directory(traces, 'ckcm', 2, 20)
+            tgz_file = tracegen.write_tgz(traces, os.path.join(directory, 'ckcm.tgz'))
+            jobs = batch.expand_jobs([{'type': 'tarball', 'path': tgz_file, 'module': 'fc6000',
+                                       'config': 'generic', 'build': build}
+                                      for build in (12, 13)])
+            # former run in the same process
+            METRICS.counter('indexed_documents_total', index='former').inc(10)
+            with FakeElasticsearch() as fake_es:
+                reports = batch.run_jobs(jobs, {'es_hosts': [fake_es.host]}, parse_workers=0)
+        finally:
+            src.index.VERSION_CACHE_DIRECTORY = cache_directory
+            shutil.rmtree(directory, ignore_errors=True)
+        self.assertTrue(all(report.success for report in reports))
+        samples = METRICS.to_json()['indexed_documents_total']
+        METRICS.reset()
+        # trace documents and rollup documents, by document type
+        self.assertEqual(sorted(sample['labels']['log_type'] for sample in samples),
+                         ['ckcm', 'rollup'])
+        self.assertEqual([sample['value'] for sample in samples
+                          if sample['labels']['log_type'] == 'ckcm'], [2 * 41])
+
+class TestBulkModule(unittest.TestCase):
+
+    #test du module bulk
+
+    def test_01_chunk_size_adapts(self):
+        sizer = bulk.ChunkSizer(size=400, min_size=50, max_size=1000, target_seconds=1)
+        sizer.observe(400, 40000, 0.1)
+        self.assertEqual(sizer.size, 500)
+        sizer.observe(500, 50000, 0.1, rejected=True)
+        self.assertEqual(sizer.size, 250)
+        sizer.observe(250, 25000, 5)
+        self.assertEqual(sizer.size, 125)
+
+    def test_02_rejected_documents_retried(self):
+        documents = [{'text': u'line %d' % position} for position in range(2000)]
+        with FakeElasticsearch(reject_ratio=0.2, reject_request_ratio=0.1, seed=1) as node_a, \
+                FakeElasticsearch(seed=2) as node_b:
+            writer = bulk.BulkWriter(bulk.HostPool([node_a.host, node_b.host]), 'test', 'ckcm',
+                                     initial_backoff=0.001, max_backoff=0.01)
+            error_code, not_indexed = writer.write(iter(documents))
+        self.assertTrue(error_code)
+        self.assertEqual(not_indexed, [])
+        self.assertEqual(node_a.documents + node_b.documents, len(documents))
+        self.assertTrue(node_a.rejected and node_b.documents)
+
+class FakeIndices(object):
+
+    #indices api of rolled indices, creation dates in days ago
+
+    def __init__(self, days_ago, write_index):
+        now = index.time.time() * 1000
+        self.settings = dict((name, {'settings': {'index': {
+            'creation_date': str(int(now - days * 86400000))}}})
+                             for name, days in days_ago.items())
+        self.write_index = write_index
+        self.deleted = []
+
+    def get_settings(self, index=None, name=None):
+        return self.settings
+
+    def get_alias(self, name=None):
+        return {self.write_index: {'aliases': {name: {}}}}
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+class TestIndexLayout(unittest.TestCase):
+
+    #test du layout d'index roulant
+
+    def setUp(self):
+        self.es_c = type('FakeClient', (object,), {})()
+        self.es_c.indices = FakeIndices({'ckcm-traces-000001': 200, 'ckcm-traces-000002': 100,
+                                         'ckcm-traces-000003': 50, 'ckcm-traces-000004': 1},
+                                        'ckcm-traces-000004')
+
+    def test_01_retention_by_age(self):
+        # 000002 rolled over 50 days ago: kept
+        dropped = index.apply_retention(self.es_c, 'ckcm', days=90)
+        self.assertEqual(dropped, ['ckcm-traces-000001'])
+        self.assertEqual(self.es_c.indices.deleted, dropped)
+
+    def test_02_retention_never_drops_write_index(self):
+        dropped = index.apply_retention(self.es_c, 'ckcm', days=0, max_indices=0)
+        self.assertEqual(dropped, ['ckcm-traces-000001', 'ckcm-traces-000002',
+                                   'ckcm-traces-000003'])
+
+class RecordingIndices(object):
+
+    #indices api recording its calls
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+        return call
+
+class TestBulkLoad(unittest.TestCase):
+
+    #test des reglages d'index pendant le chargement
+
+    def setUp(self):
+        self.es_c = type('FakeClient', (object,), {})()
+        self.es_c.indices = RecordingIndices()
+
+    def _restored(self):
+        return [('put_settings', (index.PRODUCTION_SETTINGS,), {'index': 'ckcm_b1'}),
+                ('refresh', (), {'index': 'ckcm_b1'}),
+                ('forcemerge', (), {'index': 'ckcm_b1',
+                                    'max_num_segments': index.FORCE_MERGE_SEGMENTS,
+                                    'request_timeout': index.FORCE_MERGE_TIMEOUT})]
+
+    def test_01_create_index_bulk_settings(self):
+        index.create_index(self.es_c, 'ckcm_b1', 'ckcm')
+        self.assertEqual(self.es_c.indices.calls,
+                         [('create', ('ckcm_b1',),
+                           {'body': {'settings': index.BULK_LOAD_SETTINGS,
+                                     'mappings': {'ckcm': index.INDEX_MAPPINGS}}})])
+        self.assertEqual(index.BULK_LOAD_SETTINGS['index']['refresh_interval'], '-1')
+
+    def test_02_production_settings_restored(self):
+        with index.bulk_load(self.es_c, 'ckcm_b1'):
+            self.assertEqual(self.es_c.indices.calls,
+                             [('put_settings', (index.BULK_LOAD_SETTINGS,),
+                               {'index': 'ckcm_b1'})])
+        self.assertEqual(self.es_c.indices.calls[1:], self._restored())
+
+    def test_03_restored_on_failure(self):
+        def load():
+            with index.bulk_load(self.es_c, 'ckcm_b1'):
+                raise IOError('bulk failed')
+        self.assertRaises(IOError, load)
+        self.assertEqual(self.es_c.indices.calls[1:], self._restored())
+
+    def test_04_disabled(self):
+        with index.bulk_load(self.es_c, 'ckcm_b1', enabled=False):
+            pass
+        self.assertEqual(self.es_c.indices.calls, [])
+
+class TestDocumentBuilder(unittest.TestCase):
+
+    #test de la serialisation des documents
+
+    fields = {'severity': u'error', 'library': u'sop',
+              'text': u'[00:00:01.000][E]SOP \u00e9chec "quoted" \\ back\tslash \u2603\n',
+              'ATCommand': u'None', 'ATEvent': u'AT+CGMREX: \'V1\''}
+
+    def test_01_serialized_equals_dictionary(self):
+        builder = parser.DocumentBuilder(test=u'test_\u00e9', module='fc6000', version=None,
+                                         build=12)
+        data = builder.build(self.fields, u'test_\u00e9_0_0.log:12')
+        builder.serialize = True
+        document = builder.build(self.fields, u'test_\u00e9_0_0.log:12')
+        self.assertEqual(document['_id'], data.pop('_id'))
+        self.assertIsInstance(document['_source'], unicode)
+        self.assertEqual(json.loads(document['_source']), data)
+        self.assertEqual(json.loads(builder.build(self.fields)), data)
+
+    def test_02_serialized_parser_documents(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(directory, 'test_000_ckcm_0.log')
+            with open(file_path, 'w') as trace:
+                trace.write(u'[00:00:01.000][E]SOP \u00e9chec "%s"\n'.encode('utf8'))
+                trace.write('[00:00:02.000][1000][2000][I]]HSTI AT+CGMR\\n\n')
+            documents = list(parser.CkcmParser().parse(file_path, offset=0, build='12'))
+            serialized = list(parser.CkcmParser(serialize=True).parse(file_path, offset=0,
+                                                                      build='12'))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        self.assertEqual(len(serialized), 2)
+        for data, document in zip(documents, serialized):
+            self.assertEqual(document['_id'], data.pop('_id'))
+            source = json.loads(document['_source'])
+            self.assertEqual(source.pop('index_time')[:10], data.pop('index_time')[:10])
+            self.assertEqual(source, data)
+
+class TestParserModule(unittest.TestCase):
+
+    #test du module parser
+
+    def test_01_get_parser(self):
+        self.assertEqual(parser.get_parser('ckcm').type, 'ckcm')
+        self.assertEqual(parser.get_parser('octopylog', '2.2.0').type, 'octopylog')
+        self.assertRaises(ValueError, parser.get_parser, 'syslog')
+
+class FakeCursor(object):
+
+    #curseur mysql: colonnes, puis lignes par lots
+
+    def __init__(self, connection, rows):
+        self.connection = connection
+        self.rows = rows
+
+    def execute(self, query, params=()):
+        if not query.startswith('SHOW'):
+            self.connection.unread_result = True
+
+    def fetchall(self):
+        return [('id',), ('value',)]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        import mysql.connector as mysql
+        if self.connection.unread_result:
+            raise mysql.InternalError('Unread result found')
+
+class FakeConnection(object):
+
+    #connexion mysql: lignes non lues consommees par consume_results
+
+    unread_result = False
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, buffered=False):
+        return FakeCursor(self, list(self.rows))
+
+    def consume_results(self):
+        self.unread_result = False
+
+class TestMySQLParser(unittest.TestCase):
+
+    #test du parser mysql
+
+    def setUp(self):
+        self.parser_c = object.__new__(parser.MySQLParser)
+        self.parser_c.table = 't_statistic'
+        self.parser_c.cur_db = FakeConnection([(position, 'v') for position in range(10)])
+
+    def test_01_abandoned_generator_closes_cursor(self):
+        rows = self.parser_c.parse(batch_size=3, key='id')
+        self.assertEqual(next(rows), {'id': 0, 'value': 'v'})
+        rows.close()
+        self.assertFalse(self.parser_c.cur_db.unread_result)
+        self.assertEqual(self.parser_c.high_water_mark, 0)
+
+class TestRollingIds(unittest.TestCase):
+
+    #test des ids de deux builds dans les index roulants
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_directory = index.MANIFEST_DIRECTORY
+        index.MANIFEST_DIRECTORY = os.path.join(self.directory, 'manifests')
+
+    def tearDown(self):
+        index.MANIFEST_DIRECTORY = self.manifest_directory
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_01_builds_do_not_overwrite(self):
+        with FakeElasticsearch() as fake_es:
+            for build in ('12', '13'):
+                traces = os.path.join(self.directory, build)
+                tracegen.write_trace_directory(traces, 'ckcm', 1, 50)
+                index.index_directory(traces, 'ckcm_v1_fc6000_generic_%s' % build, 'ckcm', 'v1',
+                                      'fc6000', None, incremental=True, hosts=[fake_es.host],
+                                      layout='rolling', fields={'build': build})
+        writes = [path for method, path, documents, _ in fake_es.requests if documents]
+        self.assertTrue(all(path.startswith('/ckcm-traces-write/') or
+                            path.startswith('/ckcm-rollups/') for path in writes))
+        trace_ids = [doc_id for doc_id in fake_es.ids if ':count:' not in doc_id and
+                     ':time:' not in doc_id and ':test:' not in doc_id]
+        self.assertEqual(len(trace_ids), 2 * 51)
+        self.assertEqual(len(set(trace_ids)), len(trace_ids))
+
+class TestStreamVersions(unittest.TestCase):
+
+    #test de la detection des versions en streaming
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scan_max_size = index.STREAM_SCAN_MAX_SIZE
+        self.cache_directory = index.VERSION_CACHE_DIRECTORY
+        index.VERSION_CACHE_DIRECTORY = os.path.join(self.directory, 'versions')
+
+    def tearDown(self):
+        index.STREAM_SCAN_MAX_SIZE = self.scan_max_size
+        index.VERSION_CACHE_DIRECTORY = self.cache_directory
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _members(self, files):
+        return iter([com.TarMember(name, StringIO.StringIO(text)) for name, text in files])
+
+    def test_01_scan_stops_at_version(self):
+        members = self._members([('test_000', 'line\n' * 10),
+                                 ('check_module_001', "+CGMREX: 'V1.2 generic'\n"),
+                                 ('test_002', 'line\n')])
+        spooled, package_version, _ = index.scan_stream_versions(members, 'ckcm')
+        self.assertEqual(package_version, 'v1.2')
+        self.assertEqual([member.name for member in spooled], ['test_000', 'check_module_001'])
+        self.assertEqual(next(members).name, 'test_002')
+
+    def test_02_scan_bounded(self):
+        members = self._members([('test_%03d' % position, 'line\n' * 100)
+                                 for position in range(10)])
+        spooled, package_version, _ = index.scan_stream_versions(members, 'ckcm',
+                                                                 max_size=1000)
+        self.assertIsNone(package_version)
+        self.assertEqual(len(spooled), 2)
+        self.assertEqual(next(members).name, 'test_002')
+
+    def test_03_untar_beyond_scan_size(self):
+        tgz_file = os.path.join(self.directory, 'ckcm.tgz')
+        with tarfile.open(tgz_file, 'w:gz') as tgz_c:
+            for name in ('test_000', 'test_001', 'check_module_002'):
+                text = "+CGMREX: 'V1.2 generic'\n" if name.startswith('check') else 'line\n' * 100
+                info = tarfile.TarInfo('traces/' + name)
+                info.size = len(text)
+                tgz_c.addfile(info, StringIO.StringIO(text))
+        index.STREAM_SCAN_MAX_SIZE = 500
+        traces = index.prepare_tgz(tgz_file, 'fc6000', 'generic', 12,
+                                   work_directory=self.directory, stream=True)
+        self.assertIsNone(traces.members)
+        self.assertEqual(traces.directory_c, os.path.join(self.directory, 'traces'))
+        self.assertEqual(traces.package_version, 'v1.2')
+
+class TestVersionDetection(unittest.TestCase):
+
+    #test de la detection des versions d'un build extrait
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = index.VERSION_CACHE_DIRECTORY
+        index.VERSION_CACHE_DIRECTORY = os.path.join(self.directory, 'versions')
+        self.find_first_match = index.find_first_match
+        self.scans = []
+
+    def tearDown(self):
+        index.VERSION_CACHE_DIRECTORY = self.cache_directory
+        index.find_first_match = self.find_first_match
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _build(self, name, files):
+        directory = os.path.join(self.directory, name)
+        os.mkdir(directory)
+        for file_name, text in files:
+            with open(os.path.join(directory, file_name), 'w') as file_c:
+                file_c.write(text)
+        return directory
+
+    def _count_scans(self):
+        def find_first_match(file_paths, match):
+            self.scans.append(file_paths)
+            return self.find_first_match(file_paths, match)
+        index.find_first_match = find_first_match
+
+    def test_01_scan_order(self):
+        directory = self._build('traces', [('check_module_big', 'line\n' * 100),
+                                           ('check_module_small', 'line\n'),
+                                           ('setenv_000', ''),
+                                           ('cmd_CGMREX_000', 'line\n' * 1000)])
+        file_paths = index.likely_version_files(directory, os.listdir(directory))
+        self.assertEqual([os.path.basename(path) for path in file_paths],
+                         ['cmd_CGMREX_000', 'check_module_small', 'check_module_big',
+                          'setenv_000'])
+
+    def test_02_scan_stops_at_first_match(self):
+        directory = self._build('traces', [('check_module_000', "line\n+CGMREX: 'V1.2 a'\n"),
+                                           ('check_module_001', "+CGMREX: 'V9.9 b'\n")])
+        file_paths = [os.path.join(directory, name)
+                      for name in ('check_module_000', 'check_module_001')]
+        matched = []
+        def match(line):
+            matched.append(line)
+            return index.match_cgmrex(line)
+        self.assertEqual(index.find_first_match(file_paths, match),
+                         ('v1.2', file_paths[0], 5))
+        self.assertEqual(len(matched), 2)
+
+    def test_03_cache_hit_across_directories(self):
+        files = [('test_000', 'line\n' * 10),
+                 ('check_module_001', "line\n+CGMREX: 'V1.2 generic'\n")]
+        self._count_scans()
+        self.assertEqual(index.get_package_version(self._build('run_1', files), 'ckcm_12'),
+                         'v1.2')
+        self.assertEqual(len(self.scans), 1)
+        self.assertTrue(os.path.isfile(os.path.join(index.VERSION_CACHE_DIRECTORY,
+                                                    'ckcm_12.json')))
+        # same build untarred in another temporary directory: no scan
+        self.assertEqual(index.get_package_version(self._build('run_2', files), 'ckcm_12'),
+                         'v1.2')
+        self.assertEqual(len(self.scans), 1)
+        # another build: cache miss
+        self.assertEqual(index.get_package_version(self._build('run_3', files), 'ckcm_13'),
+                         'v1.2')
+        self.assertEqual(len(self.scans), 2)
+
+    def test_04_stale_cache_entry(self):
+        self._count_scans()
+        index.get_package_version(self._build('run_1', [
+            ('check_module_001', "+CGMREX: 'V1.2 generic'\n")]), 'ckcm_12')
+        version = index.get_package_version(self._build('run_2', [
+            ('check_module_001', "+CGMREX: 'V1.3 generic'\n")]), 'ckcm_12')
+        self.assertEqual(version, 'v1.3')
+        self.assertEqual(len(self.scans), 2)
+
+class TestIncrementalIndexing(unittest.TestCase):
+
+    #test de l'indexation incrementale
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.traces = os.path.join(self.directory, 'traces')
+        os.makedirs(self.traces)
+        self.manifest_directory = index.MANIFEST_DIRECTORY
+        index.MANIFEST_DIRECTORY = os.path.join(self.directory, 'manifests')
+
+    def tearDown(self):
+        index.MANIFEST_DIRECTORY = self.manifest_directory
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, file_c, count, seed=0, mtime=1000000):
+        """ ckcm trace file of count lines, same lines for a same seed """
+        rand = random.Random(seed)
+        file_path = os.path.join(self.traces, file_c)
+        with open(file_path, 'w') as trace:
+            for position in range(count):
+                trace.write(tracegen.ckcm_line(rand, position) + '\n')
+        os.utime(file_path, (mtime, mtime))
+        return file_path
+
+    def _index(self, fake_es):
+        rollup_file = os.path.join(self.directory, 'rollup.json')
+        index.index_directory(self.traces, 'ckcm_v1_fc6000_generic_12', 'ckcm', 'v1',
+                              'fc6000', None, incremental=True, hosts=[fake_es.host],
+                              rollup_file=rollup_file)
+        return rollup.load_rollup(rollup_file).test_lines()
+
+    def test_01_rollup_of_reparsed_files_replaced(self):
+        with FakeElasticsearch() as fake_es:
+            self._write('test_000_ckcm_0.log', 30)
+            self._write('test_001_ckcm_0.log', 30)
+            self.assertEqual(self._index(fake_es), {'test_000': (30, 3), 'test_001': (30, 3)})
+            # test_000 grown: tail only, test_001 rewritten: parsed from its start
+            self._write('test_000_ckcm_0.log', 50, mtime=2000000)
+            self._write('test_001_ckcm_0.log', 20, seed=1, mtime=2000000)
+            lines = self._index(fake_es)
+        self.assertEqual(lines['test_000'][0], 50)
+        self.assertEqual(lines['test_001'][0], 20)
+
+    def test_02_incremental_offsets(self):
+        files = ['test_000_ckcm_0.log', 'test_001_ckcm_0.log', 'test_002_ckcm_0.log',
+                 'test_003_ckcm_0.log']
+        for file_c in files:
+            self._write(file_c, 30)
+        offsets, manifest = index.get_incremental_offsets(self.traces, files, {})
+        self.assertEqual(offsets, dict.fromkeys(files, 0))
+        size = manifest[files[0]]['size']
+        #Unchanged files are left out
+        self.assertEqual(index.get_incremental_offsets(self.traces, files, manifest), ({}, {}))
+        #Grown file: tail only, changed and truncated files: from their start
+        self._write(files[0], 50, mtime=2000000)
+        self._write(files[1], 30, seed=1, mtime=2000000)
+        self._write(files[2], 20, mtime=2000000)
+        #Touched file (same content): left out
+        self._write(files[3], 30, mtime=2000000)
+        offsets, signatures = index.get_incremental_offsets(self.traces, files, manifest)
+        self.assertEqual(offsets, {files[0]: size, files[1]: 0, files[2]: 0})
+        self.assertEqual(signatures[files[0]]['offset'],
+                         os.path.getsize(os.path.join(self.traces, files[0])))
+
+    def test_03_tail_indexed_once(self):
+        with FakeElasticsearch() as fake_es:
+            size = os.path.getsize(self._write('test_000_ckcm_0.log', 30))
+            self._index(fake_es)
+            #Nothing new: nothing indexed, rollup kept
+            self.assertEqual(self._index(fake_es), {'test_000': (30, 3)})
+            self._write('test_000_ckcm_0.log', 45, mtime=2000000)
+            self.assertEqual(self._index(fake_es)['test_000'][0], 45)
+        offsets = [int(doc_id.rpartition(':')[2]) for doc_id in fake_es.ids
+                   if doc_id.startswith('test_000_ckcm_0.log:')]
+        self.assertEqual(len(offsets), 45)
+        self.assertEqual(len(set(offsets)), 45)
+        self.assertEqual(len([offset for offset in offsets if offset >= size]), 15)
+
+    def test_04_rollup_of_failed_files_kept(self):
+        former = rollup.Rollup()
+        former.add('test_000', 'error', 'sop')
+        manifest = {'test_000_ckcm_0.log': {'rollup': former.to_json()}}
+        tail = rollup.Rollup()
+        tail.add('test_000', 'info', 'sop')
+        file_rollups = index.update_file_rollups(manifest, [('test_000_ckcm_0.log', False)],
+                                                 {'test_000_ckcm_0.log': 100},
+                                                 {'test_000_ckcm_0.log': tail})
+        self.assertEqual(file_rollups['test_000_ckcm_0.log'].test_lines(), {'test_000': (1, 1)})
+        file_rollups = index.update_file_rollups(manifest, [('test_000_ckcm_0.log', True)],
+                                                 {'test_000_ckcm_0.log': 100},
+                                                 {'test_000_ckcm_0.log': tail})
+        self.assertEqual(file_rollups['test_000_ckcm_0.log'].test_lines(), {'test_000': (2, 1)})
+
+    def test_05_partial_last_line(self):
+        file_path = self._write('test_000_ckcm_0.log', 40)
+        with open(file_path) as trace:
+            lines = trace.readlines()
+        starts = [sum(len(line) for line in lines[:position]) for position in range(40)]
+        with FakeElasticsearch() as fake_es:
+            # last line still written: parsed, then parsed again once complete
+            with open(file_path, 'w') as trace:
+                trace.write(''.join(lines[:30]) + lines[30][:20])
+            os.utime(file_path, (1000000, 1000000))
+            self.assertEqual(self._index(fake_es)['test_000'][0], 31)
+            manifest = index.load_manifest('ckcm_v1_fc6000_generic_12')
+            self.assertEqual(manifest['test_000_ckcm_0.log']['offset'], starts[30])
+            self._write('test_000_ckcm_0.log', 40, mtime=2000000)
+            self.assertEqual(self._index(fake_es)['test_000'][0], 40)
+            # nothing new: index settings untouched
+            requests = len(fake_es.requests)
+            self.assertEqual(self._index(fake_es)['test_000'][0], 40)
+            paths = [path for _, path, _, _ in fake_es.requests[requests:]]
+        offsets = [int(doc_id.rpartition(':')[2]) for doc_id in fake_es.ids
+                   if doc_id.startswith('test_000_ckcm_0.log:')]
+        self.assertEqual(sorted(set(offsets)), starts)
+        self.assertEqual(len(offsets), 41)
+        self.assertFalse([path for path in paths if '_settings' in path or '_forcemerge' in path])
+
+class TestRollupModule(unittest.TestCase):
+
+    #test du module rollup
+
+    def setUp(self):
+        self.rollup = rollup.Rollup()
+        self.rollup.add('test_000', 'info', 'hiphop', '10:00:01.000')
+        self.rollup.add('test_000', 'error', 'tala', '10:01:30.000')
+        self.rollup.add('test_001', 'error', 'tala', '09:59:59.000')
+
+    def test_01_counts_per_test(self):
+        other = rollup.Rollup()
+        other.add('test_000', 'info', 'hiphop', '09:00:00.000')
+        self.rollup.merge(other)
+        self.assertEqual(self.rollup.test_lines(), {'test_000': (3, 1), 'test_001': (1, 1)})
+        self.assertEqual(self.rollup.tests['test_000'], ['09:00:00.000', '10:01:30.000'])
+        self.assertEqual(self.rollup.buckets[('10:00', 'info')], 1)
+
+    def test_02_documents_and_json(self):
+        documents = self.rollup.documents('ckcm_v1_12', {'build': '12'})
+        self.assertEqual(len(documents), 3 + 3 + 2)
+        self.assertEqual(documents[0]['_id'], u'ckcm_v1_12:count:test_000:error:tala')
+        loaded = rollup.Rollup.from_json(json.loads(json.dumps(self.rollup.to_json())))
+        self.assertEqual(loaded.documents('ckcm_v1_12'), self.rollup.documents('ckcm_v1_12'))
+
+class TestTemplatesModule(unittest.TestCase):
+
+    #test du module templates
+
+    def test_01_template_params(self):
+        miner = templates.TemplateMiner()
+        first = miner.match(u'timer 12 expired after 500 ms')
+        second = miner.match(u'timer 13 expired after 250 ms')
+        self.assertEqual(first, (1, [u'12', u'500']))
+        self.assertEqual(second, (1, [u'13', u'250']))
+        self.assertEqual(miner.match(u'connection 3 state up')[0], 2)
+        self.assertEqual(miner.templates[1].text, u'timer <*> expired after <*> ms')
+
+    def test_02_repeats_collapsed_ids_kept(self):
+        miner = templates.TemplateMiner()
+        documents = [{'text': u'[00:00:0%d.000][1000]SOP retry 4' % position}
+                     for position in range(3)] + [{'text': u'[00:00:04.000][1000]SOP retry 5'}]
+        mined = list(miner.mine(documents, 'ckcm', 'build_1'))
+        self.assertEqual([data['repeat'] for data in mined], [3, 1])
+        self.assertEqual(miner.first_seen('build_1'), set([1]))
+        loaded = templates.TemplateMiner.from_json(json.loads(json.dumps(miner.to_json())))
+        self.assertEqual(loaded.match(u'[1000]SOP retry 6'), (1, [u'[1000]SOP', u'6']))
+        self.assertEqual(loaded.next_id, 2)
+
+class TestSearchModule(unittest.TestCase):
+
+    #test du module search
+
+    documents = [{'text': u'[00:00:01.000][E]SOP timer expired', 'severity': 'error',
+                  'library': 'sop', 'test': 'test_000'},
+                 {'text': u'[00:00:02.000][I]SOP timer started', 'severity': 'info',
+                  'library': 'sop', 'test': 'test_000'},
+                 {'text': u'[00:00:03.000][E]RAP timer expired', 'severity': 'error',
+                  'library': 'rap', 'test': 'test_001'},
+                 {'text': u'[00:00:04.000][E]SOP reset \xe9chec', 'severity': 'error',
+                  'library': 'sop', 'test': 'test_001'},
+                 {'text': u'[00:00:05.000][W]SOP timer expired', 'severity': 'warning',
+                  'library': 'sop', 'test': 'test_001'}]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = search.LocalIndex(os.path.join(self.directory, 'index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_01_segment_round_trip(self):
+        writer = search.SegmentWriter(os.path.join(self.directory, 'segment'), 'ckcm_b1')
+        for data in self.documents:
+            writer.add(data)
+        writer.close()
+        segment = search.Segment(os.path.join(self.directory, 'segment'))
+        self.assertEqual((segment.name, segment.count), ('ckcm_b1', 5))
+        self.assertEqual(list(segment.documents([3, 0])), [self.documents[3], self.documents[0]])
+        self.assertEqual(list(segment.postings(u'expired')), [0, 2, 4])
+        self.assertEqual(list(segment.postings(u'unknown')), [])
+
+    def test_02_term_and_bitmap_queries(self):
+        self.index.add_documents(self.documents, 'ckcm_b1')
+        segment = next(self.index.segments())
+        self.assertEqual(segment.search(text=u'Timer expired'), [0, 2, 4])
+        self.assertEqual(segment.search(text=u'\xc9CHEC'), [3])
+        self.assertEqual(segment.search(severity='error'), [0, 2, 3])
+        self.assertEqual(segment.search(severity='error', library='sop'), [0, 3])
+        self.assertEqual(segment.search(text=u'expired', severity='error', library='sop'), [0])
+        self.assertEqual(segment.search(severity='critical'), [])
+        self.assertEqual(segment.search(), range(5))
+        self.assertRaises(ValueError, list, self.index.search(module='fc6000'))
+
+    def test_03_segments_merged(self):
+        self.index.add_documents(self.documents, 'ckcm_b1', segment_max_docs=2)
+        self.index.add_documents(self.documents[:2], 'ckcm_b2')
+        self.assertEqual([segment.name for segment in self.index.segments()],
+                         ['ckcm_b1'] * 3 + ['ckcm_b2'])
+        results = list(self.index.search(u'expired', severity='error', limit=None))
+        self.assertEqual(results, [('ckcm_b1', self.documents[0]), ('ckcm_b1', self.documents[2]),
+                                   ('ckcm_b2', self.documents[0])])
+        results = list(self.index.search(u'timer', limit=4))
+        self.assertEqual([data['text'][1:13] for _, data in results],
+                         ['00:00:01.000', '00:00:02.000', '00:00:03.000', '00:00:05.000'])
+        results = list(self.index.search(u'expired', build='*_b2'))
+        self.assertEqual(results, [('ckcm_b2', self.documents[0])])
+
+    def test_05_term_blocks(self):
+        block_size = search.TERMS_BLOCK_SIZE
+        search.TERMS_BLOCK_SIZE = 3
+        try:
+            self.index.add_documents(self.documents, 'ckcm_b1')
+        finally:
+            search.TERMS_BLOCK_SIZE = block_size
+        segment = next(self.index.segments())
+        tokens = set()
+        for data in self.documents:
+            tokens.update(search.tokenize(data['text']))
+        self.assertEqual(len(segment.terms_index), (len(tokens) + 2) // 3)
+        for token in tokens:
+            self.assertEqual(list(segment.postings(token)),
+                             [doc_id for doc_id, data in enumerate(self.documents)
+                              if token in search.tokenize(data['text'])])
+        for token in (u'0', u'ab', u'timez', u'\u00e9', u'zzz'):
+            self.assertIsNone(segment.term(token))
+        # segments loaded once per local index
+        self.assertIs(next(self.index.segments()), segment)
+
+    def test_04_command_line(self):
+        traces = os.path.join(self.directory, 'traces')
+        tracegen.write_trace_directory(traces, 'ckcm', files=2, lines=200)
+        src.com._LOGGING_INITIALIZED, initialized = True, src.com._LOGGING_INITIALIZED
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            search.main(['build', self.index.directory, traces, '--name', 'ckcm_b1',
+                         '--version', 'v1'])
+            search.main(['query', self.index.directory, '--severity', 'error',
+                         '--test', 'test_001', '--limit', '1000'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            src.com._LOGGING_INITIALIZED = initialized
+        results = [json.loads(line) for line in output.splitlines()]
+        parser_c = parser.get_parser('ckcm', None)
+        expected = [data['text'] for file_c in sorted(os.listdir(traces))
+                    for data in parser_c.parse(os.path.join(traces, file_c), version='v1')
+                    if data['severity'] == 'error' and data['test'] == 'test_001']
+        self.assertTrue(expected)
+        self.assertEqual([result['document']['text'] for result in results], expected)
+        self.assertEqual(set(result['build'] for result in results), set(['ckcm_b1']))
+
+class TestExportModule(unittest.TestCase):
+
+    #test de l'export en colonnes
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.documents = [{'text': u'[00:00:0%d.000][E]SOP \u00e9chec "%d"' % (position, position),
+                           'severity': ('error', 'info')[position % 2], 'library': 'sop',
+                           'ATCommand': u'None', 'ATEvent': u'None', 'test': 'test_000',
+                           'module': 'fc6000', 'version': 'v1'}
+                          for position in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _columns(self, table):
+        return dict((column, table.column(column).to_pylist()) for column in export.EXPORT_COLUMNS)
+
+    def test_01_parquet_row_groups(self):
+        import pyarrow.parquet
+        output_path = os.path.join(self.directory, 'traces.parquet')
+        self.assertEqual(export.export_documents(self.documents, output_path,
+                                                 row_group_size=2), 5)
+        parquet_file = pyarrow.parquet.ParquetFile(output_path)
+        self.assertEqual(parquet_file.num_row_groups, 3)
+        self.assertEqual([parquet_file.metadata.row_group(group).num_rows for group in range(3)],
+                         [2, 2, 1])
+        severity = export.EXPORT_COLUMNS.index('severity')
+        self.assertIn('PLAIN_DICTIONARY',
+                      parquet_file.metadata.row_group(0).column(severity).encodings)
+        columns = self._columns(parquet_file.read())
+        self.assertEqual(columns['text'], [data['text'] for data in self.documents])
+        self.assertEqual(columns['timestamp'], [u'00:00:0%d.000' % position for position in range(5)])
+        self.assertEqual(columns['severity'], [u'error', u'info', u'error', u'info', u'error'])
+        self.assertEqual(columns['ATCommand'], [None] * 5)
+
+    def test_02_arrow_dictionary_batches(self):
+        import pyarrow
+        output_path = os.path.join(self.directory, 'traces.arrow')
+        self.assertEqual(export.export_documents(self.documents, output_path, 'arrow',
+                                                 row_group_size=2), 5)
+        reader = pyarrow.ipc.open_file(pyarrow.OSFile(output_path))
+        self.assertEqual(reader.num_record_batches, 3)
+        for column in export.EXPORT_COLUMNS:
+            self.assertEqual(pyarrow.types.is_dictionary(reader.schema.field(column).type),
+                             column in export.DICTIONARY_COLUMNS)
+        columns = self._columns(reader.read_all())
+        self.assertEqual(columns['text'], [data['text'] for data in self.documents])
+        self.assertEqual(columns['library'], [u'sop'] * 5)
+        self.assertEqual(columns['ATEvent'], [None] * 5)
+
+    def test_03_unknown_format(self):
+        self.assertRaises(src.com.ExportException, export.ColumnarWriter,
+                          os.path.join(self.directory, 'traces.csv'), 'csv')
+
+def _square(value):
+    return value * value
+
+def _squares(count):
+    for value in range(count):
+        yield _square(value)
+
+class TestProfilingModule(unittest.TestCase):
+
+    #test du module profiling
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = profiling.StageProfiler(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _square_calls(self, file_path):
+        stats = pstats.Stats(file_path).stats
+        return sum(stat[1] for key, stat in stats.items() if key[2] == '_square')
+
+    def test_01_labelled_iterator_profiled_once(self):
+        self.assertEqual(sum(self.profiler.iterate(_squares(500), 'parse', 'trace.log')),
+                         sum(value * value for value in range(500)))
+        file_path = os.path.join(self.directory, 'parse', 'trace.log.prof')
+        self.assertEqual(self._square_calls(file_path), 500)
+
+    def test_02_iterator_closed_early(self):
+        for value in self.profiler.iterate(_squares(500), 'templates'):
+            if value > 100:
+                break
+        self.profiler.dump()
+        self.assertEqual(len(self.profiler._profiles), 0)
+        self.assertEqual(self._square_calls(os.path.join(self.directory, 'templates.prof')), 12)
+
+    def test_03_file_profiles_per_build(self):
+        for es_index in ('ckcm_v1_fc6000_generic_12', 'ckcm_v1_fc6000_generic_13',
+                         'ckcm_v1_fc6000_generic_12'):
+            label = profiling.profile_label(es_index, '/tmp/job/traces/test_000_0_0.log')
+            with self.profiler.stage('parse', label):
+                _square(2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'parse'))),
+                         ['ckcm_v1_fc6000_generic_12', 'ckcm_v1_fc6000_generic_13'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'parse',
+                                                        'ckcm_v1_fc6000_generic_12'))),
+                         ['test_000_0_0.log.1.prof', 'test_000_0_0.log.prof'])
+
+class TestParallelIndexing(unittest.TestCase):
+
+    #test de l'indexation des fichiers par un pool de processus
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.batch_size = index.PARSE_BATCH_SIZE
+
+    def tearDown(self):
+        index.PARSE_BATCH_SIZE = self.batch_size
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_01_documents_sent_by_batches(self):
+        tracegen.write_trace_directory(self.directory, 'ckcm', 2, 100)
+        # forked parsing processes inherit the batch size
+        index.PARSE_BATCH_SIZE = 7
+        rollups = {}
+        with FakeElasticsearch() as fake_es:
+            es_c = Elasticsearch(hosts=[fake_es.host])
+            results = index.index_files_parallel(es_c, self.directory, 'test', 'ckcm', 'v1',
+                                                 'fc6000', None, 2, rollups=rollups)
+        self.assertEqual(sorted(file_c for file_c, _ in results), sorted(rollups))
+        self.assertTrue(all(error_code for _, error_code in results))
+        self.assertEqual(fake_es.documents, sum(len(rollup) for rollup in rollups.values()))
+        self.assertEqual(fake_es.documents, 201)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_02_indexing_error_stops_parsing(self):
+        tracegen.write_trace_directory(self.directory, 'ckcm', 4, 2000)
+        # parsing processes fill the queue and wait
+        index.PARSE_BATCH_SIZE = 10
+        bulk_index = index.bulk_index
+        errors = []
+
+        def failing_bulk_index(*args, **kwargs):
+            raise IOError('bulk failed')
+
+        def run():
+            try:
+                index.index_files_parallel(None, self.directory, 'test', 'ckcm', 'v1',
+                                           'fc6000', None, 2)
+            except IOError as exc:
+                errors.append(exc)
+
+        index.bulk_index = failing_bulk_index
+        try:
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+            thread.join(30)
+        finally:
+            index.bulk_index = bulk_index
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+class TestIndexConfigs(unittest.TestCase):
+
+    #test du pipeline d'indexation de plusieurs configs
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.work_directory = os.path.join(self.directory, 'work')
+        os.mkdir(self.work_directory)
+        traces = os.path.join(self.directory, 'traces')
+        tracegen.write_trace_directory(traces, 'ckcm', 2, 20)
+        self.tgz_file = tracegen.write_tgz(traces, os.path.join(self.directory, 'ckcm.tgz'))
+        self.job_class = index.jenkins.JenkinsJob
+        self.index_directory = index.index_directory
+        self.es_hosts = index.ES_HOSTS
+        self.cache_directory = index.VERSION_CACHE_DIRECTORY
+        index.VERSION_CACHE_DIRECTORY = os.path.join(self.directory, 'versions')
+        self.job_directories = []
+        self.live_directories = 0
+
+    def tearDown(self):
+        index.jenkins.JenkinsJob = self.job_class
+        index.index_directory = self.index_directory
+        index.ES_HOSTS = self.es_hosts
+        index.VERSION_CACHE_DIRECTORY = self.cache_directory
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _stub(self, download_failures=(), index_failures=()):
+        test = self
+
+        class FakeJenkinsJob(object):
+            """ tar.gz copied instead of downloaded """
+            def __init__(self, config_hw=None, config_sw=None, work_directory='/tmp', **_):
+                if config_sw in download_failures:
+                    raise IOError('download failed')
+                test.job_directories.append(work_directory)
+                test.live_directories = max(test.live_directories,
+                                            len(os.listdir(test.work_directory)))
+                self.ckcm_tgz_file_name = os.path.join(work_directory, 'ckcm.tgz')
+                shutil.copy(test.tgz_file, self.ckcm_tgz_file_name)
+                self.build_number = 12
+
+            def get_url(self):
+                return 'fake'
+
+        def index_directory(directory_c, es_index, *args, **kwargs):
+            if any(config in es_index for config in index_failures):
+                raise IOError('indexing failed')
+            # indexing slower than downloads
+            time.sleep(0.05)
+            return test.index_directory(directory_c, es_index, *args, **kwargs)
+
+        index.jenkins.JenkinsJob = FakeJenkinsJob
+        index.index_directory = index_directory
+
+    def test_01_failing_jobs_isolated(self):
+        self._stub(download_failures=('config1',), index_failures=('config2',))
+        configs = [('FC6000', 'config%d' % position) for position in range(6)]
+        with FakeElasticsearch() as fake_es:
+            index.ES_HOSTS = [fake_es.host]
+            results = index.index_configs(configs, download_workers=2, parse_workers=2,
+                                          index_workers=1,
+                                          work_directory=self.work_directory)
+        self.assertEqual(results, dict((config, config[1] not in ('config1', 'config2'))
+                                       for config in configs))
+        documents = dict((config, 0) for config in configs)
+        for _, path, count, _ in fake_es.requests:
+            if path.endswith('/ckcm/_bulk'):
+                documents[('FC6000', path.split('_')[3])] += count
+        # 2 files of 20 lines and the version file per indexed job
+        self.assertEqual(documents, dict((config, 0 if config[1] in ('config1', 'config2')
+                                          else 41) for config in configs))
+        # one directory per job, all removed
+        self.assertEqual(len(set(self.job_directories)), 5)
+        self.assertEqual(os.listdir(self.work_directory), [])
+        # bounded traces queue: downloading, waiting and indexing jobs only
+        self.assertTrue(self.live_directories <= 2 + 1 + 1)
+
+class TestBenchmarks(unittest.TestCase):
+
+    #test de la suite de benchmarks
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_01_run_and_compare(self):
+        from src.benchmarks import run
+        results = run.run(files=1, lines=50, selected=['ckcm_log', 'ckcm_parser', 'bulk_index'])
+        self.assertEqual([result['name'] for result in results['benchmarks']],
+                         ['ckcm_log', 'ckcm_parser', 'bulk_index'])
+        for result in results['benchmarks']:
+            self.assertNotIn('error', result)
+            self.assertTrue(result['rate'] > 0)
+        # lines bulk indexed to the fake endpoint
+        self.assertEqual(results['benchmarks'][2]['count'], 50)
+        self.assertEqual(run.compare(results, results), [])
+
+        previous = os.path.join(self.directory, 'previous.json')
+        # ckcm_log 1000 times faster before, ckcm_parser slower
+        results['benchmarks'][0]['rate'] *= 1000
+        results['benchmarks'][1]['rate'] /= 1000
+        with open(previous, 'w') as previous_c:
+            json.dump(results, previous_c)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            status = run.main(['--files', '1', '--lines', '50', '--only', 'ckcm_log',
+                               '--only', 'ckcm_parser', '--compare', previous])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 1)
+        self.assertIn('REGRESSION ckcm_log:', output)
+        self.assertNotIn('REGRESSION ckcm_parser', output)
+
 #Main entry of unitary tests campaigns
 if __name__ == '__main__':
     unittest.main()